@@ -23,6 +23,8 @@ from lib.NEF_reader import _split_path_and_frame, TRANSLATIONS_1_3_PROTEIN
 import logging
 
 from lib.rdcs_lib import build_log_probability_from_entry, get_nef_entry
+from lib.cache_lib import MatrixCache
+from lib import diagnostics_lib
 
 
 def _get_arguments(system_args):
@@ -105,6 +107,33 @@ def _get_arguments(system_args):
 
     parser.add_argument("--rdc_type", choices= ["nef","snaps"], help=" type of RDC data.", default="nef")
 
+    parser.add_argument("--threads", type=int, default=None,
+                        help="""Number of threads to use when calculating the log
+                        probability matrix. Overrides n_threads in the config
+                        file (default 1).""")
+
+    # Caching of calculated score matrices
+    parser.add_argument("--cache_dir", default=None,
+                        help="""A directory for caching the calculated score
+                        matrices between runs. If not given, no cache is used.""")
+    parser.add_argument("--cache_size", type=float, default=500,
+                        help="""The maximum size of the cache in MB. The least
+                        recently used entries are removed beyond this.""")
+
+    # Diagnostic output of intermediate tables
+    parser.add_argument("--diagnostics_dir", default=None,
+                        help="""A directory to save intermediate tables (eg. the
+                        log probability matrix) to, as binary files listed in
+                        index.json. If not given, nothing is saved.""")
+    parser.add_argument("--diagnostics_level", choices=list(diagnostics_lib.LEVELS),
+                        default="summary",
+                        help="""How much to save to --diagnostics_dir: summary
+                        for the main score matrices, detail to also include
+                        the inputs and intermediate steps.""")
+    parser.add_argument("--diagnostics_text", action="store_true", default=False,
+                        help="""Also save a text version of each table saved to
+                        --diagnostics_dir. This can be slow for large proteins.""")
+
     args = parser.parse_args(system_args)
 
     # if input shifts are nef all file types are nef unless
@@ -156,6 +185,17 @@ def run_snaps(system_args):
     # Import config file
     assigner.read_config_file(args.config_file)
 
+    if args.threads is not None:
+        assigner.pars["n_threads"] = args.threads
+
+    if args.cache_dir is not None:
+        assigner.cache = MatrixCache(args.cache_dir, int(args.cache_size * 2**20))
+
+    if args.diagnostics_dir is not None:
+        diagnostics_lib.configure(args.diagnostics_dir, args.diagnostics_level,
+                                  text=args.diagnostics_text)
+        logger.info("Saving %s diagnostics to %s", args.diagnostics_level, args.diagnostics_dir)
+
 
     # Importer for observed and predicted shifts
     importer = SNAPS_importer()
@@ -198,6 +238,9 @@ def run_snaps(system_args):
 
     # assigner.calc_mismatch_matrix()
     #
+    # # The marginal probabilities are only used in assign_df and the output
+    # assigner.calc_marginal_prob_matrix()
+    #
     # if assigner.pars["iterate_until_consistent"]:
     #     assigner.assign_df = assigner.find_consistent_assignments(set_assign_df=True)
     # else:
@@ -281,14 +324,19 @@ def _output_results(args, assigner, logger,):
 
         min_log_prob = -min(assign_df['Log_prob'])
 
-        nef_out_frame = pd.DataFrame(assign_df[['SS_name', 'Res_N', 'Res_name',  'Res_type','Log_prob']])
+        # The merit is the marginal probability of each pair if it's been
+        # calculated, otherwise it's scaled from the log probability
+        use_marginal_prob = 'Marginal_prob' in assign_df.columns
+        merit_column = 'Marginal_prob' if use_marginal_prob else 'Log_prob'
+
+        nef_out_frame = pd.DataFrame(assign_df[['SS_name', 'Res_N', 'Res_name',  'Res_type', merit_column]])
 
 
         nef_out_frame = nef_out_frame.rename(columns={
             'SS_name': 'unassigned_sequence_code',
             'Res_N': 'sequence_code',
             'Res_type': 'residue_name',
-            'Log_prob': 'merit'
+            merit_column: 'merit'
         })
 
 
@@ -321,7 +369,8 @@ def _output_results(args, assigner, logger,):
 
         nef_out_frame_assigned['assigned'] = nef_out_frame['assigned'].replace({'NaN': False})
 
-        nef_out_frame_assigned['merit'] = ((min_log_prob - nef_out_frame_assigned['merit']) / min_log_prob) - 1
+        if not use_marginal_prob:
+            nef_out_frame_assigned['merit'] = ((min_log_prob - nef_out_frame_assigned['merit']) / min_log_prob) - 1
 
         nef_out_frame_assigned['residue_name'] = nef_out_frame_assigned['residue_name'].replace(TRANSLATIONS_1_3_PROTEIN)
 
@@ -363,6 +412,8 @@ def _output_results(args, assigner, logger,):
         output = str(save_frame)
 
     else:
+        if 'Marginal_prob' in assigner.assign_df.columns:
+            headings.insert(headings.index('Log_prob') + 1, 'Marginal_prob')
 
         table = []
         for df_index, df_row in assigner.assign_df.iterrows():
@@ -407,7 +458,6 @@ def _import_rdc_data(args, assigner, importer):
 
         if args.rdc_type == "nef" :
 
-            print('rdc')
             file_name=args.rdc_file
             magnitude_matrix=importer.import_rdc_data(file_name)
 
@@ -418,10 +468,10 @@ def _import_rdc_data(args, assigner, importer):
 
 
         else:
-            print('wrong file format ')
+            logging.getLogger("SNAPS").warning("Unrecognised RDC file format %s", args.rdc_type)
 
     else:
-        print('no rdc file provided')
+        logging.getLogger("SNAPS").info("No RDC file provided")
 
 
 def _setup_logger(args):
@@ -8,6 +8,7 @@ the imported chemical shifts and the log probability matrix).
 @author: aph516
 """
 import sys
+from time import perf_counter
 from xmlrpc.client import DateTime
 
 import numpy as np
@@ -18,9 +19,7 @@ from bokeh.models.ranges import Range1d
 from bokeh.models import LabelSet, ColumnDataSource, Span
 from bokeh.io import export_png
 from bokeh.embed import json_item
-from scipy.stats import norm, multivariate_normal
 from scipy.optimize import linear_sum_assignment
-from math import log10
 from copy import deepcopy
 # from Bio.SeqUtils import seq1
 from Bio import SeqIO
@@ -28,12 +27,40 @@ from collections import namedtuple
 from sortedcontainers import SortedListWithKey
 # from textwrap import dedent
 import logging
-import yaml
 from pathlib import Path
 
 from lib.NEF_reader import read_nef_pred_shifts_from_file_to_pandas
 from lib.rdcs_lib import build_magnitude_log_probability_tables, magnitude_matrix_to_log_probability_matrix, \
     add_penalty_tables
+from lib.scoring_lib import (shift_array, independent_log_prob, correlated_log_prob,
+                             pred_correction_arrays, aa_class_masks, residue_type_masks,
+                             aa_type_mismatch)
+from lib.model_registry_lib import registry
+from lib.lap_lib import (solve_with_dummies, DualAssignment, matching_with_dummies,
+                         ConstraintOverlay, ConstraintSession)
+from lib.murty_lib import MurtyProblem, kbest_assignments, DUMMY
+from lib.sinkhorn_lib import sinkhorn_marginals
+from lib.mcmc_lib import SwapProblem, parallel_tempering
+from lib.joint_lib import optimise_joint, DEFAULT_BETAS, JointIteration
+from lib.fragment_lib import link_graph, linear_fragments, place_fragments
+from lib.label_lib import LabelRegistry
+from lib.link_lib import LinkIndex, threshold_sweep
+from lib.cache_lib import hash_inputs
+from lib import diagnostics_lib
+
+# Assignment confidence for each combination of the confidence of the links
+# to the i-1 residue (rows) and the i+1 residue (columns). The codes are
+# N=0 (no link), W=1 (one consistent shift), S=2 (two or more) and
+# X=3 (mismatch above the threshold).
+CONFIDENCE_TABLE = np.array([["Undefined", "Medium", "High", "Unreliable"],
+                             ["Medium", "High", "High", "Low"],
+                             ["High", "High", "High", "Medium"],
+                             ["Unreliable", "Low", "Medium", "Unreliable"]], dtype=object)
+
+# Link term for spin systems with no carbon shifts to compare. This is the
+# mean of -0.5*(mismatch/link_sd)^2 for a correct link, so it neither rewards
+# nor punishes a link with no data relative to a typical good one.
+NEUTRAL_LINK_LOG_PROB = -0.5
 
 
 def df_lookup(df, row_labels, col_labels, index="rows"):
@@ -61,6 +88,73 @@ def df_lookup(df, row_labels, col_labels, index="rows"):
                           index=row_labels))
 
 
+class AssignmentSession:
+    """Interactive constraints on the assignment of a SNAPS_assigner, made
+    with SNAPS_assigner.start_session()
+
+    Spin systems and residues are given by name. After each call to fix(),
+    forbid() or release(), the optimal assignment is repaired from the
+    previous one (see lib.lap_lib.ConstraintSession), which takes milliseconds
+    rather than the time to re-solve the whole problem.
+    """
+
+    def __init__(self, assigner):
+        self.assigner = assigner
+        self.labels = assigner._label_registry()
+        self.problem = ConstraintSession(-assigner.log_prob_matrix.to_numpy(dtype=float),
+                                         self.labels.dummy_ss, self.labels.dummy_res)
+
+    def _ids(self, ss, res):
+        ss = None if ss is None else self.labels.ss_ids([ss])[0]
+        res = None if res is None else self.labels.res_ids([res])[0]
+        return ss, res
+
+    def _timed(self, action, name, ss, res):
+        start_time = perf_counter()
+        action(*self._ids(ss, res))
+        self.assigner.logger.debug("%s %s %s: assignment updated in %.1f ms", name, ss, res,
+                                   1000 * (perf_counter() - start_time))
+
+    def fix(self, ss, res):
+        """Require ss to be assigned to res. If res is a dummy, ss is left
+        unassigned (and vice versa)."""
+        self._timed(self.problem.fix, "Fixed", ss, res)
+
+    def forbid(self, ss, res):
+        """Prevent ss being assigned to res. If res is a dummy, ss must be
+        assigned to a real residue (and vice versa)."""
+        self._timed(self.problem.forbid, "Forbade", ss, res)
+
+    def release(self, ss=None, res=None):
+        """Remove the constraints on the pair (ss, res), or on all pairs of ss
+        or res if only one is given, or all constraints if neither is"""
+        self._timed(self.problem.release, "Released", ss, res)
+
+    def constraints(self):
+        """The current constraints
+
+        Returns
+        A tuple (inc, exc) of DataFrames of SS_name and Res_name pairs, as
+        used by find_best_assignment()
+        """
+        fixed, forbidden = self.problem.constraints()
+        return self.labels.matching(*fixed), self.labels.matching(*forbidden)
+
+    def solution(self, set_assign_df=False):
+        """The best assignment with the current constraints
+
+        Returns
+        An assign_df, as from assign_from_preds()
+        """
+        broken = self.problem.broken()
+        if len(broken):
+            self.assigner.logger.warning(
+                "The constraints can't all be satisfied: %s" %
+                ", ".join(self.labels.ss_names[broken].astype(str)))
+        matching = self.labels.matching(*self.problem.pairs())
+        return self.assigner.make_assign_df(matching, set_assign_df)
+
+
 class SNAPS_assigner:
     # Functions
     def __init__(self):
@@ -69,11 +163,17 @@ class SNAPS_assigner:
         self.seq_df = None
         self.all_preds = None
         self.log_prob_matrix = None
+        self.marginal_prob_matrix = None
         self.mismatch_matrix = None
         self.consistent_links_matrix = None
+        self.link_index = None  # LinkIndex of consistent sequential links, see calc_link_index()
+        self.labels = None  # LabelRegistry for obs and preds, set by prepare_obs_preds()
+        self.session = None  # AssignmentSession, set by start_session()
         self.assign_df = None
         self.alt_assign_df = None
         self.best_match_indexes = None
+        self.cache = None  # Optional MatrixCache for the score matrices
+        self.diagnostics = diagnostics_lib.diagnostics
         self.pars = {"pred_correction": False,
                      "delta_correlation": False,
                      "atom_set": {"H", "N", "HA", "C", "CA", "CB", "C_m1", "CA_m1", "CB_m1"},
@@ -81,7 +181,8 @@ class SNAPS_assigner:
                                  'C': 0.5330, 'CA': 0.4412, 'CB': 0.5163,
                                  'C_m1': 0.5530, 'CA_m1': 0.4412, 'CB_m1': 0.5163},
                      "seq_link_threshold": 0.2,
-                     'use_ss_class_info': False }
+                     'use_ss_class_info': False,
+                     "n_threads": 1}
         self.logger = logging.getLogger("SNAPS.assigner")
 
         if False:
@@ -114,9 +215,7 @@ class SNAPS_assigner:
 
         Parameters
         filename: A path to the configuration file"""
-        f = open(filename, 'r')
-
-        self.pars = yaml.safe_load(f)
+        self.pars = registry.config(filename)
         self.pars["atom_set"] = set(self.pars["atom_set"])
 
         # Check whether all necessary parameters have been imported
@@ -542,8 +641,10 @@ class SNAPS_assigner:
 
         self.obs = obs.copy()
         self.preds = preds.copy()
-        print('recently needed pbs\n', obs)
-        print('recently needed preds\n', preds)
+        self.labels = LabelRegistry.from_obs_preds(self.obs, self.preds)
+        self.link_index = None  # Out of date now obs has changed
+        self.diagnostics.record("prepared_obs", self.obs)
+        self.diagnostics.record("prepared_preds", self.preds)
         return (self.obs, self.preds)
 
     def calc_log_prob_matrix(self, atom_sd=None, sf=1, default_prob=0.01):
@@ -552,10 +653,14 @@ class SNAPS_assigner:
         By probability, we mean the value of the probability density function,
         assuming the prediction errors follow a Gaussian distribution.
         If self.pars["delta_correlation"]==True, correlations in errors between
-        different atom types will be accounted for.
+        different atom types will be accounted for. In this case the
+        multivariate normal is marginalised over any atoms that are missing
+        for a given spin system/residue pair.
         If self.pars["pred_correction"]==True, a linear correction will be
         applied to the predicted shifts to compensate for prediction bias
         towards random coil values.
+        If self.pars["n_threads"] is more than 1, blocks of rows are
+        calculated in parallel on that many threads.
 
         Returns
         A DataFrame containing the log probabilities
@@ -567,153 +672,94 @@ class SNAPS_assigner:
         default_prob: penalty for missing data
         """
 
-        print('self.pars\n', self.pars)
+        self.diagnostics.record("pars", self.pars)
         # Use default atom_sd values if not defined
         if atom_sd is None:
             atom_sd = self.pars["atom_sd"]
 
         obs = self.obs.copy()
-        print ('obs\n', obs)
-
         preds = self.preds.copy()
-        print('preds \n', preds)
         atoms = list(self.pars["atom_set"].intersection(obs.columns))
 
+        if self.cache is not None:
+            cache_key = self._log_prob_cache_key(atoms, atom_sd, sf, default_prob)
+            cached = self.cache.load("log_prob", cache_key)
+            if cached is not None:
+                self.logger.info("Using cached log probability matrix (%dx%d)",
+                                 cached["log_prob_matrix"].shape[0],
+                                 cached["log_prob_matrix"].shape[1])
+                return (self._set_log_prob_matrix(cached["log_prob_matrix"]))
+
+        # Only the real spin systems and residues are scored. Dummies are
+        # given a log probability of 0 with everything at the end.
+        real_obs = ~obs["Dummy_SS"].to_numpy(dtype=bool)
+        real_preds = ~preds["Dummy_res"].to_numpy(dtype=bool)
+        all_obs, all_preds = obs, preds
+        obs = obs.loc[real_obs, :]
+        preds = preds.loc[real_preds, :]
+
+        obs_shifts = shift_array(obs, atoms)
+        pred_shifts = shift_array(preds, atoms)
+        # Rows of the matrix can be calculated in parallel
+        n_threads = max(1, int(self.pars.get("n_threads", 1)))
+
         if self.pars["pred_correction"]:
-            # Import parameters for correcting the shifts
-            lm_pars = pd.read_csv(self.pars["pred_correction_file"], index_col=0)
+            # Get parameters for correcting the shifts, and look up the
+            # gradient and offset for every residue (the i-1 atoms use the
+            # parameters for the preceding residue type)
+            correction_model = registry.correction_model(self.pars["pred_correction_file"])
             self.logger.info("Imported pred_correction info from %s"
                              % self.pars["pred_correction_file"])
+            grad_table, offset_table = correction_model.tables(atoms)
+            pred_grad, pred_offset = pred_correction_arrays(preds, atoms,
+                                                            grad_table, offset_table)
+            self.logger.info("Calculating corrections to predicted shifts")
+        else:
+            pred_grad, pred_offset = None, None
 
         if self.pars["delta_correlation"]:
-            # Import parameters describing the delta correlations
-            # Note: this also sorts the atom types in d_mean and c_cov into the
-            # same order as the 'atoms' list defined above.
+            # Get parameters describing the delta correlations, with the atom
+            # types in the same order as the 'atoms' list defined above.
             if self.pars["pred_correction"]:
-                d_mean = pd.read_csv(self.pars["delta_correlation_mean_corrected_file"],
-                                     header=None, index_col=0).loc[atoms, 1]
-                d_cov = (pd.read_csv(self.pars["delta_correlation_cov_corrected_file"],
-                                     index_col=0).loc[atoms, atoms])
-                self.logger.info("Imported delta_correlation info from %s and %s"
-                                 % (self.pars["delta_correlation_mean_corrected_file"],
-                                    self.pars["delta_correlation_cov_corrected_file"]))
-            else:
-                d_mean = pd.read_csv(self.pars["delta_correlation_mean_file"],
-                                     header=None, index_col=0).loc[atoms, 1]
-                d_cov = (pd.read_csv(self.pars["delta_correlation_cov_file"],
-                                     index_col=0).loc[atoms, atoms])
-                self.logger.info("Imported delta_correlation info from %s and %s"
-                                 % (self.pars["delta_correlation_mean_file"],
-                                    self.pars["delta_correlation_cov_file"]))
-
-            # For the delta_correlation method, we need to store the prediction
-            # errors for each atom type for analysis at the end.
-            delta_list = []
-
-        log_prob_matrix = pd.DataFrame(0, index=obs.index, columns=preds.index)
-        log_prob_matrix.index.name = "Res_name"
-        log_prob_matrix.columns.name ="SS_name"
-
-
-        for atom in atoms:
-            # The most efficient way I've found to do the calculation is to
-            # take the obs and preds shift columns for an atom, repeat each
-            # into a matrix, then subtract these matrixes from each other.
-            # That way, all calculations take advantage of vectorisation.
-            # Much faster than using loops.
-            obs_atom = pd.DataFrame(obs[atom].repeat(len(obs.index)).values.
-                                    reshape([len(obs.index), -1]),
-                                    index=obs.index, columns=preds.index)
-            preds_atom = pd.DataFrame(preds[atom].repeat(len(preds.index)).values.
-                                      reshape([len(preds.index), -1]).transpose(),
-                                      index=obs.index, columns=preds.index)
-
-            # If correcting the predictions, subtract a linear function of the
-            # observed shift from each predicted shift
-            if self.pars["pred_correction"]:
-                self.logger.info("Calculating corrections to predicted shifts")
-                preds_corr_atom = preds_atom
-                for res in preds["Res_type"].dropna().unique():
-                    if (atom + "_" + res) in lm_pars.index:
-                        # Find shifts of the current atom/residue combination
-                        mask = ((lm_pars["Atom_type"] == atom) &
-                                (lm_pars["Res_type"] == res))
-
-                        # Look up model parameters
-                        grad = lm_pars.loc[mask, "Grad"].tolist()[0]
-                        offset = lm_pars.loc[mask, "Offset"].tolist()[0]
-
-                        # Make the correction
-                        if atom in ("C_m1", "CA_m1", "CB_m1"):
-                            mask = (preds["Res_type_m1"] == res)
-                            preds_corr_atom.loc[:, mask] = (
-                                    preds_atom.loc[:, mask]
-                                    - grad * obs_atom.loc[:, mask]
-                                    - offset)
-                        else:
-                            mask = (preds["Res_type"] == res)
-                            preds_corr_atom.loc[:, mask] = (
-                                    preds_atom.loc[:, mask]
-                                    - grad * obs_atom.loc[:, mask]
-                                    - offset)
-
-                delta_atom = preds_corr_atom - obs_atom
-            else:
-                delta_atom = preds_atom - obs_atom
-
-            if self.pars["delta_correlation"]:
-                # Store delta matrix for this atom type for later analysis
-                delta_list = delta_list + [delta_atom.values]
+                mean_file = self.pars["delta_correlation_mean_corrected_file"]
+                cov_file = self.pars["delta_correlation_cov_corrected_file"]
             else:
-                # Make a note of NA positions in delta, and set them to zero
-                # (this avoids warnings when using norm.logpdf)
-                na_mask = np.isnan(delta_atom)
-                delta_atom[na_mask] = 0
+                mean_file = self.pars["delta_correlation_mean_file"]
+                cov_file = self.pars["delta_correlation_cov_file"]
+            d_mean, d_cov, factors = registry.correlation_model(mean_file, cov_file).arrays(atoms)
+            self.logger.info("Imported delta_correlation info from %s and %s"
+                             % (mean_file, cov_file))
 
-                # Calculate the log probability density
-                prob_atom = pd.DataFrame(norm.logpdf(delta_atom,
-                                                     scale=atom_sd[atom]),
-                                         index=obs.index, columns=preds.index)
-
-                # Replace former NA values with a default value
-                prob_atom[na_mask] = log10(default_prob)
-
-                # Add to the log prob matrix
-                log_prob_matrix = log_prob_matrix + prob_atom
-
-        if self.pars["delta_correlation"]:
             self.logger.info("Accounting for correlated prediction errors")
-
-            # Combine the delta matrixes from each atom type into a single 3D matrix
-            delta_mat = np.array(delta_list)
-            # Move the axis containing the atom category to the end
-            # (necessary for multivariate_normal function)
-            delta_mat = np.moveaxis(delta_mat, 0, -1)
-
-            # Make a note of NA positions in delta, and set them to zero
-            na_mask = np.isnan(delta_mat)
-            delta_mat[na_mask] = 0
-
-            # Initialise multivariate model and calculate log_pdf
-            mvn = multivariate_normal(d_mean, d_cov)
-            log_prob_matrix = pd.DataFrame(mvn.logpdf(delta_mat),
-                                           index=obs.index, columns=preds.index)
-            print('log probability before penalties\n', log_prob_matrix)
-            # Apply a penalty for missing data
-            na_matrix = na_mask.sum(axis=-1)  # Count how many NA values for
-            # each Res/SS pair
-            log_prob_matrix = log_prob_matrix + log10(default_prob) * na_matrix
+            log_prob_matrix = correlated_log_prob(obs_shifts, pred_shifts,
+                                                  d_mean, d_cov, default_prob,
+                                                  pred_grad=pred_grad,
+                                                  pred_offset=pred_offset,
+                                                  factors=factors,
+                                                  n_threads=n_threads)
+        else:
+            log_prob_matrix = independent_log_prob(obs_shifts, pred_shifts,
+                                                   [atom_sd[atom] * sf for atom in atoms],
+                                                   default_prob,
+                                                   pred_grad=pred_grad,
+                                                   pred_offset=pred_offset,
+                                                   n_threads=n_threads)
+        log_prob_matrix = pd.DataFrame(log_prob_matrix, index=obs.index, columns=preds.index)
+        self.diagnostics.record("log_prob_matrix_raw", log_prob_matrix)
 
         # original_log_prob_matrix = log_prob_matrix.copy(deep=True)
 
         if self.pars["use_ss_class_info"]:
             log_prob_matrix = self._apply_ss_class_penalties(log_prob_matrix, obs, preds)
-            print('log probability after penalties\n', log_prob_matrix)
-        # Sort out NAs and dummy residues/spin systems
-        log_prob_matrix[log_prob_matrix.isna()] = 2 * np.nanmin(
-            log_prob_matrix.values)
-        log_prob_matrix.loc[obs["Dummy_SS"], :] = 0
-        log_prob_matrix.loc[:, preds["Dummy_res"]] = 0
+            self.diagnostics.record("log_prob_matrix_ss_class", log_prob_matrix)
+        # Sort out NAs and add back the dummy residues/spin systems
+        real_values = log_prob_matrix.to_numpy(dtype=float, copy=True)
+        na_mask = np.isnan(real_values)
+        if na_mask.any():
+            real_values[na_mask] = 2 * np.nanmin(real_values)
+        values = np.zeros((len(all_obs.index), len(all_preds.index)))
+        values[np.ix_(real_obs, real_preds)] = real_values
+        log_prob_matrix = pd.DataFrame(values, index=all_obs.index, columns=all_preds.index)
 
         log_prob_matrix.index.name = "Res_name"
         log_prob_matrix.columns.name = "SS_name"
@@ -721,64 +767,129 @@ class SNAPS_assigner:
         self.logger.info("Calculated log probability matrix (%dx%d)",
                          log_prob_matrix.shape[0], log_prob_matrix.shape[1])
 
+        if self.cache is not None:
+            self.cache.save("log_prob", cache_key, {"log_prob_matrix": log_prob_matrix})
+        return (self._set_log_prob_matrix(log_prob_matrix))
+
+    def _set_log_prob_matrix(self, log_prob_matrix):
+        """Store a new log probability matrix, whether calculated or cached"""
         self.log_prob_matrix = log_prob_matrix
-        print(log_prob_matrix.to_string())
+        # Any marginal probabilities were for the old matrix
+        self.marginal_prob_matrix = None
+        self.diagnostics.record("log_prob_matrix", log_prob_matrix, diagnostics_lib.SUMMARY)
         return (self.log_prob_matrix)
 
+    def _log_prob_cache_key(self, atoms, atom_sd, sf, default_prob):
+        """Hash everything that affects the log probability matrix"""
+        pars = {"atoms": set(atoms),
+                "atom_sd": {atom: atom_sd[atom] for atom in atoms},
+                "sf": sf,
+                "default_prob": default_prob}
+        # The model files are identified by the digests kept by the registry,
+        # so they're only read again if they've been modified
+        model_digests = []
+        for par in ["delta_correlation", "pred_correction", "use_ss_class_info"]:
+            pars[par] = self.pars.get(par, False)
+        if pars["pred_correction"]:
+            model_digests += registry.correction_digests(self.pars["pred_correction_file"])
+            if pars["delta_correlation"]:
+                model_digests += registry.correlation_digests(
+                    self.pars["delta_correlation_mean_corrected_file"],
+                    self.pars["delta_correlation_cov_corrected_file"])
+        elif pars["delta_correlation"]:
+            model_digests += registry.correlation_digests(self.pars["delta_correlation_mean_file"],
+                                                          self.pars["delta_correlation_cov_file"])
+
+        return hash_inputs(self.obs, self.preds, pars, model_digests)
+
     def calc_rdc_log_prob_matrix(self, dataframe: pd.DataFrame ):
 
         RDC_log_probability_matrix = magnitude_matrix_to_log_probability_matrix(dataframe)
-        print('rdc log probability matrix \n',RDC_log_probability_matrix )
+        self.diagnostics.record("rdc_log_prob_matrix", RDC_log_probability_matrix,
+                                diagnostics_lib.SUMMARY)
         return RDC_log_probability_matrix
 
     def combine_penalty_tables(self, rdc_dataframe: pd.DataFrame, snaps_dataframe: pd.DataFrame):
         penalty_table=add_penalty_tables(rdc_dataframe,snaps_dataframe)
-        print(penalty_table)
+        self.diagnostics.record("combined_penalty_table", penalty_table, diagnostics_lib.SUMMARY)
         return penalty_table
 
 
     @staticmethod
     def _apply_ss_class_penalties(log_prob_matrix, obs, preds):
+        """Penalise spin system/residue pairs where the residue type isn't
+        allowed by the SS_class (or SS_class_m1) information for the spin
+        system.
 
+        Returns
+        log_prob_matrix, with the penalties added
 
-        # For each type of residue type information that's available, make a
-        # matrix showing the probability modifications due to type mismatch,
-        # then add it to log_prob_matrix
+        Parameters
+        log_prob_matrix: DataFrame with rows matching obs and columns matching
+            preds
+        obs, preds: DataFrames of observed and predicted shifts
+        """
+        # For each type of residue type information that's available, encode
+        # the allowed types for each spin system and the type of each residue
+        # as amino acid bitmasks, then penalise pairs with no bits in common.
         # Maybe make SS_class mismatch a parameter in config file?
-        #print('inter', {"SS_class", "SS_class_m1"}.intersection(obs.columns))
         ss_class_to_res_type = {
             "SS_class": "Res_type",
             "SS_class_m1": "Res_type_m1"
         }
-        for ss_class in {"SS_class", "SS_class_m1"}.intersection(obs.columns):
-            active_res_ss_class = ss_class_to_res_type[ss_class]
-
-            SS_class_matrix = pd.DataFrame(0.0, index=log_prob_matrix.index,
-                                           columns=log_prob_matrix.columns)
-
-
-            # For each amino acid type in turn:
-            for res in preds[active_res_ss_class].dropna().unique():
-                # Work out which observations could be that aa type
-
-                if res == 'X':
-                    continue
-
-                allowed = obs[ss_class].str.contains(res).fillna(True)
-
-                # Select the predictions which are that aa type
-                pred_list = preds.loc[preds[active_res_ss_class] == res, "Res_name"]
-
-                # For the selected predictions, penalise any observations
-                # where the current aa type is not allowed
-                for p in pred_list:
-                    SS_class_matrix.loc[:, p] = (~allowed) * -100  # log10(0.01)
-
-
-            log_prob_matrix = log_prob_matrix + SS_class_matrix
+        values = log_prob_matrix.to_numpy(dtype=float, copy=True)
+        for ss_class in ["SS_class", "SS_class_m1"]:
+            if ss_class not in obs.columns:
+                continue
+            mismatch = aa_type_mismatch(aa_class_masks(obs[ss_class].tolist()),
+                                        residue_type_masks(preds[ss_class_to_res_type[ss_class]]))
+            values[mismatch] += -100  # log10(0.01)
+
+        return pd.DataFrame(values, index=log_prob_matrix.index,
+                            columns=log_prob_matrix.columns)
+
+    def calc_marginal_prob_matrix(self, temperature=1, tol=1e-3):
+        """Estimate the probability of each spin system being assigned to
+        each residue, over all possible assignments
+
+        This uses Sinkhorn iterations on the log probability matrix (see
+        lib.sinkhorn_lib), which cost a few matrix-vector products each,
+        rather than re-solving the assignment problem. Dummy spin systems and
+        residues score 0 with everything, as in find_best_assignment(), so
+        the probability of a spin system being paired with any dummy residue
+        is the probability that it's not in the sequence.
+
+        Once calculated, make_assign_df() adds a Marginal_prob column with
+        the probability of each assigned pair.
 
+        Returns
+        A DataFrame with the same labels as log_prob_matrix, whose rows and
+        columns sum to 1
 
-        return log_prob_matrix
+        Parameters
+        temperature: scale for the log probabilities. Higher values give
+            flatter probabilities.
+        tol: convergence tolerance for the Sinkhorn iterations
+        """
+        log_prob_matrix = self.log_prob_matrix
+        log_prob = log_prob_matrix.to_numpy(dtype=float).copy()
+        labels = self._label_registry()
+        dummy_rows, dummy_cols = labels.dummy_ss, labels.dummy_res
+        log_prob[dummy_rows, :] = 0
+        log_prob[:, dummy_cols] = 0
+
+        marginals, converged = sinkhorn_marginals(log_prob, temperature, tol,
+                                                  n_threads=self.pars.get("n_threads", 1))
+        if not converged:
+            self.logger.warning("Marginal probabilities may be inaccurate, as the "
+                                "Sinkhorn iterations did not converge")
+
+        marginal_prob_matrix = pd.DataFrame(marginals, index=log_prob_matrix.index,
+                                            columns=log_prob_matrix.columns)
+        self.marginal_prob_matrix = marginal_prob_matrix
+        self.diagnostics.record("marginal_prob_matrix", marginal_prob_matrix,
+                                diagnostics_lib.SUMMARY)
+        return (self.marginal_prob_matrix)
 
     def calc_mismatch_matrix(self, threshold=0.2):
         """Calculate matrix of the mismatch between i and i-1 observed carbon
@@ -790,6 +901,16 @@ class SNAPS_assigner:
         """
         obs = self.obs.copy()
 
+        if self.cache is not None:
+            cache_key = hash_inputs(obs, threshold)
+            cached = self.cache.load("mismatch", cache_key)
+            if cached is not None:
+                self.mismatch_matrix = cached["mismatch_matrix"]
+                self.consistent_links_matrix = cached["consistent_links_matrix"]
+                self.logger.info("Using cached mismatch and consistent_links matrixes (%dx%d)",
+                                 self.mismatch_matrix.shape[0], self.mismatch_matrix.shape[1])
+                return (self.mismatch_matrix, self.consistent_links_matrix)
+
         # First check if there are any sequential atoms
         carbons = pd.Series(["C", "CA", "CB"])
         carbons_m1 = carbons + "_m1"
@@ -842,14 +963,67 @@ class SNAPS_assigner:
 
             self.mismatch_matrix = mismatch_matrix
             self.consistent_links_matrix = consistent_links_matrix
+            if self.cache is not None:
+                self.cache.save("mismatch", cache_key,
+                                {"mismatch_matrix": mismatch_matrix,
+                                 "consistent_links_matrix": consistent_links_matrix})
             return (self.mismatch_matrix, consistent_links_matrix)
 
+    def calc_link_index(self, threshold=0.2):
+        """Find the consistent sequential links between spin systems, and store
+        them in a sparse lib.link_lib.LinkIndex
+
+        This gives the same mismatches and numbers of consistent links as
+        calc_mismatch_matrix(), but only keeps the pairs with a mismatch of at
+        most threshold, and doesn't need the dense matrixes.
+
+        Returns
+        The LinkIndex, which is also kept in self.link_index. Its rows and
+        columns are the spin systems, in the order of self.obs.
+
+        Parameters
+        threshold: the largest mismatch for a link to be kept, and the cutoff
+            for a consistent shift
+        """
+        carbons = pd.Series(["C", "CA", "CB"])
+        seq_atoms = carbons[carbons.isin(self.obs.columns) &
+                            (carbons + "_m1").isin(self.obs.columns)]
+        if seq_atoms.size == 0:
+            self.logger.warning("No sequential links in data - link index not calculated.")
+            return (None)
+
+        self.link_index = LinkIndex(self.obs[seq_atoms].to_numpy(dtype=float),
+                                    self.obs[seq_atoms + "_m1"].to_numpy(dtype=float),
+                                    threshold)
+        self.logger.info("Found %d consistent sequential links between %d spin systems",
+                         self.link_index.nnz, self.link_index.n)
+        return (self.link_index)
+
+    def _link_index(self, threshold=0.2):
+        """self.link_index, calculated first if it's missing, out of date, or
+        doesn't include links up to threshold"""
+        link_index = self.link_index
+        if (link_index is None or link_index.n != len(self.obs.index)
+                or link_index.window < threshold):
+            link_index = self.calc_link_index(max(threshold, 0.2))
+        return (link_index)
+
     def find_best_assignment(self, score_matrix, maximise=True, inc=None, exc=None,
-                             dummy_rows=None, dummy_cols=None, return_none_all_dummy=False):
+                             dummy_rows=None, dummy_cols=None, return_none_all_dummy=False,
+                             row_name="SS_name", col_name="Res_name", overlay=None):
         """ Use the Hungarian algorithm to find the highest scoring assignment,
         with constraints. Generalised so it can be used for assigning either
         sequentially or based on predictions.
 
+        Dummy rows and columns are not passed to the solver. Instead, the
+        problem is solved on the real rows and columns, and any that are left
+        unassigned are then paired up with the dummies. Each dummy is assumed
+        to score 0 with any real row or column.
+
+        The constraints are applied through a lib.lap_lib.ConstraintOverlay,
+        so score_matrix is never copied: only the scores of the free real rows
+        and columns are read out for the solver.
+
         Returns a data frame with the index and column names of the matching.
 
         Parameters
@@ -858,20 +1032,39 @@ class SNAPS_assigner:
         inc: a DataFrame of (row, col) pairs which must be part of the assignment.
             First column has the index names, second has the column names.
         exc: a DataFrame of (row, col) pairs which may not be part of the assignment.
+        dummy_rows, dummy_cols: labels of the dummy rows and columns. By
+            default, these are the dummy spin systems and residues in
+            self.obs and self.preds.
+        return_none_all_dummy: if True, return None if the unconstrained part
+            of the problem contains only dummy rows or only dummy columns
+        row_name, col_name: column names to use for the row and column labels
+            in inc, exc and the returned matching
+        overlay: optionally, a ConstraintOverlay over the values of
+            score_matrix, with further fixed or forbidden pairs and penalties.
+            It isn't modified.
         """
-        score_matrix = score_matrix.copy()
-
-        row_name = score_matrix.index.name
-        col_name = score_matrix.columns.name
+        if dummy_rows is None:
+            dummy_rows = self._dummy_labels("obs", "Dummy_SS")
+        if dummy_cols is None:
+            dummy_cols = self._dummy_labels("preds", "Dummy_res")
+        dummy_rows = set(dummy_rows)
+        dummy_cols = set(dummy_cols)
 
         self.logger.info("Started linear assignment")
 
+        row_pos = pd.Series(np.arange(len(score_matrix.index)), index=score_matrix.index)
+        col_pos = pd.Series(np.arange(len(score_matrix.columns)), index=score_matrix.columns)
+        if overlay is None:
+            overlay = ConstraintOverlay(score_matrix.to_numpy(dtype=float))
+        elif inc is not None or exc is not None:
+            overlay = overlay.copy()
+        overlay_fixed_rows, overlay_fixed_cols = overlay.fixed_pairs()
+
         if inc is not None:
             # Check for conflicting entries in inc
             conflicts = inc[row_name].duplicated(keep=False) | inc[col_name].duplicated(keep=False)
             if any(conflicts):
                 self.logger.warning("Warning: entries in inc conflict with one another - dropping conflicts")
-                # print(inc[conflicts])
                 inc = inc[~conflicts]
 
             if exc is not None:
@@ -880,64 +1073,105 @@ class SNAPS_assigner:
                 exc_in_inc = exc[row_name].isin(inc[row_name]) | exc[col_name].isin(inc[col_name])
                 if any(exc_in_inc):
                     self.logger.warning("Some values in exc are also found in inc, so are redundant.")
-                    # print(exc[exc_in_inc])
                     exc = exc.loc[~exc_in_inc, :]
 
-            # Removed fixed assignments from probability matrix and obs, preds
-            # dataframes. Latter is needed if inc includes any dummy SS/res,
-            # and to detect if the reduced data is entirely dummies
-            score_matrix_reduced = score_matrix.drop(index=inc[row_name]).drop(columns=inc[col_name])
+            # Take the fixed assignments out of the problem
+            overlay.fix(row_pos[inc[row_name]].to_numpy(), col_pos[inc[col_name]].to_numpy())
             self.logger.info("%d assignments were fixed, %d remain to be assigned"
-                             % (len(inc), len(score_matrix_reduced.index)))
-        else:
-            score_matrix_reduced = score_matrix
+                             % (len(inc), len(overlay.free_rows())))
 
-        # If the matrix consists entirely of dummy rows or columns, the
+        if exc is not None:
+            # Forbid excluded (row, col) pairs. If one side of a pair is a
+            # dummy, this excludes *all* dummies for the other side (see below)
+            exc_rows = exc[row_name].map(row_pos)
+            exc_cols = exc[col_name].map(col_pos)
+            known = exc_rows.notna() & exc_cols.notna()
+            overlay.forbid(exc_rows[known].to_numpy(dtype=int), exc_cols[known].to_numpy(dtype=int))
+
+        free_rows = overlay.free_rows()
+        free_cols = overlay.free_cols()
+        is_dummy_row = score_matrix.index.isin(dummy_rows)
+        is_dummy_col = score_matrix.columns.isin(dummy_cols)
+
+        # If the free part consists entirely of dummy rows or columns, the
         # assignment will not be meaningful. In this case, may want to return None
         if return_none_all_dummy:
-            if (set(score_matrix_reduced.index).issubset(dummy_rows) or
-                    set(score_matrix_reduced.columns).issubset(dummy_cols)):
+            if is_dummy_row[free_rows].all() or is_dummy_col[free_cols].all():
                 self.logger.debug("Score matrix includes only dummy rows/columns")
                 return (None)
 
-        if exc is not None:
-            # Penalise excluded (row, col) pairs
-            if maximise:
-                penalty = -2 * score_matrix.abs().max().max()
-            else:
-                penalty = 2 * score_matrix.abs().max().max()
-
-            for i, r in exc.iterrows():  # iterates over (index, row as pd.Series) tuples
-                # If one side of an exclude pair is a dummy row or column,
-                # exclude *all* dummy rows and columns
-                if r[row_name] in dummy_rows:
-                    score_matrix_reduced.loc[r[row_name],
-                                             dummy_cols] = penalty
-                elif r[col_name] in dummy_cols:
-                    score_matrix_reduced.loc[dummy_rows,
-                                             r[col_name]] = penalty
-                else:
-                    score_matrix_reduced.loc[r["SS_name"], r["Res_name"]] = penalty
-
-            self.logger.info("Penalised %d excluded row,column pairs" % len(exc.index))
-
+        # Split the free problem into the real rows/columns, which go to
+        # the solver, and the dummies
+        real_rows = free_rows[~is_dummy_row[free_rows]]
+        real_cols = free_cols[~is_dummy_col[free_cols]]
+        costs = overlay.scores(real_rows, real_cols)
         if maximise:
-            row_ind, col_ind = linear_sum_assignment(-1 * score_matrix_reduced)
-            # -1 because linear_sum_assignment() minimises sum, but we want to
-            # maximise it.
-        else:
-            row_ind, col_ind = linear_sum_assignment(score_matrix_reduced)
+            # -1 because the solver minimises the sum, but we want to maximise it.
+            np.negative(costs, out=costs)
+        row_dummy_cost = np.zeros(len(real_rows))
+        col_dummy_cost = np.zeros(len(real_cols))
+
+        forbidden = overlay.forbidden_block(real_rows, real_cols)
+        if forbidden is not None:
+            # Penalise forbidden (row, col) pairs, and leaving a row or column
+            # unassigned if it's forbidden from pairing with any dummy
+            penalty = 2 * overlay.max_abs_score()
+            costs[forbidden] = penalty
+            col_dummy_cost[overlay.forbidden_block(np.flatnonzero(is_dummy_row),
+                                                   real_cols).any(axis=0)] = penalty
+            row_dummy_cost[overlay.forbidden_block(real_rows,
+                                                   np.flatnonzero(is_dummy_col)).any(axis=1)] = penalty
+            if exc is not None:
+                self.logger.info("Penalised %d excluded row,column pairs" % len(exc.index))
+
+        row_ind, col_ind = solve_with_dummies(costs, is_dummy_row[free_rows].sum(),
+                                              is_dummy_col[free_cols].sum(),
+                                              row_dummy_cost, col_dummy_cost)
+
+        # Pair any unassigned real rows/columns with the dummies
+        real_row_labels = score_matrix.index[real_rows]
+        real_col_labels = score_matrix.columns[real_cols]
+        unassigned_rows = np.setdiff1d(np.arange(len(real_rows)), row_ind)
+        unassigned_cols = np.setdiff1d(np.arange(len(real_cols)), col_ind)
+        spare_dummy_rows = list(score_matrix.index[free_rows[is_dummy_row[free_rows]]])
+        spare_dummy_cols = list(score_matrix.columns[free_cols[is_dummy_col[free_cols]]])
+        rows = list(real_row_labels[row_ind]) + list(real_row_labels[unassigned_rows])
+        cols = list(real_col_labels[col_ind]) + spare_dummy_cols[:len(unassigned_rows)]
+        rows += spare_dummy_rows[:len(unassigned_cols)]
+        cols += list(real_col_labels[unassigned_cols])
+        rows += spare_dummy_rows[len(unassigned_cols):]
+        cols += spare_dummy_cols[len(unassigned_rows):]
 
         # Construct results dataframe
-        matching_reduced = pd.DataFrame({row_name: score_matrix_reduced.index[row_ind],
-                                         col_name: score_matrix_reduced.columns[col_ind]})
-
-        if inc is not None:
-            matching = pd.concat([inc, matching_reduced])
+        matching_reduced = pd.DataFrame({row_name: rows, col_name: cols})
+
+        fixed = [] if inc is None else [inc]
+        if len(overlay_fixed_rows):
+            fixed.append(pd.DataFrame({row_name: score_matrix.index[overlay_fixed_rows],
+                                       col_name: score_matrix.columns[overlay_fixed_cols]}))
+        if fixed:
+            matching = pd.concat(fixed + [matching_reduced])
             return (matching)
         else:
             return (matching_reduced)
 
+    def _dummy_labels(self, df_name, dummy_col):
+        """Get the index labels of dummy rows in self.obs or self.preds"""
+        df = getattr(self, df_name)
+        if df is None or dummy_col not in df.columns:
+            return []
+        return df.index[df[dummy_col].fillna(False).astype(bool)]
+
+    def _label_registry(self):
+        """The LabelRegistry giving the ids of the rows and columns of
+        log_prob_matrix, remade if obs or preds have changed since
+        prepare_obs_preds()"""
+        if self.labels is None or not self.labels.matches(self.log_prob_matrix):
+            self.labels = LabelRegistry.from_obs_preds(self.obs, self.preds)
+            if not self.labels.matches(self.log_prob_matrix):
+                raise ValueError("The labels of log_prob_matrix don't match obs and preds")
+        return self.labels
+
     def make_assign_df(self, matching, set_assign_df=False):
         """Make a dataframe with full assignment information, given a dataframe
         of SS_name and Res_name.
@@ -948,7 +1182,7 @@ class SNAPS_assigner:
         obs.index.name = "name"  # Needed to avoid error when merging dataframes.
         # print(obs,'obs')
         preds = self.preds.copy()
-        log_prob_matrix = self.log_prob_matrix.copy()
+        labels = self._label_registry()
         #print (preds, ' preds')
         valid_atoms = list(self.pars["atom_set"])
         extra_cols = set(matching.columns).difference({"SS_name", "Res_name"})
@@ -974,12 +1208,12 @@ class SNAPS_assigner:
                                  valid_atoms + ["Res_name"])],
                              on="Res_name", suffixes=("", "_pred"), how="left")
 
-        # Careful above not to get rows/columns confused
-        series = df_lookup(log_prob_matrix,
-                                          assign_df["SS_name"],
-                                          assign_df["Res_name"])
-
-        assign_df["Log_prob"] = assign_df["SS_name"].map(series)
+        # Look up the pairs by id. This is by position, as a spin system can
+        # appear more than once (eg. in alternative assignments)
+        ss_ids, res_ids = labels.matching_ids(assign_df)
+        assign_df["Log_prob"] = self.log_prob_matrix.to_numpy()[ss_ids, res_ids]
+        if self.marginal_prob_matrix is not None:
+            assign_df["Marginal_prob"] = self.marginal_prob_matrix.to_numpy()[ss_ids, res_ids]
         assign_df = assign_df.sort_values(by="Res_N")
 
         if set_assign_df:
@@ -1004,8 +1238,8 @@ class SNAPS_assigner:
         "Calculate the sum log probability of a particular matching"
         # return(sum(self.log_prob_matrix.lookup(matching["SS_name"],
         #                                            matching["Res_name"])))
-        return (sum(df_lookup(self.log_prob_matrix, matching["SS_name"],
-                              matching["Res_name"])))
+        ss_ids, res_ids = self._label_registry().matching_ids(matching)
+        return (sum(self.log_prob_matrix.to_numpy()[ss_ids, res_ids].tolist()))
 
     def sequential_atoms_present(self, atom_list):
         """Returns true if a pair of atoms in atom_list are sequential, otherwise False
@@ -1018,6 +1252,32 @@ class SNAPS_assigner:
 
         return (seq_atoms.any())
 
+    def _matching_neighbours(self, matching):
+        """Find the spin systems assigned to each residue and its neighbours
+
+        Returns
+        A tuple (tmp, ss, ss_m1, ss_p1). tmp is a DataFrame with SS_name,
+        Res_name, Res_name_m1 and Res_name_p1 columns for every residue in
+        matching or self.preds, and the others are arrays with the positions
+        in self.obs of the spin systems assigned to each residue and to the
+        residues before and after it (or -1 if there isn't one)
+
+        Parameters
+        matching: a DataFrame with Res_name and SS_name columns, indexed by
+            Res_name
+        """
+        tmp = pd.concat([matching[["SS_name", "Res_name"]],
+                         self.preds[["Res_name_m1", "Res_name_p1"]]], axis=1)
+
+        ss = self.obs.index.get_indexer(tmp["SS_name"])
+        matching_ss = self.obs.index.get_indexer(matching["SS_name"])
+
+        def neighbour_ss(col):
+            pos = matching.index.get_indexer(tmp[col])
+            return np.where(pos >= 0, matching_ss[pos], -1)
+
+        return tmp, ss, neighbour_ss("Res_name_m1"), neighbour_ss("Res_name_p1")
+
     def check_matching_consistency(self, matching, threshold=0.2):
         """Calculate mismatch scores and assignment confidence for a given matching
 
@@ -1029,65 +1289,39 @@ class SNAPS_assigner:
         matching: a DataFrame with Res_name and SS_name columns
         threshold: the maximum allowed mismatch for a good sequential link
         """
-        # Create mismatch matrix if it doesn't already exist
-        if self.mismatch_matrix is None:
-            self.calc_mismatch_matrix()
+        link_index = self._link_index(threshold)
 
         # Add Res_name_m1 and Res_name_p1 columns to matching DataFrame
         matching.index = matching["Res_name"]
         matching.index.name = None
 
-        tmp = pd.concat([matching, self.preds[["Res_name_m1", "Res_name_p1"]]], axis=1)
-
-        # Add a SS_name_m1 and SS_name_p1 columns
-        tmp = tmp.merge(matching[["SS_name"]], how="left", left_on="Res_name_m1",
-                        right_index=True, suffixes=("", "_m1"))
-        tmp = tmp.merge(matching[["SS_name"]], how="left", left_on="Res_name_p1",
-                        right_index=True, suffixes=("", "_p1"))
-
-        # Filter out rows with NaN's in SS_name_m1/p1
-        tmp_m1 = tmp.dropna(subset=["SS_name_m1"])
-        tmp_p1 = tmp.dropna(subset=["SS_name_p1"])
-
-        # Get the mismatches
-        tmp["Max_mismatch_m1"] = pd.Series(list(df_lookup(self.mismatch_matrix,
-                                                          tmp_m1["SS_name_m1"], tmp_m1["SS_name"])), index=tmp_m1.index)
-        tmp["Max_mismatch_p1"] = pd.Series(list(df_lookup(self.mismatch_matrix,
-                                                          tmp_p1["SS_name"], tmp_p1["SS_name_p1"])), index=tmp_p1.index)
-        tmp["Max_mismatch"] = tmp[["Max_mismatch_m1", "Max_mismatch_p1"]].max(axis=1)
-
-        tmp["Num_good_links_m1"] = pd.Series(list(df_lookup(self.consistent_links_matrix,
-                                                            tmp_m1["SS_name_m1"], tmp_m1["SS_name"])),
-                                             index=tmp_m1.index)
-        tmp["Num_good_links_p1"] = pd.Series(list(df_lookup(self.consistent_links_matrix,
-                                                            tmp_p1["SS_name"], tmp_p1["SS_name_p1"])),
-                                             index=tmp_p1.index)
-        tmp["Num_good_links_m1"].fillna(0, inplace=True)
-        tmp["Num_good_links_p1"].fillna(0, inplace=True)
-        tmp["Num_good_links"] = tmp["Num_good_links_m1"] + tmp["Num_good_links_p1"]
-
-        # Add an assignment confidence column
-        tmp["Conf_m1"] = "N"
-        tmp.loc[tmp["Num_good_links_m1"] > 0, "Conf_m1"] = "W"
-        tmp.loc[tmp["Num_good_links_m1"] > 1, "Conf_m1"] = "S"
-        tmp.loc[tmp["Max_mismatch_m1"] > threshold, "Conf_m1"] = "X"
-
-        tmp["Conf_p1"] = "N"
-        tmp.loc[tmp["Num_good_links_p1"] > 0, "Conf_p1"] = "W"
-        tmp.loc[tmp["Num_good_links_p1"] > 1, "Conf_p1"] = "S"
-        tmp.loc[tmp["Max_mismatch_p1"] > threshold, "Conf_p1"] = "X"
-
-        tmp["Conf2"] = tmp["Conf_m1"] + tmp["Conf_p1"]
-        # Reorder letters eg WS -> SW
-        tmp["Conf2"] = tmp["Conf2"].replace(["WS", "NS", "XS", "NW", "XW", "XN"],
-                                            ["SW", "SN", "SX", "WN", "WX", "NX"])
-
-        tmp["Confidence"] = tmp["Conf2"]
-        tmp["Confidence"] = tmp["Confidence"].replace(["SS", "SW", "SN", "WW"], "High")
-        tmp["Confidence"] = tmp["Confidence"].replace(["SX", "WN"], "Medium")
-        tmp["Confidence"] = tmp["Confidence"].replace("WX", "Low")
-        tmp["Confidence"] = tmp["Confidence"].replace(["NX", "XX"], "Unreliable")
-        tmp["Confidence"] = tmp["Confidence"].replace("NN", "Undefined")
+        tmp, ss, ss_m1, ss_p1 = self._matching_neighbours(matching)
+
+        # Get the mismatches and number of good links, and the confidence
+        # code for each side (see CONFIDENCE_TABLE)
+        def links(first, second):
+            has_link = (first >= 0) & (second >= 0)
+            mismatch = np.full(len(tmp.index), np.nan)
+            n_links = np.zeros(len(tmp.index))
+            mismatch[has_link], n_links[has_link] = link_index.pair_stats(
+                first[has_link], second[has_link], threshold)
+            code = np.minimum(n_links, 2).astype(int)
+            code[mismatch > threshold] = 3
+            return mismatch, n_links, code
+
+        mismatch_m1, links_m1, conf_m1 = links(ss_m1, ss)
+        mismatch_p1, links_p1, conf_p1 = links(ss, ss_p1)
+
+        tmp = pd.DataFrame({"SS_name": tmp["SS_name"],
+                            "Res_name": tmp["Res_name"],
+                            "Max_mismatch_m1": mismatch_m1,
+                            "Max_mismatch_p1": mismatch_p1,
+                            "Max_mismatch": np.fmax(mismatch_m1, mismatch_p1),
+                            "Num_good_links_m1": links_m1,
+                            "Num_good_links_p1": links_p1,
+                            "Num_good_links": links_m1 + links_p1,
+                            "Confidence": CONFIDENCE_TABLE[conf_m1, conf_p1]},
+                           index=tmp.index)
 
         # Summarise confidence of results
         summary_str = ", ".join(
@@ -1095,8 +1329,7 @@ class SNAPS_assigner:
              tmp["Confidence"].value_counts().sort_values(ascending=False).items()])
         self.logger.info("Calculated assignment confidence: " + summary_str)
 
-        return (tmp.loc[:, ["SS_name", "Res_name", "Max_mismatch_m1", "Max_mismatch_p1", "Max_mismatch",
-                            "Num_good_links_m1", "Num_good_links_p1", "Num_good_links", "Confidence"]])
+        return (tmp)
 
     def add_consistency_info(self, input_assign_df=None, threshold=0.2):
         """ Find maximum mismatch and number of 'significant' mismatches for
@@ -1136,14 +1369,71 @@ class SNAPS_assigner:
 
         return (assign_df)
 
+    def sweep_link_thresholds(self, thresholds, matching=None):
+        """Summarise the assignment confidence at several link thresholds
+
+        This gives the same confidence levels as running calc_link_index()
+        and check_matching_consistency() with each threshold in turn, but
+        the shift differences for the links of the assignment are only
+        calculated and sorted once (see lib.link_lib.threshold_sweep()). It
+        can be used to choose seq_link_threshold for a dataset.
+
+        Returns
+        A DataFrame indexed by Threshold, in increasing order, with the
+        number of residues at each confidence level, the total number of
+        consistent shifts over all the sequential links (Good_links), and the
+        number of links with a mismatch above the threshold
+        (Mismatched_links)
+
+        Parameters
+        thresholds: a sequence of link thresholds
+        matching: a DataFrame with SS_name and Res_name columns (default
+            self.assign_df)
+        """
+        if matching is None:
+            matching = self.assign_df
+        matching = matching[["SS_name", "Res_name"]].copy()
+        matching.index = matching["Res_name"]
+        matching.index.name = None
+        thresholds = np.unique(np.asarray(thresholds, dtype=float))
+        link_index = self._link_index()
+
+        tmp, ss, ss_m1, ss_p1 = self._matching_neighbours(matching)
+        has_link = (ss >= 0) & (ss_p1 >= 0)
+        n_links, mismatched = threshold_sweep(
+            link_index.pair_differences(ss[has_link], ss_p1[has_link]), thresholds)
+
+        # Confidence codes (see CONFIDENCE_TABLE) for the links to the i+1
+        # residue, and the same for the i-1 residue by looking up the link
+        # from it
+        code_p1 = np.zeros((len(tmp.index), len(thresholds)), dtype=int)
+        code_p1[has_link] = np.where(mismatched, 3, np.minimum(n_links, 2))
+        link_pos = pd.Series(np.flatnonzero(has_link), index=tmp.index[has_link])
+        prev_pos = link_pos.reindex(tmp["Res_name_m1"]).to_numpy()
+        has_prev = ~np.isnan(prev_pos) & (ss_m1 >= 0) & (ss >= 0)
+        code_m1 = np.zeros_like(code_p1)
+        code_m1[has_prev] = code_p1[prev_pos[has_prev].astype(int)]
+
+        confidence = CONFIDENCE_TABLE[code_m1, code_p1]
+        levels = ["High", "Medium", "Low", "Unreliable", "Undefined"]
+        summary = pd.DataFrame({level: (confidence == level).sum(axis=0) for level in levels},
+                               index=pd.Index(thresholds, name="Threshold"))
+        summary["Good_links"] = n_links.sum(axis=0)
+        summary["Mismatched_links"] = mismatched.sum(axis=0)
+        return (summary)
+
     def find_alt_assignments(self, N=1, by_ss=True, verbose=False):
         """ Find the next-best assignment(s) for each residue or spin system
 
-        This works by setting the log probability to a very high value for each
-        residue in turn, and rerunning the assignment
+        This works by excluding the best match for each spin system (or
+        residue) in turn, and finding the best assignment without it. The
+        results are the same as calling find_best_assignment() with the
+        excluded pairs, but the unconstrained assignment and its dual
+        potentials are only found once. Each exclusion then just needs one
+        augmenting path search to repair the assignment (see
+        lap_lib.DualAssignment).
 
         Arguments:
-        best_match_indexes: [row_ind, col_ind] output from find_best_assignment()
         N: number of alternative assignments to generate
         by_ss: if true, calculate next best assignment for each spin system.
             Otherwise, calculate it for each residue.
@@ -1157,58 +1447,54 @@ class SNAPS_assigner:
         best_matching = self.assign_df.loc[:, ["SS_name", "Res_name"]]
         best_matching.index = best_matching["SS_name"]
         best_matching.index.name = None
-        alt_matching = None
 
         # Calculate sum probability for the best matching
         best_sum_prob = self.calc_overall_matching_prob(best_matching)
 
-        # Calculate the value used to penalise the best match for each residue
-        penalty = 2 * log_prob_matrix.min().min()
+        # Set up the problem as find_best_assignment() does: dummies score 0
+        # with everything, and excluded pairs get a large penalty cost
+        log_prob = log_prob_matrix.to_numpy(dtype=float)
+        labels = self._label_registry()
+        dummy_rows, dummy_cols = labels.dummy_ss, labels.dummy_res
+        costs = -log_prob
+        costs[dummy_rows, :] = 0
+        costs[:, dummy_cols] = 0
+        penalty = 2 * np.abs(log_prob).max()
         logging.debug("Penalty value: %f", penalty)
+        best_solution = DualAssignment(costs)
 
-        # Initialise DataFrame for storing alt_assignments
-        alt_matching_all = best_matching.copy()
-        alt_matching_all["Rank"] = 1
-        alt_matching_all["Rel_prob"] = 0
-
-        for i in best_matching.index:  # Consider each spin system in turn
-            ss = best_matching.loc[i, "SS_name"]
-            res = best_matching.loc[i, "Res_name"]
-            logging.debug("Finding alt assignments for original match %s - %s", ss, res)
-            if verbose: print(ss, res)
-
-            excluded = best_matching.loc[[i], :]
+        alt_matches = []
+        # Consider each spin system in turn
+        for ss, res in zip(*labels.matching_ids(best_matching)):
+            logging.debug("Finding alt assignments for original match %s - %s",
+                          labels.ss_names[ss], labels.res_names[res])
+            if verbose: print(labels.ss_names[ss], labels.res_names[res])
 
+            solution = best_solution.copy()
             for j in range(N):
-                alt_matching = self.find_best_assignments(exc=excluded)
-
-                alt_matching["Rank"] = j + 2
-                alt_sum_prob = self.calc_overall_matching_prob(alt_matching)
-                alt_matching["Rel_prob"] = alt_sum_prob - best_sum_prob
-
-                # Add the alt match for this ss or res to the results dataframe
-                # and also the excluded dataframe.
+                # Exclude the current match, and find the best assignment
+                # without it (and without any matches excluded previously)
+                self._exclude_pair(solution, ss, res, dummy_rows, dummy_cols, penalty)
+                rows, cols = matching_with_dummies(solution.row_to_col, dummy_rows, dummy_cols)
+                # Summed as calc_overall_matching_prob() does, for identical results
+                alt_sum_prob = sum(log_prob[rows, cols].tolist())
+
+                # Find the new match for this ss or res
                 if by_ss:
-                    # alt_matching_all = alt_matching_all.append(
-                    #         alt_matching.loc[alt_matching["SS_name"]==ss, :],
-                    #         ignore_index=True)
-                    alt_matching_all = pd.concat([alt_matching_all, alt_matching.loc[alt_matching["SS_name"] == ss, :]],
-                                                 ignore_index=True)
-                    res = alt_matching.loc[alt_matching["SS_name"] == ss,
-                                           "Res_name"].tolist()[0]
-                    # The .tolist()[0] is to convert a single-item series into a string.
+                    res = cols[rows == ss][0]
                 else:
-                    # alt_matching_all = alt_matching_all.append(
-                    #         alt_matching.loc[alt_matching["Res_name"]==res, :],
-                    #         ignore_index=True)
-                    alt_matching_all = pd.concat(
-                        [alt_matching_all, alt_matching.loc[alt_matching["Res_name"] == res, :]], ignore_index=True)
-
-                    ss = alt_matching.loc[alt_matching["Res_name"] == res,
-                                          "SS_name"].tolist()[0]
-                # excluded = excluded.append(pd.DataFrame({"SS_name":[ss],"Res_name":[res]}),
-                #                            ignore_index=True)
-                excluded = pd.concat([excluded, pd.DataFrame({"SS_name": [ss], "Res_name": [res]})], ignore_index=True)
+                    ss = rows[cols == res][0]
+                alt_matches.append({"SS_name": labels.ss_names[ss],
+                                    "Res_name": labels.res_names[res], "Rank": j + 2,
+                                    "Rel_prob": alt_sum_prob - best_sum_prob})
+
+        # Initialise DataFrame for storing alt_assignments
+        alt_matching_all = best_matching.copy()
+        alt_matching_all["Rank"] = 1
+        alt_matching_all["Rel_prob"] = 0
+        if alt_matches:
+            alt_matching_all = pd.concat([alt_matching_all, pd.DataFrame(alt_matches)],
+                                         ignore_index=True)
 
         self.alt_assign_df = self.make_assign_df(alt_matching_all)
         if by_ss:
@@ -1220,11 +1506,53 @@ class SNAPS_assigner:
 
         return (self.alt_assign_df)
 
-    def find_kbest_assignments(self, k, init_inc=None, init_exc=None, verbose=False):
+    @staticmethod
+    def _exclude_pair(solution, row, col, dummy_rows, dummy_cols, penalty):
+        """Penalise a (row, col) pair in a DualAssignment, as
+        find_best_assignment() does for pairs in exc. If one side of the pair
+        is a dummy, *all* dummies are excluded for the other side."""
+        if dummy_rows[row] and not dummy_cols[col]:
+            solution.set_costs(np.flatnonzero(dummy_rows), [col], penalty)
+        elif dummy_cols[col] and not dummy_rows[row]:
+            solution.set_costs([row], np.flatnonzero(dummy_cols), penalty)
+        elif not dummy_rows[row] and not dummy_cols[col]:
+            solution.set_costs([row], [col], penalty)
+
+    def start_session(self, inc=None, exc=None):
+        """Start an interactive session for fixing and forbidding pairs
+
+        This gives the same assignments as calling find_best_assignment()
+        with inc and exc, but each change to the constraints only needs the
+        assignment to be repaired, rather than re-solved.
+
+        Returns
+        An AssignmentSession, which is also kept in self.session
+
+        Parameters
+        inc, exc: optional DataFrames of (SS_name, Res_name) pairs to start
+            with as fixed and forbidden
+        """
+        self.session = AssignmentSession(self)
+        # Forbid first, so a pair in both inc and exc ends up fixed
+        if exc is not None:
+            for ss, res in zip(exc["SS_name"], exc["Res_name"]):
+                self.session.forbid(ss, res)
+        if inc is not None:
+            for ss, res in zip(inc["SS_name"], inc["Res_name"]):
+                self.session.fix(ss, res)
+        return (self.session)
+
+    def find_kbest_assignments(self, k, init_inc=None, init_exc=None, verbose=False, n_jobs=1):
         """ Find the k best overall assignments using the Murty algorithm.
 
         k: the number of assignments to find
+        init_inc, init_exc: optional DataFrames of (SS_name, Res_name) pairs
+            which must be included in, or excluded from, every assignment.
+            As in find_best_assignment(), a pair with a dummy on one side
+            means the other side must (or must not) be paired with a dummy.
         verbose: print information about progress
+        n_jobs: number of worker processes used to solve the child nodes. The
+            ranked assignments are the same for any number of workers.
 
         This algorithm works by defining nodes. A node is a particular set of
         constraints on the assignment, consisting of pairs that muct be included,
@@ -1239,81 +1567,240 @@ class SNAPS_assigner:
         For more details, see:
         Murty, K. (1968). An Algorithm for Ranking all the Assignments in
         Order of Increasing Cost. Operations Research, 16(3), 682-687
+
+        The search itself works on index arrays (see lib.murty_lib). Assignments
+        which only differ in which dummy a spin system or residue is paired
+        with count as the same assignment.
+
+        Returns
+        A tuple (ranked_nodes, unranked_nodes). Each is a SortedListWithKey of
+        Node(sum_log_prob, matching, inc, exc), sorted by sum_log_prob (so the
+        best assignment is last). unranked_nodes holds the assignments which
+        were found along the way but didn't make the top k.
         """
         Node = namedtuple("Node", ["sum_log_prob", "matching", "inc", "exc"])
 
-        # Initial best matching (subject to initial constraints)
-        best_matching = self.find_best_assignments(inc=init_inc, exc=init_exc)
-        best_matching.index = best_matching["SS_name"]
-        best_matching.index.name = None
+        # Set up the problem as find_best_assignment() does: dummies score 0
+        # with everything
+        log_prob_matrix = self.log_prob_matrix
+        log_prob = log_prob_matrix.to_numpy(dtype=float)
+        labels = self._label_registry()
+        dummy_rows, dummy_cols = labels.dummy_ss, labels.dummy_res
+        costs = -log_prob
+        costs[dummy_rows, :] = 0
+        costs[:, dummy_cols] = 0
+        problem = MurtyProblem(costs, dummy_rows, dummy_cols)
+
+        def to_pairs(constraints):
+            # Convert a DataFrame of labels to (row, col) id pairs
+            if constraints is None or len(constraints) == 0:
+                return None
+            rows, cols = labels.matching_ids(constraints)
+            rows = np.where(dummy_rows[rows], DUMMY, rows)
+            cols = np.where(dummy_cols[cols], DUMMY, cols)
+            pairs = np.unique(np.column_stack([rows, cols]), axis=0)
+            return pairs[(pairs != DUMMY).any(axis=1)]
+
+        def first_unused(dummies, used):
+            unused = dummies.copy()
+            unused[used] = False
+            return np.argmax(unused if unused.any() else dummies)
+
+        def to_node(murty_node):
+            rows, cols = matching_with_dummies(murty_node.row_to_col, dummy_rows, dummy_cols)
+            matching = pd.DataFrame({"SS_name": log_prob_matrix.index[rows],
+                                     "Res_name": log_prob_matrix.columns[cols]},
+                                    index=log_prob_matrix.index[rows])
+            # Constraints on "any dummy" are given the label of the dummy
+            # paired in this matching (for inc), or of a dummy not used in inc
+            # (for exc). find_best_assignment() interprets these the same way.
+            pair_rows = np.empty(problem.n, dtype=int)
+            pair_rows[cols] = rows
+            pair_cols = np.empty(problem.n, dtype=int)
+            pair_cols[rows] = cols
+            inc_rows, inc_cols = murty_node.included.T
+            inc_rows = np.where(inc_rows == DUMMY, pair_rows[np.maximum(inc_cols, 0)], inc_rows)
+            inc_cols = np.where(inc_cols == DUMMY, pair_cols[np.maximum(inc_rows, 0)], inc_cols)
+            exc_rows, exc_cols = murty_node.excluded.T
+            exc_rows = np.where(exc_rows == DUMMY, first_unused(dummy_rows, inc_rows), exc_rows)
+            exc_cols = np.where(exc_cols == DUMMY, first_unused(dummy_cols, inc_cols), exc_cols)
+
+            def to_frame(r, c):
+                if len(r) == 0:
+                    return None
+                return pd.DataFrame({"SS_name": log_prob_matrix.index[r],
+                                     "Res_name": log_prob_matrix.columns[c]})
+
+            # Summed as calc_overall_matching_prob() does, for identical results
+            return Node(sum(log_prob[rows, cols].tolist()), matching,
+                        to_frame(inc_rows, inc_cols), to_frame(exc_rows, exc_cols))
+
+        ranked, pending = kbest_assignments(problem, k, to_pairs(init_inc), to_pairs(init_exc),
+                                            n_jobs=n_jobs)
+        if verbose:
+            for i, node in enumerate(ranked):
+                print("%d\tinc:%d\texc:%d\tcost:%f"
+                      % (i, len(node.included), len(node.excluded), node.cost))
+
+        ranked_nodes = SortedListWithKey([to_node(n) for n in ranked],
+                                         key=lambda n: n.sum_log_prob)
+        unranked_nodes = SortedListWithKey([to_node(n) for n in pending],
+                                           key=lambda n: n.sum_log_prob)
+        return (ranked_nodes, unranked_nodes)
 
-        # Define lists to keep track of nodes
-        ranked_nodes = SortedListWithKey(key=lambda n: n.sum_log_prob)
-        unranked_nodes = SortedListWithKey(
-            [Node(self.calc_overall_matching_prob(best_matching),
-                  best_matching, inc=init_inc, exc=init_exc)],
-            key=lambda n: n.sum_log_prob)
-
-        while len(ranked_nodes) < k:
-            # Set highest scoring unranked node as current_node
-            current_node = unranked_nodes.pop()
-
-            if verbose:
-                s = str(len(ranked_nodes)) + "\t"
-                if current_node.inc is not None:
-                    s = s + "inc:" + str(len(current_node.inc)) + "\t"
-                if current_node.exc is not None:
-                    s = s + "exc:" + str(len(current_node.exc))
-                print(s)
-
-            # If the current node has forced included pairings, get a list of
-            # all parts of the matching that can vary.
-            if current_node.inc is not None:
-                matching_reduced = current_node.matching[
-                    ~current_node.matching["SS_name"].
-                    isin(current_node.inc["SS_name"])]
-            else:
-                matching_reduced = current_node.matching
-
-            # Create child nodes and add them to the unranked_nodes list
-            # -1 in range(matching_reduced.shape[0]-1) is because forcing
-            # inclusion of all but one residue actually results in getting back
-            # the original matching, and also results in an infinite loop of
-            # identical child nodes...
-            for i in range(matching_reduced.shape[0] - 1):
-                # print("\t", i)
-                # Construct dataframes of excluded and included pairs
-                exc_i = matching_reduced.iloc[[i], :]
-                if current_node.exc is not None:
-                    exc_i = exc_i.append(current_node.exc, ignore_index=True)
-                inc_i = matching_reduced.iloc[0:i, :]
-                if current_node.inc is not None:
-                    inc_i = inc_i.append(current_node.inc, ignore_index=True)
-                inc_i = inc_i.drop_duplicates()
-                # If there are no included pairs, it's better for inc_i to be None than an empty df
-                if inc_i.shape[0] == 0:
-                    inc_i = None
-
-                matching_i = self.find_best_assignments(inc=inc_i, exc=exc_i,
-                                                        return_none_if_all_dummy=True,
-                                                        verbose=False)
-                if matching_i is None:
-                    # If the non-constrained residues or spin systems are all
-                    # dummies, find_best_assignments will return None, and this
-                    # node can be discarded
-                    pass
-                else:
-                    # Create a new child node and add to unranked_nodes
-                    matching_i.index = matching_i["SS_name"]
-                    matching_i.index.name = None
-                    node_i = Node(self.calc_overall_matching_prob(matching_i),
-                                  matching_i, inc_i, exc_i)
-                    unranked_nodes.add(node_i)
-            ranked_nodes.add(current_node)
+    def sample_assignments(self, temperatures=(1, 2, 4, 8), time_budget=60, n_rounds=None,
+                           steps_per_round=10000, use_links=True, link_sd=None,
+                           n_jobs=1, seed=None):
+        """Sample plausible assignments by parallel tempering MCMC
 
-        return (ranked_nodes, unranked_nodes)
+        The chains start from the best assignment (as found by
+        assign_from_preds()), and each step swaps the residues of two spin
+        systems. Assignments are scored by log_prob_matrix, plus a Gaussian
+        log probability for the mismatch of each sequential link if
+        calc_mismatch_matrix() has been run and use_links is True. See
+        lib.mcmc_lib for details.
+
+        Returns
+        A tuple (visit_freq_matrix, result). visit_freq_matrix is a DataFrame
+        with the same labels as log_prob_matrix, giving the fraction of
+        samples with each spin system assigned to each residue. result is a
+        lib.mcmc_lib.TemperingResult, which also has the effective sample
+        size and acceptance rates.
+
+        Parameters
+        temperatures: temperature of each chain. Only the first (normally 1)
+            is sampled.
+        time_budget: stop after this many seconds (checked after each round)
+        n_rounds: stop after this many rounds
+        steps_per_round: number of steps each chain makes between exchanges
+        use_links: include the sequential link terms
+        link_sd: standard deviation of the link mismatches (default
+            pars["seq_link_threshold"])
+        n_jobs: number of processes to run the chains in
+        seed: seed for the random number generator
+        """
+        log_prob_matrix = self.log_prob_matrix
+        problem, start = self._swap_problem(use_links, link_sd)
+        result = parallel_tempering(problem, start, temperatures, steps_per_round,
+                                    n_rounds, time_budget, n_jobs, seed)
+        self.logger.info("Sampled %d rounds of %d steps: effective sample size %.1f, "
+                         "acceptance rates %s, exchange rates %s",
+                         result.n_rounds, steps_per_round, result.ess,
+                         np.round(result.acceptance_rate, 3), np.round(result.exchange_rate, 3))
+
+        visit_freq_matrix = pd.DataFrame(result.visit_freq, index=log_prob_matrix.index,
+                                         columns=log_prob_matrix.columns)
+        self.diagnostics.record("visit_freq_matrix", visit_freq_matrix, diagnostics_lib.SUMMARY)
+        return (visit_freq_matrix, result)
+
+    def _swap_problem(self, use_links=True, link_sd=None):
+        """Set up the scores for swap moves between assignments
+
+        Returns
+        A tuple (problem, start). problem is a lib.mcmc_lib.SwapProblem with
+        the same rows and columns as log_prob_matrix, including a Gaussian log
+        probability for the mismatch of each sequential link if
+        calc_mismatch_matrix() has been run and use_links is True. Links
+        between spin systems with no carbon shifts to compare score
+        NEUTRAL_LINK_LOG_PROB. start is
+        the best assignment (as found by assign_from_preds()), as the column
+        for each row.
+
+        Parameters
+        use_links: include the sequential link terms
+        link_sd: standard deviation of the link mismatches (default
+            pars["seq_link_threshold"])
+        """
+        log_prob_matrix = self.log_prob_matrix
+        log_prob = log_prob_matrix.to_numpy(dtype=float).copy()
+        labels = self._label_registry()
+        dummy_rows, dummy_cols = labels.dummy_ss, labels.dummy_res
+        log_prob[dummy_rows, :] = 0
+        log_prob[:, dummy_cols] = 0
+
+        best_matching = self.find_best_assignment(log_prob_matrix, maximise=True)
+        ss_ids, res_ids = labels.matching_ids(best_matching)
+        start = np.empty(labels.n_ss, dtype=int)
+        start[ss_ids] = res_ids
+
+        prev_col, link_log_prob = None, None
+        if use_links and self.mismatch_matrix is not None:
+            if link_sd is None:
+                link_sd = self.pars["seq_link_threshold"]
+            # Link each real residue to the residue before it, if there is one
+            prev_col = labels.prev_res
+
+            mismatch = self.mismatch_matrix.reindex(index=log_prob_matrix.index,
+                                                    columns=log_prob_matrix.index)
+            link_log_prob = -0.5 * (mismatch.fillna(0).to_numpy(dtype=float) / link_sd) ** 2
+            # Pairs with no carbon types in common (including any dummies)
+            # have a mismatch of 0, but no evidence either way. They get the
+            # mean of the term for a correct link, so a good link scores
+            # better than a missing one.
+            pos = self.obs.index.get_indexer(log_prob_matrix.index)
+            shared = self._link_index().shared_matrix()[np.ix_(pos, pos)]
+            link_log_prob[~shared] = NEUTRAL_LINK_LOG_PROB
+
+        return (SwapProblem(log_prob, prev_col, link_log_prob), start)
+
+    def find_joint_assignment(self, threshold=0.2, link_sd=None, betas=DEFAULT_BETAS,
+                              steps_per_stage=20000, seed=0, set_assign_df=False):
+        """Find the assignment maximising the joint objective of match to
+        predictions and sequential links
+
+        The objective is the sum log probability of the assignment, plus a
+        Gaussian log probability for the mismatch of each sequential link (see
+        _swap_problem()), with the mismatches calculated by
+        calc_mismatch_matrix() if it hasn't been run. It's optimised directly
+        by lib.joint_lib, normally in 10-20 assignment problem solves (at
+        most lib.joint_lib.DEFAULT_MAX_SOLVES). This is more solves than the
+        iterative method of find_consistent_assignments() usually needs.
+        Simulated annealing, which is much slower, is only run if the solves
+        don't converge. The objective and elapsed time of each iteration are
+        logged.
+
+        Returns
+        An assign_df DataFrame, with the consistency info added
+
+        Parameters
+        threshold: the maximum allowed mismatch for a good sequential link,
+            when calculating the confidence
+        link_sd: standard deviation of the link mismatches (default
+            pars["seq_link_threshold"])
+        betas: inverse temperature of each simulated annealing stage, if
+            annealing is needed
+        steps_per_stage: number of swap moves in each annealing stage
+        seed: seed for the random number generator
+        set_assign_df: if True, store the result in self.assign_df
+        """
+        self.logger.info("Started joint optimisation of predictions and sequential links")
+        if self.mismatch_matrix is None:
+            # Without it, the link terms would be silently left out
+            self.calc_mismatch_matrix(threshold)
+        log_prob_matrix = self.log_prob_matrix
+        problem, start = self._swap_problem(link_sd=link_sd)
+        result = optimise_joint(problem, start, betas=betas, steps_per_stage=steps_per_stage,
+                                seed=seed)
+        for iteration in result.history:
+            self.logger.info("Iteration %d (%s, link weight %.3g): objective %.3f, time %.3fs",
+                             iteration.iteration, iteration.method, iteration.link_weight,
+                             iteration.objective, iteration.time)
+        self.logger.info("Finished joint optimisation after %d assignment solves",
+                         result.n_solves)
+        self.diagnostics.record("joint_history",
+                                lambda: pd.DataFrame(result.history, columns=JointIteration._fields),
+                                diagnostics_lib.SUMMARY)
+
+        labels = self._label_registry()
+        dummy_rows, dummy_cols = labels.dummy_ss, labels.dummy_res
+        rows, cols = matching_with_dummies(result.row_to_col, dummy_rows, dummy_cols)
+        assign_df = self.make_assign_df(labels.matching(rows, cols), set_assign_df)
+        assign_df = self.add_consistency_info(assign_df, threshold)
+        if set_assign_df:
+            self.assign_df = assign_df
+        return (assign_df)
 
-    def find_consistent_assignments(self, threshold=0.2, set_assign_df=False):
+    def find_consistent_assignments(self, threshold=0.2, set_assign_df=False, method=None):
         """Try to find a consistent set of assignments by optimising both match
         to predictions and mismatches between adjacent residues
 
@@ -1321,7 +1808,18 @@ class SNAPS_assigner:
 
         Parameters
         threshold: the maximum allowed mismatch for a good sequential link
+        method: "iterative" repeatedly penalises spin systems inconsistent with
+            the confident assignments and reassigns, while "joint" uses
+            find_joint_assignment(). By default, "joint" is used if
+            pars["iterate_until_consistent"] is "joint".
         """
+        if method is None:
+            method = ("joint" if self.pars.get("iterate_until_consistent") == "joint"
+                      else "iterative")
+        if method == "joint":
+            return (self.find_joint_assignment(threshold, set_assign_df=set_assign_df))
+        elif method != "iterative":
+            raise ValueError("Unknown consistency method: %s" % method)
 
         self.logger.info("Started assigning based on predictions and sequential links")
         assign_df0 = self.assign_from_preds()
@@ -1330,45 +1828,63 @@ class SNAPS_assigner:
         self.logger.info("At the current stage, there are " + str(N_HM_conf0) +
                          " high or medium confidence assignments")
 
+        log_prob_matrix = self.log_prob_matrix
+        log_prob = log_prob_matrix.to_numpy(dtype=float)
+        labels = self._label_registry()
+        link_index = self._link_index(threshold)
+
         while True:
             # Find all residues with an adjacent confident residue
-            HM_conf_res = assign_df0.loc[assign_df0["Confidence"].isin(["High", "Medium"]),
-                                         "Res_name"]
-
-            # Make a dataframe for looking up which spin system is assigned to each residue
-            tmp = assign_df0[["Res_name", "SS_name"]]
-            tmp.index = tmp["Res_name"]
-
-            # Limit their assignment options to consistent spin systems
-            a = self.copy()
+            HM_conf_res = labels.res_ids(
+                assign_df0.loc[assign_df0["Confidence"].isin(["High", "Medium"]), "Res_name"])
+
+            # Make an array for looking up which spin system is assigned to each residue
+            res_to_ss = np.full(labels.n_res, -1)
+            ss_ids, res_ids = labels.matching_ids(assign_df0)
+            res_to_ss[res_ids] = ss_ids
+
+            # Limit their assignment options to consistent spin systems. The
+            # penalties are layered over log_prob_matrix, rather than applied
+            # to a copy of it.
+            overlay = ConstraintOverlay(log_prob)
+            penalised_min = np.nanmin(log_prob)
+
+            def penalise(allowed_ss, res, penalty):
+                """Penalise the disallowed spin systems for res, and return the
+                new minimum penalised log_prob"""
+                rows = np.flatnonzero(~allowed_ss)
+                if len(rows) == 0:
+                    return penalised_min
+                overlay.add_penalty(rows, res, penalty)
+                return min(penalised_min, np.nanmin(overlay.scores(rows, [res])))
 
             for res in HM_conf_res:
                 # Get the neighbouring residues
-                res_m1 = self.preds.loc[res, "Res_name_m1"]
-                res_p1 = self.preds.loc[res, "Res_name_p1"]
+                res_m1 = labels.prev_res[res]
+                res_p1 = labels.next_res[res]
 
-                ss = tmp.SS_name[res]
+                ss = res_to_ss[res]
 
-                # (Need to be careful with NaN values at this point)
-                penalty = a.log_prob_matrix.min().min()
-                if not pd.isna(res_m1):
+                # (Spin systems with no shifts in common with ss have a
+                # mismatch of 0, so are allowed)
+                penalty = penalised_min
+                if res_m1 >= 0:
                     # Get list of inconsistent i-1 spin systems
-                    allowed_ss = self.mismatch_matrix.loc[:, ss] <= threshold
+                    allowed_ss = link_index.allowed_prev(ss, threshold)
                     # Set the inconsistent spins systems to have a high log_prob
                     # penalty is added so in case no spin systems are allowed -
                     # this way, the predictions do still have an influence.
-                    a.log_prob_matrix.loc[~allowed_ss, res_m1] += penalty
-                    # print(res, self.mismatch_matrix.index[self.mismatch_matrix.loc[:,ss]<=threshold])
-                if not pd.isna(res_p1):
+                    penalised_min = penalise(allowed_ss, res_m1, penalty)
+                if res_p1 >= 0:
                     # Get list of inconsistent i+1 spin systems
-                    allowed_ss = self.mismatch_matrix.loc[ss, :] <= threshold
+                    allowed_ss = link_index.allowed_next(ss, threshold)
                     # Set the inconsistent spins systems to have a high log_prob
-                    a.log_prob_matrix.loc[~allowed_ss, res_p1] += penalty
-                    # print(res, self.mismatch_matrix.index[self.mismatch_matrix.loc[ss,:]<=threshold])
+                    penalised_min = penalise(allowed_ss, res_p1, penalty)
 
             # Rerun assignment and see how many are consistent now
-            assign_df1 = a.assign_from_preds()
-            assign_df1 = a.add_consistency_info(assign_df1, threshold)
+            matching = self.find_best_assignment(log_prob_matrix, maximise=True, overlay=overlay)
+            assign_df1 = self.make_assign_df(matching)
+            assign_df1 = self.add_consistency_info(assign_df1, threshold)
             N_HM_conf1 = assign_df1["Confidence"].isin(["High", "Medium"]).sum()
             self.logger.info("At the current stage, there are " + str(N_HM_conf1) +
                              " high or medium confidence assignments")
@@ -1399,6 +1915,93 @@ class SNAPS_assigner:
 
         return (matching)
 
+    def find_fragments(self, threshold=None, min_links=2, min_length=3):
+        """Chain spin systems into fragments, using the unambiguous sequential
+        links in mismatch_matrix and consistent_links_matrix
+
+        See lib.fragment_lib for details.
+
+        Returns
+        A DataFrame with columns Fragment, Position and SS_name, giving the
+        spin systems of each fragment in sequence order
+
+        Parameters
+        threshold: the maximum mismatch for a sequential link (default
+            pars["seq_link_threshold"])
+        min_links: the minimum number of consistent shifts for a link
+        min_length: the minimum number of spin systems in a fragment
+        """
+        if threshold is None:
+            threshold = self.pars["seq_link_threshold"]
+        ss_names = self.log_prob_matrix.index
+        mismatch = self.mismatch_matrix.reindex(index=ss_names, columns=ss_names)
+        consistent_links = self.consistent_links_matrix.reindex(index=ss_names, columns=ss_names)
+        graph = link_graph(mismatch.to_numpy(dtype=float), consistent_links.to_numpy(dtype=float),
+                           threshold, min_links)
+        fragments = linear_fragments(graph, min_length)
+        self.logger.info("Found %d fragments from %d sequential links, covering %d spin systems",
+                         len(fragments), graph.nnz, sum(len(f) for f in fragments))
+
+        fragment_df = pd.DataFrame({"Fragment": np.repeat(np.arange(len(fragments)),
+                                                          [len(f) for f in fragments]),
+                                    "Position": np.concatenate([np.arange(len(f))
+                                                                for f in fragments] + [[]]),
+                                    "SS_name": ss_names[np.concatenate(fragments + [[]])
+                                                        .astype(int)]})
+        fragment_df["Position"] = fragment_df["Position"].astype(int)
+        return (fragment_df)
+
+    def assign_by_fragments(self, threshold=None, min_links=2, min_length=3, min_log_odds=10,
+                            set_assign_df=False):
+        """Assign fragments of linked spin systems, then the rest from predictions
+
+        Fragments (from find_fragments()) are placed on the sequence where
+        their log probability is clearly highest, and the remaining spin
+        systems are assigned by find_best_assignment() with the placed pairs
+        fixed, so the linear assignment problem only contains the unplaced
+        spin systems and residues. See lib.fragment_lib for details.
+
+        Returns
+        An assign_df DataFrame, with a Fragment column giving the fragment
+        each placed spin system came from (or NaN)
+
+        Parameters
+        threshold, min_links, min_length: see find_fragments()
+        min_log_odds: the minimum log odds of a fragment's best position
+            relative to its next best, for it to be placed
+        set_assign_df: if True, store the result in self.assign_df
+        """
+        if self.mismatch_matrix is None:
+            self.logger.warning("No mismatch matrix, so assigning from predictions only")
+            return (self.assign_from_preds(set_assign_df))
+
+        fragment_df = self.find_fragments(threshold, min_links, min_length)
+        log_prob_matrix = self.log_prob_matrix
+        labels = self._label_registry()
+        fragments = [labels.ss_ids(df["SS_name"])
+                     for _, df in fragment_df.groupby("Fragment", sort=True)]
+
+        # Put the real residues in sequence order
+        seq_cols = np.flatnonzero(~labels.dummy_res)
+        seq_cols = seq_cols[np.argsort(labels.res_n[seq_cols], kind="stable")]
+        log_prob = log_prob_matrix.to_numpy(dtype=float)[:, seq_cols]
+
+        placements = place_fragments(log_prob, fragments, labels.res_n[seq_cols], min_log_odds)
+        inc = labels.matching(
+            np.concatenate([fragments[p.fragment] for p in placements] + [[]]),
+            np.concatenate([seq_cols[p.start:p.start + len(fragments[p.fragment])]
+                            for p in placements] + [[]]),
+            Fragment=np.repeat([p.fragment for p in placements],
+                               [len(fragments[p.fragment]) for p in placements]))
+        self.logger.info("Placed %d of %d fragments, fixing %d assignments",
+                         len(placements), len(fragments), len(inc))
+
+        matching = self.find_best_assignment(log_prob_matrix, maximise=True,
+                                             inc=inc if len(inc) else None)
+        assign_df = self.make_assign_df(matching, set_assign_df)
+        self.logger.info("Finished assigning by fragments")
+        return (assign_df)
+
     def output_shiftlist(self, filepath, format="sparky",
                          confidence_list=["High", "Medium", "Low", "Unreliable", "Undefined"]):
         """Export a chemical shift list, in a variety of formats
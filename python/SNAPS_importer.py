@@ -7,17 +7,25 @@ Defines a class with functions related to importing peak lists and shift lists.
 from textwrap import dedent
 
 from pynmrstar import Entry
+import numpy as np
 import pandas as pd
 from Bio.SeqUtils import seq1
-from math import sqrt
+from scipy.spatial import cKDTree
 
 from lib.NEF_reader import read_nef_obs_shifts_from_file_to_pandas, TRANSLATIONS_3_1_PROTEIN, _split_path_and_frame
 
 from lib.rdcs_lib import get_nef_entry, build_log_probability_from_entry, pred_measured_to_magnitude_matrix
+from lib.scoring_lib import ALL_AA_MASK, aa_mask, aa_string
 
 
 POSSIBLE_1LET_AAS_STR = "ACDEFGHIKLMNPQRSTVWY"
 
+# Spectra where a spin system's shift is taken from its strongest peak
+STRONGEST_PEAK_SPECTRA = {"hnco": "C_m1", "hncaco": "C", 
+                          "hncoca": "CA_m1", "hnca": "CA"}
+# Spectra with both CA and CB peaks, and the shifts they give
+CA_CB_SPECTRA = {"hncocacb": ("CA_m1", "CB_m1"), "hncacb": ("CA", "CB")}
+
 class SnapsImportException(Exception):
     ...
 # import nmrstarlib
@@ -104,7 +112,7 @@ class SNAPS_importer:
         return(self.roots)
         
     def import_3d_peaks(self, filename, filetype, spectrum, 
-                        assign_nearest_root=False):
+                        assign_nearest_root=False, max_distance=None):
         """Import a 3D peak list in various formats
         
         filetype: one of "ccpn", "sparky", "xeasy" or "nmrpipe"
@@ -116,6 +124,10 @@ class SNAPS_importer:
             In this case, the proton assignment is used for CCPN and Sparky, 
             while the ASS column is used for nmrPipe. Xeasy peaklists alone 
             do not seem to contain assignment information.
+        max_distance: if assign_nearest_root is True, peaks further than this
+            from the nearest root are left unassigned (with SS_name NaN). The
+            distance is sqrt(dH^2 + (0.2*dN)^2), in ppm. By default, every peak
+            is assigned.
         """
         if filetype == "ccpn":
             peaks = pd.read_table(filename,
@@ -194,13 +206,7 @@ class SNAPS_importer:
         # If assign_nearest_root, find closest root resonance for each peak 
         # and set that as SS_name.
         if assign_nearest_root or spectrum=="xeasy":
-            peaks["SS_name"] == None
-            
-            roots = self.roots
-            for i in peaks.index:
-                delta = ((roots["H"]-peaks.loc[i,"H"])**2 
-                         + (0.2*(roots["N"]-peaks.loc[i,"N"]))**2).apply(sqrt)
-                peaks.loc[i, "SS_name"] = roots.loc[delta.idxmin(), "SS_name"]
+            peaks["SS_name"] = self.find_nearest_roots(peaks, max_distance)
 
         # Also, only keep spin systems that are in self.roots
         #peaks = peaks.loc[peaks["SS_name"].isin(self.roots["SS_name"])]
@@ -210,11 +216,45 @@ class SNAPS_importer:
             
         return(self.peaklists[spectrum])
         
+    def find_nearest_roots(self, peaks, max_distance=None):
+        """Find the closest root (hsqc) peak to each peak
+
+        All the peaks are queried at once against a KD-tree of the roots, with
+        the N dimension scaled by 0.2 to make it comparable with H.
+
+        Returns a list of the SS_name of the nearest root to each peak, or NaN
+        if there are no roots within max_distance (or the peak position is
+        missing).
+
+        peaks: a DataFrame with H and N columns
+        max_distance: the largest distance for a peak to be assigned to a root
+        """
+        def scaled(df):
+            return np.column_stack([df["H"].to_numpy(dtype=float),
+                                    0.2 * df["N"].to_numpy(dtype=float)])
+
+        roots = self.roots[np.isfinite(scaled(self.roots)).all(axis=1)]
+        peak_coords = scaled(peaks)
+        found = np.isfinite(peak_coords).all(axis=1)
+        nearest = np.full(len(peaks.index), -1)
+        if len(roots.index) == 0 or not found.any():
+            return [np.nan] * len(peaks.index)
+        upper_bound = np.inf if max_distance is None else np.nextafter(max_distance, np.inf)
+        distance, nearest[found] = cKDTree(scaled(roots)).query(peak_coords[found],
+                                                                distance_upper_bound=upper_bound)
+        # Peaks with no root in range get an infinite distance
+        nearest[found] = np.where(np.isfinite(distance), nearest[found], -1)
+        ss_names = roots["SS_name"].to_numpy(dtype=object)
+        return list(np.where(nearest >= 0, ss_names[nearest], np.nan))
+
     def find_shifts_from_peaks(self):
         """ Work out chemical shifts for each spin system from peak lists
         
         Will use all spectra in the self.peaklists dictionary. The following
         spectra are supported: hnco, hncaco, hnca, hncoca, hncacb, hncocacb.
+        
+        Each spectrum is handled in one grouped pass over its peaks, rather 
+        than selecting the peaks of each spin system in turn. 
         """
         # Possible extension: could put a parameter to control hncacb sign interpretation
         obs = pd.DataFrame({"SS_name": self.roots["SS_name"], 
@@ -224,97 +264,98 @@ class SNAPS_importer:
         obs.index.name = None
         for spec in self.peaklists.keys():
             peaks = self.peaklists[spec]
-            for ss in obs["SS_name"]:
-                if ss in peaks["SS_name"].values:
-                    ss_peaks = peaks.loc[peaks["SS_name"]==ss,:]
-                    if spec=="hnco":
-                        # Set C_m1 shift to strongest peak in this spin system.         
-                        i = ss_peaks.loc[:,"Height"].idxmax()
-                        obs.loc[ss, "C_m1"] = ss_peaks.loc[i, "C"]
-                    elif spec=="hncaco":
-                        # Set C shift to strongest peak in this spin system.         
-                        i = ss_peaks.loc[:,"Height"].idxmax()
-                        obs.loc[ss, "C"] = ss_peaks.loc[i, "C"]
-                    elif spec=="hncoca":
-                        # Set CA_m1 shift to strongest peak in this spin system.         
-                        i = ss_peaks.loc[:,"Height"].idxmax()
-                        obs.loc[ss, "CA_m1"] = ss_peaks.loc[i, "C"]
-                    elif spec=="hnca":
-                        # Set CA shift to strongest peak in this spin system.         
-                        i = ss_peaks.loc[:,"Height"].idxmax()
-                        obs.loc[ss, "CA"] = ss_peaks.loc[i, "C"]
-                    elif spec=="hncocacb":
-                        # Use a simple heuristic to guess if peak is CA or CB:
-                        # - If only 1 peak, CA if shift >41 ppm, otherwise CB
-                        # - If >1 peak, only keep the two with highest 
-                        #   (absolute) intensity. 
-                        # - If both >48 ppm, the largest shift is CB. 
-                        #   Otherwise, the smallest shift is CB
-                        if sum(peaks["SS_name"]==ss)==1:
-                            if ss_peaks["C"].item()>41:
-                                obs.loc[ss, "CA_m1"] = ss_peaks["C"].item()
-                            else:
-                                obs.loc[ss, "CB_m1"] = ss_peaks["C"].item()
-                        else:
-                            ss_peaks["Abs_height"] = ss_peaks["Height"].abs()
-                            # Above line throws a SettingWithCopy warning, 
-                            # but I can't seem to fix it
-                            
-                            ss_peaks = ss_peaks.sort_values(by="Abs_height",
-                                                            ascending=False)
-                            ss_peaks = ss_peaks.iloc[0:2,:]
-                            C_max = ss_peaks["C"].max()
-                            C_min = ss_peaks["C"].min()
-                            if C_max>48 and C_min>48:
-                                obs.loc[ss,"CA_m1"] = C_min
-                                obs.loc[ss,"CB_m1"] = C_max
-                            else:
-                                obs.loc[ss,"CA_m1"] = C_max
-                                obs.loc[ss,"CB_m1"] = C_min
-                    elif spec=="hncacb":
-                        # Use a simple heuristic to guess if peak is CA or CB:
-                        # - If only 1 peak, CA if shift >41 ppm, otherwise CB
-                        # - If >1 peak, only keep the two with highest 
-                        #   (absolute) intensity. 
-                        # - If strongest peak is 41-48 ppm and >twice height of
-                        #   next highest, then it's glycine CA
-                        # - Else, if both >48 ppm, the largest shift is CB. 
-                        #   Otherwise, the smallest shift is CB
-                        if sum(peaks["SS_name"]==ss)==1:
-#                            print(ss_peaks)
-#                            print(ss_peaks["C"])
-#                            print(ss_peaks["C"].item())
-                            if ss_peaks["C"].item()>41:
-                                obs.loc[ss, "CA"] = ss_peaks["C"].item()
-                            else:
-                                obs.loc[ss, "CB"] = ss_peaks["C"].item()
-                        else:
-                            ss_peaks["Abs_height"] = ss_peaks["Height"].abs()
-                            # Above line throws a SettingWithCopy warning, 
-                            # but I can't seem to fix it
-                            ss_peaks = ss_peaks.sort_values(by="Abs_height",
-                                                            ascending=False)
-                            ss_peaks = ss_peaks.iloc[0:2,:]
-                            C_max = ss_peaks["C"].max()
-                            C_min = ss_peaks["C"].min()
-                            if (ss_peaks.iloc[0,:]["C"]>41 and 
-                                ss_peaks.iloc[0,:]["C"]<48 and 
-                                ss_peaks.iloc[0,:]["Abs_height"] >
-                                2*ss_peaks.iloc[1,:]["Abs_height"]):
-                                
-                                obs.loc[ss,"CA"] = ss_peaks.iloc[0,:]["C"]
-                            elif C_max>48 and C_min>48:
-                                obs.loc[ss,"CA"] = C_min
-                                obs.loc[ss,"CB"] = C_max
-                            else:
-                                obs.loc[ss,"CA"] = C_max
-                                obs.loc[ss,"CB"] = C_min
-                    else:
-                        print("Spectrum type %s not recognised" % spec)
-                        break
+            peaks = peaks.loc[peaks["SS_name"].isin(obs["SS_name"]),:]
+            if peaks.empty:
+                continue
+            if spec in STRONGEST_PEAK_SPECTRA:
+                shifts = self._strongest_peak_shifts(peaks, 
+                                                     STRONGEST_PEAK_SPECTRA[spec])
+            elif spec in CA_CB_SPECTRA:
+                shifts = self._ca_cb_shifts(peaks, *CA_CB_SPECTRA[spec], 
+                                            glycine=(spec=="hncacb"))
+            else:
+                print("Spectrum type %s not recognised" % spec)
+                continue
+            self._set_obs_shifts(obs, shifts)
             
         self.obs = obs
         return(self.obs)
+    
+    @staticmethod
+    def _strongest_peak_shifts(peaks, atom):
+        """Set the shift to the strongest peak in each spin system
+        
+        Returns a list containing one Series of shifts, indexed by SS_name.
+        """
+        peaks = peaks.reset_index(drop=True)
+        i = peaks.groupby("SS_name", sort=False)["Height"].idxmax()
+        return [pd.Series(peaks.loc[i, "C"].to_numpy(), index=i.index, name=atom)]
+    
+    @staticmethod
+    def _ca_cb_shifts(peaks, CA, CB, glycine=False):
+        """Use a simple heuristic to guess if each peak is CA or CB
+        
+        - If only 1 peak, CA if shift >41 ppm, otherwise CB
+        - If >1 peak, only keep the two with highest (absolute) intensity. 
+        - If glycine is True, and the strongest peak is 41-48 ppm and >twice 
+          height of next highest, then it's glycine CA (and CB is not set)
+        - Else, if both >48 ppm, the largest shift is CB. Otherwise, the 
+          smallest shift is CB
+        
+        Returns a list of Series of CA and CB shifts, indexed by SS_name and 
+        containing only the spin systems where that shift is set.
+        
+        peaks: peaks of one spectrum, all from spin systems in obs
+        CA, CB: names of the CA and CB shifts (eg. "CA_m1", "CB_m1")
+        """
+        peaks = peaks.assign(Abs_height=peaks["Height"].abs())
+        peaks = peaks.reset_index(drop=True)
+        n_peaks = peaks.groupby("SS_name", sort=False).size()
+        
+        # Rank the peaks within each spin system by absolute height. A stable
+        # sort keeps peaks of equal height in the order of the peak list.
+        peaks = peaks.sort_values(by="Abs_height", ascending=False, 
+                                  kind="stable")
+        rank = peaks.groupby("SS_name", sort=False).cumcount()
+        first = peaks.loc[rank==0,:].set_index("SS_name")
+        second = peaks.loc[rank==1,:].set_index("SS_name").reindex(first.index)
+        
+        single = (n_peaks.reindex(first.index)==1).to_numpy()
+        C1, C2 = first["C"].to_numpy(), second["C"].to_numpy()
+        with np.errstate(invalid="ignore"):
+            C_max, C_min = np.fmax(C1, C2), np.fmin(C1, C2)
+            above_41 = C1>41
+            is_gly = (~single & glycine & above_41 & (C1<48) & 
+                      (first["Abs_height"].to_numpy() > 
+                       2*second["Abs_height"].to_numpy()))
+            both_48 = (C_max>48) & (C_min>48)
+        
+        CA_shift = np.where(single | is_gly, C1, np.where(both_48, C_min, C_max))
+        CB_shift = np.where(single, C1, np.where(both_48, C_max, C_min))
+        CA_set = ~single | above_41
+        CB_set = ~(single & above_41) & ~is_gly
+        return [pd.Series(CA_shift[CA_set], index=first.index[CA_set], name=CA),
+                pd.Series(CB_shift[CB_set], index=first.index[CB_set], name=CB)]
+    
+    @staticmethod
+    def _set_obs_shifts(obs, shifts):
+        """Copy shifts into obs, adding any new columns
+        
+        New columns are added in the order they would be if the shifts were 
+        set one spin system at a time, in the order of obs.
+        
+        obs: DataFrame indexed by SS_name
+        shifts: list of Series of shifts indexed by SS_name, in the order 
+            they're set within a spin system
+        """
+        positions = [obs.index.get_indexer(s.index) for s in shifts]
+        new_cols = [(pos.min(), k) for k, (s, pos) in enumerate(zip(shifts, positions))
+                    if s.name not in obs.columns and len(s.index)>0]
+        for _, k in sorted(new_cols):
+            obs[shifts[k].name] = np.nan
+        for s, pos in zip(shifts, positions):
+            if len(s.index)>0:
+                obs.iloc[pos, obs.columns.get_loc(s.name)] = s.to_numpy()
             
     def import_obs_shifts(self, filename, filetype, SS_num=False, chain='A'):
         """ Import a chemical shift list
@@ -569,10 +610,8 @@ class SNAPS_importer:
 
         ex_mask = (aa_info_df["Type"] == "ex")
         for row_index in aa_info_df.index[ex_mask]:
-            expected_aas = POSSIBLE_1LET_AAS_STR
-            for aa_1let in aa_info_df.loc[row_index, "AA"]:
-                expected_aas = expected_aas.replace(aa_1let, "")
-            aa_info_df.loc[row_index, ss_class_col] = expected_aas
+            excluded = aa_mask(aa_info_df.loc[row_index, "AA"])
+            aa_info_df.loc[row_index, ss_class_col] = aa_string(ALL_AA_MASK & ~excluded)
         aa_info_df.index = aa_info_df["SS_name"]
 
         # Create SS_class column in obs DataFrame if it doesn't already exist.
@@ -649,6 +688,25 @@ class SNAPS_importer:
                """
             raise SnapsImportException(msg)
 
+    @staticmethod
+    def _aa_classes_from_res_type(res_types, aa_classes):
+        """Map each residue type onto the amino acid class string containing it
+
+        res_types: Series of one letter residue types
+        aa_classes: list of amino acid class strings, eg. ["VIA","G","S"]
+        """
+        class_masks = [(aa_mask(g), g) for g in aa_classes]
+
+        def find_class(res_type):
+            if not isinstance(res_type, str):
+                return res_type
+            for mask, g in class_masks:
+                if mask & aa_mask(res_type):
+                    return g
+            return res_type
+
+        return res_types.map(find_class)
+
     def import_testset_shifts(self, filename, remove_Pro=True,
                           short_aa_names=True, SS_class=None, SS_class_m1=None):
         """ Import observed chemical shifts from testset data
@@ -708,15 +766,13 @@ class SNAPS_importer:
         obs = obs[["Res_N", "Res_type", "Res_type_m1", "SS_name"]+
                   list(atom_set.intersection(obs.columns))]
         
-        # Add SS_class information
+        # Add SS_class information. Each residue type is replaced by the
+        # class that contains it (residue types not in any class are kept).
         if SS_class is not None:
-            obs["SS_class"]=obs["Res_type"]
-            for g in SS_class:
-                obs["SS_class"] = obs["SS_class"].str.replace("["+g+"]", g)
+            obs["SS_class"] = self._aa_classes_from_res_type(obs["Res_type"], SS_class)
         if SS_class_m1 is not None:
-            obs["SS_class_m1"]=obs["Res_type_m1"]
-            for g in SS_class_m1:
-                obs["SS_class_m1"] = obs["SS_class_m1"].str.replace("["+g+"]", g)
+            obs["SS_class_m1"] = self._aa_classes_from_res_type(obs["Res_type_m1"],
+                                                                SS_class_m1)
         
         obs.index = obs["SS_name"]
         obs.index.name = None
@@ -0,0 +1,173 @@
+"""
+A persistent on-disk cache for the score matrices calculated by SNAPS_assigner.
+
+Each cache entry is a directory containing one .npy file per matrix (so they
+can be memory mapped when loaded), and a labels.npz file with the row and
+column labels. Entries are keyed by a hash of everything that went into the
+calculation, so a changed input simply gives a different key. The cache is
+kept under a maximum size by removing the least recently used entries.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Bump this if the way any cached matrix is calculated changes, so old entries
+# are no longer used.
+CACHE_VERSION = 1
+
+DEFAULT_MAX_BYTES = 500 * 2 ** 20
+
+logger = logging.getLogger("SNAPS.cache")
+
+
+def hash_inputs(*items):
+    """Make a hex digest from a sequence of DataFrames, arrays, dicts, sets,
+    strings, bytes and numbers"""
+    h = hashlib.sha256(str(CACHE_VERSION).encode())
+    for item in items:
+        _update_hash(h, item)
+    return h.hexdigest()
+
+
+def _update_hash(h, item):
+    if isinstance(item, pd.DataFrame):
+        h.update(b"DataFrame")
+        h.update(json.dumps([str(c) for c in item.columns]).encode())
+        h.update(json.dumps([str(t) for t in item.dtypes]).encode())
+        h.update(pd.util.hash_pandas_object(item, index=True).to_numpy().tobytes())
+    elif isinstance(item, np.ndarray):
+        h.update(b"ndarray" + str(item.dtype).encode() + str(item.shape).encode())
+        h.update(np.ascontiguousarray(item).tobytes())
+    elif isinstance(item, dict):
+        h.update(b"dict")
+        for key in sorted(item, key=str):
+            _update_hash(h, str(key))
+            _update_hash(h, item[key])
+    elif isinstance(item, (set, frozenset)):
+        h.update(b"set")
+        for x in sorted(item, key=str):
+            _update_hash(h, x)
+    elif isinstance(item, (list, tuple)):
+        h.update(b"list")
+        for x in item:
+            _update_hash(h, x)
+    elif isinstance(item, bytes):
+        h.update(b"bytes" + str(len(item)).encode() + item)
+    else:
+        h.update(repr(item).encode())
+
+
+class MatrixCache:
+    """A directory of cached matrix bundles, with size-based eviction"""
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        directory: where the cache is kept (created if necessary)
+        max_bytes: the cache is pruned back below this size after each save
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def load(self, kind, key):
+        """Load a bundle of matrices
+
+        Returns
+        A dict of DataFrames keyed by matrix name, or None if the bundle isn't
+        in the cache. The values are memory mapped copy-on-write, so the
+        DataFrames can be modified without affecting the cache.
+
+        Parameters
+        kind: the type of bundle (eg. "log_prob")
+        key: from hash_inputs()
+        """
+        path = self._path(kind, key)
+        if not path.is_dir():
+            return None
+
+        try:
+            with np.load(path / "labels.npz", allow_pickle=False) as labels:
+                labels = dict(labels)
+            result = {}
+            for name in labels["names"]:
+                values = np.load(path / (name + ".npy"), mmap_mode="c")
+                df = pd.DataFrame(values, index=labels[name + "_index"],
+                                  columns=labels[name + "_columns"], copy=False)
+                df.index.name = _none_if_empty(labels[name + "_index_name"])
+                df.columns.name = _none_if_empty(labels[name + "_columns_name"])
+                result[str(name)] = df
+        except (OSError, KeyError, ValueError) as e:
+            logger.warning("Ignoring unreadable cache entry %s (%s)", path, e)
+            return None
+
+        # Mark as recently used
+        os.utime(path)
+        logger.info("Loaded %s matrices from cache entry %s", kind, path)
+        return result
+
+    def save(self, kind, key, matrices):
+        """Save a bundle of matrices
+
+        Parameters
+        kind: the type of bundle (eg. "log_prob")
+        key: from hash_inputs()
+        matrices: dict of DataFrames keyed by matrix name
+        """
+        path = self._path(kind, key)
+        tmp_path = Path(tempfile.mkdtemp(dir=self.directory, prefix=".tmp-"))
+        try:
+            labels = {"names": np.array(list(matrices), dtype=str)}
+            for name, df in matrices.items():
+                values = df.to_numpy()
+                if values.dtype == object:
+                    # Object arrays can't be memory mapped
+                    values = df.to_numpy(dtype=float)
+                np.save(tmp_path / (name + ".npy"), values)
+                labels[name + "_index"] = np.array(df.index, dtype=str)
+                labels[name + "_columns"] = np.array(df.columns, dtype=str)
+                labels[name + "_index_name"] = np.array(df.index.name or "", dtype=str)
+                labels[name + "_columns_name"] = np.array(df.columns.name or "", dtype=str)
+            np.savez(tmp_path / "labels.npz", **labels)
+
+            if path.exists():
+                shutil.rmtree(path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Could not save cache entry %s (%s)", path, e)
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+
+        logger.info("Saved %s matrices to cache entry %s", kind, path)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache is no bigger
+        than max_bytes"""
+        entries = []
+        for path in self.directory.iterdir():
+            if path.is_dir() and not path.name.startswith("."):
+                size = sum(f.stat().st_size for f in path.iterdir())
+                entries.append((path.stat().st_mtime, size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            logger.info("Evicted cache entry %s", path)
+
+    def _path(self, kind, key):
+        return self.directory / ("%s-%s" % (kind, key))
+
+
+def _none_if_empty(name):
+    name = str(name)
+    return name if name else None
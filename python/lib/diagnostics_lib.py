@@ -0,0 +1,244 @@
+"""
+An optional channel for saving the intermediate tables calculated during a
+SNAPS run, for debugging and inspection.
+
+Diagnostics are off by default, and recording something costs nothing beyond
+a level check until they are switched on. When enabled, each recorded
+DataFrame or array is written as a binary artefact (.npz, or .parquet for
+mixed-type DataFrames if pyarrow is available) into a run directory, and
+listed in index.json in that directory. Artefacts are only formatted as text
+if that is asked for, either with format_text() or by setting text=True.
+
+Levels:
+    OFF: nothing is recorded
+    SUMMARY: the main score matrices
+    DETAIL: also the inputs and intermediate steps of each calculation
+"""
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+OFF = 0
+SUMMARY = 1
+DETAIL = 2
+
+LEVELS = {"off": OFF, "summary": SUMMARY, "detail": DETAIL}
+
+INDEX_FILE = "index.json"
+
+logger = logging.getLogger("SNAPS.diagnostics")
+
+
+def _parquet_available():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class Diagnostics:
+    """Writes recorded tables to a run directory, if the level allows it"""
+
+    def __init__(self, run_dir=None, level=OFF, text=False):
+        """
+        run_dir: directory the artefacts are written to (created when the
+            first artefact is recorded)
+        level: OFF, SUMMARY or DETAIL, or one of the names in LEVELS
+        text: if True, also write a .txt rendering of each artefact
+        """
+        self.configure(run_dir, level, text)
+
+    def configure(self, run_dir=None, level=OFF, text=False):
+        """Change the run directory and level. The index is started afresh."""
+        if isinstance(level, str):
+            try:
+                level = LEVELS[level.lower()]
+            except KeyError:
+                raise ValueError("Unknown diagnostics level %r (should be one of %s)"
+                                 % (level, ", ".join(LEVELS)))
+        if level > OFF and run_dir is None:
+            raise ValueError("A run directory is needed to record diagnostics")
+        self.run_dir = None if run_dir is None else Path(run_dir)
+        self.level = level
+        self.text = text
+        self._entries = []
+
+    def enabled(self, level=SUMMARY):
+        """Check whether artefacts at the given level are being recorded"""
+        return self.run_dir is not None and OFF < level <= self.level
+
+    def record(self, name, value, level=DETAIL, description=""):
+        """Save an artefact, if diagnostics are enabled at this level
+
+        Returns
+        The path of the artefact written, or None if nothing was recorded
+
+        Parameters
+        name: short name for the artefact (eg. "log_prob_matrix")
+        value: a DataFrame, Series, numpy array or JSON serialisable object
+            (eg. a dict of parameters). May also be a function with no
+            arguments returning one of these, in which case it's only called
+            if the artefact is recorded.
+        level: SUMMARY or DETAIL
+        description: optional text to include in the index
+        """
+        if not self.enabled(level):
+            return None
+        if callable(value):
+            value = value()
+
+        self.run_dir.mkdir(parents=True, exist_ok=True)
+        stem = "%04d-%s" % (len(self._entries) + 1, name)
+        try:
+            file_name, kind, shape = self._write(stem, value)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning("Could not record diagnostic artefact %s (%s)", name, e)
+            return None
+
+        entry = {"name": name,
+                 "file": file_name,
+                 "kind": kind,
+                 "shape": shape,
+                 "level": level,
+                 "description": description,
+                 "time": datetime.now().isoformat(timespec="seconds")}
+        self._entries.append(entry)
+        self._write_index()
+
+        if self.text:
+            (self.run_dir / (stem + ".txt")).write_text(self.format_text(name))
+
+        logger.debug("Recorded diagnostic artefact %s", self.run_dir / file_name)
+        return self.run_dir / file_name
+
+    def index(self):
+        """Returns
+        A list of dicts describing each artefact recorded in the run directory
+        """
+        if self.run_dir is None or not (self.run_dir / INDEX_FILE).exists():
+            return []
+        with open(self.run_dir / INDEX_FILE) as f:
+            return json.load(f)
+
+    def load(self, name):
+        """Load the most recently recorded artefact with this name
+
+        Returns
+        A DataFrame, numpy array or JSON object, depending on what was recorded
+        """
+        for entry in reversed(self.index()):
+            if entry["name"] == name:
+                return _read(self.run_dir / entry["file"], entry["kind"])
+        raise KeyError("No diagnostic artefact called %s in %s" % (name, self.run_dir))
+
+    def format_text(self, name):
+        """Render the most recently recorded artefact with this name as text"""
+        value = self.load(name)
+        if isinstance(value, pd.DataFrame):
+            return value.to_string()
+        if isinstance(value, np.ndarray):
+            with np.printoptions(threshold=np.inf, linewidth=200):
+                return str(value)
+        return json.dumps(value, indent=2)
+
+    def _write(self, stem, value):
+        """Write a single artefact
+
+        Returns
+        The file name, the kind of artefact and its shape (or None)
+        """
+        if isinstance(value, pd.Series):
+            value = value.to_frame()
+
+        if isinstance(value, pd.DataFrame):
+            numeric = all(pd.api.types.is_numeric_dtype(t) or pd.api.types.is_bool_dtype(t)
+                          for t in value.dtypes)
+            if not numeric and _parquet_available():
+                file_name = stem + ".parquet"
+                value.to_parquet(self.run_dir / file_name)
+                return file_name, "parquet", list(value.shape)
+            file_name = stem + ".npz"
+            _save_frame(self.run_dir / file_name, value, numeric)
+            return file_name, "frame" if numeric else "columns", list(value.shape)
+
+        if isinstance(value, np.ndarray):
+            file_name = stem + ".npz"
+            np.savez(self.run_dir / file_name, values=value)
+            return file_name, "array", list(value.shape)
+
+        file_name = stem + ".json"
+        with open(self.run_dir / file_name, "w") as f:
+            json.dump(value, f, indent=2, default=_json_default)
+        return file_name, "json", None
+
+    def _write_index(self):
+        # Write to a temporary file first, so the index is never left half written
+        fd, tmp_name = tempfile.mkstemp(dir=self.run_dir, prefix=".index-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self._entries, f, indent=2)
+        os.replace(tmp_name, self.run_dir / INDEX_FILE)
+
+
+def _save_frame(path, df, numeric):
+    """Save a DataFrame as a .npz file. Numeric frames are stored as a single
+    array; others have one array per column, with object columns as strings."""
+    arrays = {"index": np.array(df.index, dtype=str),
+              "columns": np.array(df.columns, dtype=str),
+              "index_name": np.array(df.index.name or "", dtype=str),
+              "columns_name": np.array(df.columns.name or "", dtype=str)}
+    if numeric:
+        arrays["values"] = df.to_numpy()
+    else:
+        for i, col in enumerate(df.columns):
+            values = df[col].to_numpy()
+            if values.dtype == object:
+                values = values.astype(str)
+            arrays["col_%d" % i] = values
+    np.savez(path, **arrays)
+
+
+def _read(path, kind):
+    if kind == "parquet":
+        return pd.read_parquet(path)
+    if kind == "json":
+        with open(path) as f:
+            return json.load(f)
+
+    with np.load(path, allow_pickle=False) as data:
+        if kind == "array":
+            return data["values"]
+        columns = data["columns"]
+        if kind == "frame":
+            df = pd.DataFrame(data["values"], index=data["index"], columns=columns)
+        else:
+            df = pd.DataFrame({col: data["col_%d" % i] for i, col in enumerate(columns)},
+                              index=data["index"])
+        df.index.name = str(data["index_name"]) or None
+        df.columns.name = str(data["columns_name"]) or None
+    return df
+
+
+def _json_default(value):
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=str)
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+# The process-wide diagnostics channel. It's off until configured, eg. by the
+# --diagnostics_dir option to SNAPS.py.
+diagnostics = Diagnostics()
+
+
+def configure(run_dir=None, level=OFF, text=False):
+    """Set up the process-wide diagnostics channel"""
+    diagnostics.configure(run_dir, level, text)
+    return diagnostics
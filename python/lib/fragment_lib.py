@@ -0,0 +1,164 @@
+"""
+Assignment by chaining spin systems into fragments.
+
+Spin systems whose i-1 shifts agree with another spin system's i shifts are
+probably adjacent in the sequence. These links form a sparse directed graph,
+and wherever a spin system has exactly one consistent successor which in
+turn has exactly one consistent predecessor, the link is unambiguous.
+Following unambiguous links gives linear fragments of sequential spin
+systems.
+
+A fragment can only be placed on a run of consecutive residues, so its score
+at each position is the sum of log_prob_matrix along a diagonal. A fragment
+is placed if its best position is clearly better than its next best, and
+conflicting placements are resolved by dynamic programming along the
+sequence (weighted interval scheduling). The remaining spin systems are then
+assigned by an ordinary, and much smaller, linear assignment problem.
+"""
+from bisect import bisect_right
+from collections import namedtuple
+
+import numpy as np
+from scipy import sparse
+
+Placement = namedtuple("Placement", ["fragment", "start", "score", "log_odds"])
+Placement.__doc__ = """The position of a fragment on the sequence
+
+fragment: index of the fragment
+start: position of the first spin system of the fragment, in the sequence
+score: sum log probability of the fragment at this position
+log_odds: score, minus the score at the next best position
+"""
+
+
+def link_graph(mismatch, consistent_links, threshold=0.2, min_links=2):
+    """Make a sparse directed graph of the consistent sequential links
+
+    Returns
+    An (n x n) boolean scipy.sparse.csr_matrix, with an edge from a to b if
+    spin system a could precede spin system b
+
+    Parameters
+    mismatch: (n x n) array with the largest mismatch between the i-1 shifts
+        of the column and the i shifts of the row (as in mismatch_matrix)
+    consistent_links: (n x n) array with the number of consistent shifts for
+        each pair (as in consistent_links_matrix)
+    threshold: the maximum mismatch for a link
+    min_links: the minimum number of consistent shifts for a link
+    """
+    adjacent = (np.asarray(consistent_links) >= min_links) & (np.asarray(mismatch) <= threshold)
+    np.fill_diagonal(adjacent, False)
+    return sparse.csr_matrix(adjacent)
+
+
+def linear_fragments(graph, min_length=3):
+    """Find the chains of unambiguous links in a link graph
+
+    Links are unambiguous if they're the only link out of their first spin
+    system and the only link into their second. Closed loops of unambiguous
+    links are ignored.
+
+    Returns
+    A list of arrays, each giving the spin systems of a fragment in sequence
+    order
+
+    Parameters
+    graph: a link graph, as made by link_graph()
+    min_length: the minimum number of spin systems in a fragment
+    """
+    n = graph.shape[0]
+    graph = sparse.csr_matrix(graph)
+    out_degree = np.diff(graph.indptr)
+    in_degree = np.bincount(graph.indices, minlength=n)
+    sources = np.repeat(np.arange(n), out_degree)
+    unique = (out_degree[sources] == 1) & (in_degree[graph.indices] == 1)
+
+    next_ss = np.full(n, -1)
+    next_ss[sources[unique]] = graph.indices[unique]
+    has_prev = np.zeros(n, dtype=bool)
+    has_prev[graph.indices[unique]] = True
+
+    fragments = []
+    for start in np.flatnonzero(~has_prev & (next_ss >= 0)):
+        fragment = [start]
+        while next_ss[fragment[-1]] >= 0:
+            fragment.append(next_ss[fragment[-1]])
+        if len(fragment) >= min_length:
+            fragments.append(np.array(fragment))
+    return fragments
+
+
+def placement_scores(log_prob, fragment, res_n):
+    """Score a fragment at every position in the sequence
+
+    Returns
+    An array with the sum log probability of the fragment starting at each
+    position, or -inf where the residues aren't consecutive
+
+    Parameters
+    log_prob: (spin systems x residues) array of log probabilities, with the
+        residues in sequence order
+    fragment: the spin systems of the fragment, in sequence order
+    res_n: the residue number of each column of log_prob
+    """
+    m = len(fragment)
+    n_positions = log_prob.shape[1] - m + 1
+    if n_positions <= 0:
+        return np.empty(0)
+    scores = np.zeros(n_positions)
+    for offset, ss in enumerate(fragment):
+        scores += log_prob[ss, offset:offset + n_positions]
+    consecutive = (res_n[m - 1:] - res_n[:n_positions]) == m - 1
+    scores[~consecutive] = -np.inf
+    return scores
+
+
+def place_fragments(log_prob, fragments, res_n, min_log_odds=10):
+    """Place fragments onto the sequence
+
+    Each fragment is a candidate at its best position, if that beats its next
+    best position by at least min_log_odds. Overlapping candidates are then
+    resolved by choosing the set that maximises the total log odds.
+
+    Returns
+    A list of Placement, in sequence order
+
+    Parameters
+    log_prob: (spin systems x residues) array of log probabilities, with the
+        residues in sequence order
+    fragments: list of fragments, as from linear_fragments()
+    res_n: the residue number of each column of log_prob
+    min_log_odds: the minimum log odds for a fragment to be placed
+    """
+    candidates = []
+    for i, fragment in enumerate(fragments):
+        scores = placement_scores(log_prob, fragment, res_n)
+        if not np.isfinite(scores).any():
+            continue
+        best, second = np.argsort(scores)[::-1][:2] if len(scores) > 1 else (0, None)
+        log_odds = np.inf if second is None else scores[best] - scores[second]
+        if log_odds >= min_log_odds:
+            candidates.append(Placement(i, int(best), scores[best], log_odds))
+
+    # Weighted interval scheduling: total[j] is the best total log odds using
+    # the first j candidates (in order of their end position)
+    candidates.sort(key=lambda p: p.start + len(fragments[p.fragment]))
+    ends = [p.start + len(fragments[p.fragment]) for p in candidates]
+    # Infinite log odds (fragments with only one position) are capped, so
+    # they still add up
+    weights = [min(p.log_odds, 1e12) for p in candidates]
+    total = [0.0] * (len(candidates) + 1)
+    previous = [0] * len(candidates)
+    for j, p in enumerate(candidates):
+        previous[j] = bisect_right(ends, p.start, 0, j)
+        total[j + 1] = max(total[j], total[previous[j]] + weights[j])
+
+    placed = []
+    j = len(candidates)
+    while j > 0:
+        if total[j] > total[j - 1]:
+            placed.append(candidates[j - 1])
+            j = previous[j - 1]
+        else:
+            j -= 1
+    return placed[::-1]
@@ -0,0 +1,196 @@
+"""
+Optimising the joint objective of match to predictions and sequential links.
+
+The objective is the score of a lib.mcmc_lib.SwapProblem: the sum of the log
+probabilities of the assigned pairs, plus a link term for each pair of
+adjacent residues. The link terms make this a quadratic assignment problem,
+which is optimised in two phases:
+
+1. Linearisation with continuation. With the neighbours of every residue held
+   at their current spin systems, the link terms become a linear score for
+   each pair, and the resulting assignment problem is solved exactly. The new
+   assignment is accepted if it improves the objective (optionally, shorter
+   steps towards the linearised scores are tried if not). The link terms are
+   weighted, starting small (where the objective is close to the plain
+   assignment problem) and rising to their full weight, as the full link
+   terms alone quickly trap the linearisation in poor local optima. If the
+   start is already a fixed point of the linearisation at full weight, the
+   continuation is skipped. Each weight needs at least one solve, so this
+   normally takes 10-20 solves in total, and the number is capped by
+   max_solves.
+2. Simulated annealing, using the constant time swap moves of
+   SwapProblem.run_chain() with a rising inverse temperature, followed by a
+   final linearisation at full weight. This escapes local optima of the
+   linearisation, but takes much longer than the solves, so by default it's
+   only run if the linearisation reached max_solves before converging.
+
+The objective and elapsed time of each iteration are recorded, so the
+convergence can be reported.
+"""
+from collections import namedtuple
+from time import monotonic
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+DEFAULT_LINK_WEIGHTS = tuple(np.geomspace(0.01, 1, 8).tolist())
+DEFAULT_STEPS = (1,)
+DEFAULT_MAX_SOLVES = 30
+DEFAULT_BETAS = tuple(np.geomspace(0.2, 20, 10).tolist())
+
+JointIteration = namedtuple("JointIteration",
+                            ["iteration", "method", "link_weight", "objective", "time"])
+JointIteration.__doc__ = """One iteration of optimise_joint()
+
+method: "start", "linearise" (one accepted assignment problem solve) or
+    "anneal" (one temperature stage)
+link_weight: weight of the link terms being optimised
+objective: the joint objective (with the links at full weight) of the current
+    assignment
+time: seconds since the start of the optimisation
+"""
+
+JointResult = namedtuple("JointResult", ["row_to_col", "objective", "history", "n_solves"])
+JointResult.__doc__ = """Results of optimise_joint()
+
+row_to_col: the best assignment found, as the column for each row
+objective: its joint objective
+history: list of JointIteration
+n_solves: number of assignment problems solved
+"""
+
+
+def linearised_log_prob(log_prob, prev_col, next_col, link_log_prob, row_to_col):
+    """The score of each pair, with the neighbouring residues held at their
+    current spin systems
+
+    Returns
+    An (n x n) array
+
+    Parameters
+    log_prob, link_log_prob: (n x n) arrays, as for SwapProblem
+    prev_col, next_col: length n arrays giving the columns before and after
+        each column, or -1 if there isn't one
+    row_to_col: the current assignment
+    """
+    col_to_row = np.empty(len(row_to_col), dtype=int)
+    col_to_row[row_to_col] = np.arange(len(row_to_col))
+    scores = log_prob.copy()
+    has_prev = prev_col >= 0
+    scores[:, has_prev] += link_log_prob[col_to_row[prev_col[has_prev]], :].T
+    has_next = next_col >= 0
+    scores[:, has_next] += link_log_prob[:, col_to_row[next_col[has_next]]]
+    return scores
+
+
+def optimise_joint(problem, start, link_weights=DEFAULT_LINK_WEIGHTS, steps=DEFAULT_STEPS,
+                   betas=DEFAULT_BETAS, steps_per_stage=20000, max_solves=DEFAULT_MAX_SOLVES,
+                   anneal_if_converged=False, seed=None):
+    """Find a high scoring assignment of a SwapProblem
+
+    Returns
+    A JointResult
+
+    Parameters
+    problem: a SwapProblem. Without link terms, start is returned unchanged.
+    start: length n array giving the starting column for each row (normally
+        the optimal assignment of the log probabilities alone)
+    link_weights: weights of the link terms for the linearisation, in
+        increasing order. The last should be 1. They're skipped if start is
+        already a fixed point of the linearisation at full weight.
+    steps: fractions of the way towards the linearised scores to try, in
+        decreasing order
+    betas: inverse temperature of each annealing stage, in increasing order.
+        If empty, only the linearisation is used.
+    steps_per_stage: number of swap moves in each annealing stage
+    max_solves: maximum total number of assignment problems solved, including
+        rejected steps
+    anneal_if_converged: if False, the annealing is only run if the
+        linearisation stopped at max_solves, rather than converging
+    seed: seed for the random number generator
+    """
+    start_time = monotonic()
+    history = []
+    row_to_col = np.array(start, dtype=int)
+    if problem.link_log_prob is None:
+        objective = problem.score(row_to_col)
+        history.append(JointIteration(0, "start", 0, objective, monotonic() - start_time))
+        return JointResult(row_to_col, objective, history, 0)
+
+    log_prob = np.array(problem.log_prob)
+    link_log_prob = np.array(problem.link_log_prob)
+    prev_col = np.array(problem.prev_col)
+    next_col = np.array(problem.next_col)
+    linked_cols = np.flatnonzero(prev_col >= 0)
+    rows = np.arange(problem.n)
+    n_solves = 0
+
+    def score(row_to_col):
+        """The log prob and link parts of the objective"""
+        col_to_row = np.empty(problem.n, dtype=int)
+        col_to_row[row_to_col] = rows
+        links = link_log_prob[col_to_row[prev_col[linked_cols]], col_to_row[linked_cols]]
+        return log_prob[rows, row_to_col].sum(), links.sum()
+
+    best = [row_to_col, sum(score(row_to_col))]
+
+    def record(method, link_weight, row_to_col, objective):
+        if objective > best[1]:
+            best[:] = [row_to_col, objective]
+        history.append(JointIteration(len(history), method, link_weight, objective,
+                                      monotonic() - start_time))
+
+    def linearise(row_to_col, link_weight):
+        """Improve row_to_col by linearised solves at link_weight
+
+        Returns a tuple (row_to_col, converged), where converged is True if
+        no step improved on it, and False if max_solves was reached first
+        """
+        nonlocal n_solves
+        weighted_links = link_weight * link_log_prob
+        weighted = np.dot(score(row_to_col), (1, link_weight))
+        while n_solves < max_solves:
+            linearised = linearised_log_prob(log_prob, prev_col, next_col, weighted_links,
+                                             row_to_col)
+            for step in steps:
+                if n_solves >= max_solves:
+                    return row_to_col, False
+                new_row_to_col = linear_sum_assignment(log_prob + step * (linearised - log_prob),
+                                                       maximize=True)[1]
+                n_solves += 1
+                if step == 1 and (new_row_to_col == row_to_col).all():
+                    return row_to_col, True
+                new_log_prob, new_links = score(new_row_to_col)
+                if new_log_prob + link_weight * new_links > weighted:
+                    break
+            else:
+                return row_to_col, True
+            row_to_col = new_row_to_col
+            weighted = new_log_prob + link_weight * new_links
+            record("linearise", link_weight, row_to_col, new_log_prob + new_links)
+        return row_to_col, False
+
+    record("start", 0, row_to_col, best[1])
+    # If the start is already a fixed point at full weight (ie. it agrees
+    # with its links), the continuation isn't needed
+    n_solves += 1
+    converged = (linear_sum_assignment(linearised_log_prob(log_prob, prev_col, next_col,
+                                                           link_log_prob, row_to_col),
+                                       maximize=True)[1] == row_to_col).all()
+    if not converged:
+        for link_weight in link_weights:
+            row_to_col, converged = linearise(row_to_col, link_weight)
+    if not len(betas) or (converged and not anneal_if_converged):
+        return JointResult(best[0], best[1], history, n_solves)
+
+    rng = np.random.default_rng(seed)
+    state, state_score = best[0].tolist(), best[1]
+    for beta, stage_seed in zip(betas, rng.integers(2**63, size=len(betas)).tolist()):
+        state, state_score, _, _, _, stage_best, stage_best_row_to_col = problem.run_chain(
+            state, state_score, beta, steps_per_stage, stage_seed, thin=steps_per_stage)
+        # The chain's scores are running totals, so recalculate
+        record("anneal", 1, np.array(stage_best_row_to_col),
+               sum(score(stage_best_row_to_col)))
+
+    linearise(best[0], 1)
+    return JointResult(best[0], best[1], history, n_solves)
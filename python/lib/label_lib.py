@@ -0,0 +1,106 @@
+"""
+Dense integer ids for spin systems and residues.
+
+The matrices in SNAPS_assigner are DataFrames labelled by spin system and
+residue names, with the spin systems in the order of obs and the residues in
+the order of preds. Looking pairs up by label hashes strings every time, so
+the registry maps the labels to integer ids once (their positions in obs and
+preds, and so in the rows and columns of log_prob_matrix). Internal code can
+then index the underlying arrays directly, and only attach labels when
+building assign_df or other outputs.
+"""
+import numpy as np
+import pandas as pd
+
+
+class LabelRegistry:
+    """Integer ids for the spin systems and residues of a SNAPS_assigner,
+    with the per-id information needed by the solvers"""
+
+    def __init__(self, ss_names, res_names, dummy_ss=None, dummy_res=None,
+                 res_n=None, prev_res=None, next_res=None):
+        """
+        ss_names, res_names: labels of the spin systems and residues, in id
+            order
+        dummy_ss, dummy_res: boolean arrays marking the dummies (default none)
+        res_n: residue number of each residue (NaN for dummies)
+        prev_res, next_res: ids of the residues before and after each
+            residue, or -1 if there isn't one
+        """
+        self.ss_names = pd.Index(ss_names)
+        self.res_names = pd.Index(res_names)
+        n_ss, n_res = len(self.ss_names), len(self.res_names)
+        self.dummy_ss = (np.zeros(n_ss, dtype=bool) if dummy_ss is None
+                         else np.asarray(dummy_ss, dtype=bool))
+        self.dummy_res = (np.zeros(n_res, dtype=bool) if dummy_res is None
+                          else np.asarray(dummy_res, dtype=bool))
+        self.res_n = np.full(n_res, np.nan) if res_n is None else np.asarray(res_n, dtype=float)
+        self.prev_res = np.full(n_res, -1) if prev_res is None else np.asarray(prev_res, dtype=int)
+        self.next_res = np.full(n_res, -1) if next_res is None else np.asarray(next_res, dtype=int)
+
+    @classmethod
+    def from_obs_preds(cls, obs, preds):
+        """Make the registry for prepared obs and preds DataFrames (as from
+        SNAPS_assigner.prepare_obs_preds())"""
+        res_names = pd.Index(preds.index)
+
+        def neighbour(col):
+            if col not in preds.columns:
+                return None
+            ids = res_names.get_indexer(preds[col])
+            ids[preds[col].isna().to_numpy()] = -1
+            return ids
+
+        def flag(df, col):
+            return df[col].eq(True).to_numpy() if col in df.columns else None
+
+        return cls(obs.index, res_names,
+                   dummy_ss=flag(obs, "Dummy_SS"),
+                   dummy_res=flag(preds, "Dummy_res"),
+                   res_n=preds["Res_N"].to_numpy(dtype=float) if "Res_N" in preds else None,
+                   prev_res=neighbour("Res_name_m1"),
+                   next_res=neighbour("Res_name_p1"))
+
+    @property
+    def n_ss(self):
+        return len(self.ss_names)
+
+    @property
+    def n_res(self):
+        return len(self.res_names)
+
+    def matches(self, matrix):
+        """True if a DataFrame has the spin systems as rows and the residues
+        as columns, in id order"""
+        return matrix.index.equals(self.ss_names) and matrix.columns.equals(self.res_names)
+
+    @staticmethod
+    def _ids(index, labels, kind):
+        ids = index.get_indexer(labels)
+        if (ids < 0).any():
+            missing = np.asarray(labels)[ids < 0]
+            raise KeyError("Unknown %s: %s" % (kind, ", ".join(map(str, missing[:5]))))
+        return ids
+
+    def ss_ids(self, labels):
+        """The ids of a sequence of spin system labels"""
+        return self._ids(self.ss_names, labels, "spin systems")
+
+    def res_ids(self, labels):
+        """The ids of a sequence of residue labels"""
+        return self._ids(self.res_names, labels, "residues")
+
+    def matching_ids(self, matching, row_name="SS_name", col_name="Res_name"):
+        """Convert a matching DataFrame to a tuple (ss_ids, res_ids)"""
+        return self.ss_ids(matching[row_name]), self.res_ids(matching[col_name])
+
+    def matching(self, ss_ids, res_ids, row_name="SS_name", col_name="Res_name", **columns):
+        """Attach labels to a matching given as arrays of ids
+
+        Returns
+        A DataFrame with row_name and col_name columns, plus any extra
+        columns given as keyword arguments
+        """
+        return pd.DataFrame({row_name: self.ss_names[np.asarray(ss_ids, dtype=int)],
+                             col_name: self.res_names[np.asarray(res_ids, dtype=int)],
+                             **columns})
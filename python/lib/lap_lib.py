@@ -0,0 +1,633 @@
+"""
+Linear assignment on rectangular cost matrices.
+
+SNAPS pads the smaller of the observed and predicted shift lists with dummy
+spin systems or residues, so that every real spin system/residue can be
+assigned. Since a dummy costs the same whichever real row or column it is
+paired with, the padding doesn't need to be built: the problem can be solved
+directly on the real (N x M) costs, with an implicit cost for each row or
+column that is left unassigned.
+"""
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+
+def solve_with_dummies(costs, n_dummy_rows=0, n_dummy_cols=0,
+                       row_dummy_cost=None, col_dummy_cost=None):
+    """Find the minimum cost assignment, allowing rows and columns to be left
+    unassigned (ie. assigned to an implicit dummy)
+
+    This gives the same optimum as padding costs with n_dummy_rows extra rows
+    and n_dummy_cols extra columns (with dummy/dummy pairs costing 0) and
+    solving the square problem. If only one side has dummies, which is the
+    usual case, no padding is needed. If neither does, this is an ordinary
+    rectangular assignment with as many pairs as possible.
+
+    Returns
+    A tuple (row_ind, col_ind) of the assigned real (row, col) pairs
+
+    Parameters
+    costs: (N x M) array of costs
+    n_dummy_rows, n_dummy_cols: number of dummy rows/columns available. If
+        either is non-zero, N + n_dummy_rows must equal M + n_dummy_cols.
+    row_dummy_cost: length N array with the cost of leaving each row
+        unassigned (default 0)
+    col_dummy_cost: length M array with the cost of leaving each column
+        unassigned (default 0)
+    """
+    costs = np.asarray(costs, dtype=float)
+    N, M = costs.shape
+    if row_dummy_cost is None:
+        row_dummy_cost = np.zeros(N)
+    if col_dummy_cost is None:
+        col_dummy_cost = np.zeros(M)
+    if (n_dummy_rows or n_dummy_cols) and N + n_dummy_rows != M + n_dummy_cols:
+        raise ValueError("Dummies do not make the assignment problem square")
+
+    if n_dummy_rows and n_dummy_cols:
+        # Real rows can be left unassigned even though there are unassigned
+        # real columns, so build the padded matrix.
+        size = N + n_dummy_rows
+        padded = np.zeros((size, size))
+        padded[:N, :M] = costs
+        padded[:N, M:] = np.asarray(row_dummy_cost)[:, np.newaxis]
+        padded[N:, :M] = np.asarray(col_dummy_cost)[np.newaxis, :]
+        row_ind, col_ind = linear_sum_assignment(padded)
+        real = (row_ind < N) & (col_ind < M)
+        return row_ind[real], col_ind[real]
+
+    # Every row (or column) on the smaller side is assigned, so only the
+    # dummy costs on the larger side matter. Since the number of unassigned
+    # columns is fixed, the total cost of sum(assigned) + sum(unassigned) can
+    # be rewritten as sum(col_dummy_cost) + sum(costs - col_dummy_cost) over
+    # the assigned pairs.
+    if N <= M:
+        return linear_sum_assignment(costs - np.asarray(col_dummy_cost)[np.newaxis, :])
+    else:
+        return linear_sum_assignment(costs - np.asarray(row_dummy_cost)[:, np.newaxis])
+
+
+def assignment_duals(costs, row_to_col, max_iter=None):
+    """Find dual potentials for an optimal assignment of a square cost matrix
+
+    With u[i] + v[j] <= costs[i, j] for every pair, and equality for the
+    assigned pairs, the reduced costs costs[i, j] - u[i] - v[j] are all
+    non-negative. This lets the assignment be repaired by a single augmenting
+    path search if some costs are increased (see DualAssignment).
+
+    The column potentials are shortest path distances in the graph with an
+    edge from column row_to_col[i] to column j of length
+    costs[i, j] - costs[i, row_to_col[i]], which are found by Bellman-Ford.
+
+    Returns
+    A tuple (u, v) of row and column potentials
+
+    Parameters
+    costs: (n x n) array of costs
+    row_to_col: length n array giving the column assigned to each row. This
+        must be an optimal assignment.
+    max_iter: limit on the number of Bellman-Ford iterations (default n+1)
+    """
+    costs = np.asarray(costs, dtype=float)
+    n = costs.shape[0]
+    assigned_costs = costs[np.arange(n), row_to_col]
+    # Ignore edges from forbidden (infinite cost) pairs
+    with np.errstate(invalid="ignore"):
+        edges = costs - assigned_costs[:, np.newaxis]
+    edges[~np.isfinite(edges)] = np.inf
+    tol = 1e-12 * max(1.0, np.abs(assigned_costs).max(initial=0))
+
+    v = np.zeros(n)
+    for _ in range(max_iter or n + 1):
+        new_v = np.minimum(v, (v[row_to_col][:, np.newaxis] + edges).min(axis=0, initial=np.inf))
+        converged = (v - new_v).max(initial=0) <= tol
+        v = new_v
+        if converged:
+            break
+    u = assigned_costs - v[row_to_col]
+    return u, v
+
+
+class DualAssignment:
+    """An optimal assignment of a square cost matrix, together with its dual
+    potentials, which can be cheaply updated when costs are changed.
+
+    Increasing the cost of pairs keeps the potentials feasible, so only the
+    rows whose assigned pair became more expensive need to be reassigned,
+    each with one O(n^2) shortest augmenting path search (as in the Hungarian
+    algorithm), rather than re-solving the whole O(n^3) problem. Decreasing
+    costs is handled in the same way, after lowering some potentials.
+    """
+
+    def __init__(self, costs, row_to_col=None, duals=None):
+        """
+        costs: (n x n) array of costs. A copy is kept.
+        row_to_col: optionally, an optimal assignment that is already known
+        duals: optionally, (u, v) potentials for row_to_col
+        """
+        self.costs = np.array(costs, dtype=float)
+        n, m = self.costs.shape
+        if n != m:
+            raise ValueError("DualAssignment needs a square cost matrix")
+        if row_to_col is None:
+            _, row_to_col = linear_sum_assignment(self.costs)
+        self.row_to_col = np.array(row_to_col, dtype=int)
+        self.col_to_row = np.empty(n, dtype=int)
+        self.col_to_row[self.row_to_col] = np.arange(n)
+        if duals is None:
+            duals = assignment_duals(self.costs, self.row_to_col)
+        self.u, self.v = (np.array(x, dtype=float) for x in duals)
+
+    def copy(self):
+        """Make an independent copy, so the costs can be changed without
+        affecting this one"""
+        new = DualAssignment.__new__(DualAssignment)
+        new.costs = self.costs.copy()
+        new.row_to_col = self.row_to_col.copy()
+        new.col_to_row = self.col_to_row.copy()
+        new.u = self.u.copy()
+        new.v = self.v.copy()
+        return new
+
+    def total_cost(self):
+        return self.costs[np.arange(len(self.row_to_col)), self.row_to_col].sum()
+
+    def set_costs(self, rows, cols, value):
+        """Change the costs of a block of pairs, and update the assignment
+
+        Assigned pairs within the block whose cost went up are removed. If any
+        costs went down, the potentials of the block's rows (or columns, if
+        there are fewer of them) are lowered until the reduced costs are
+        non-negative again, which doesn't affect any other reduced costs, and
+        the pairs which are no longer tight are removed too. The removed rows
+        are then reassigned by augmenting paths.
+
+        Parameters
+        rows, cols: sequences of row and column indices. The costs of every
+            (row, col) combination are changed.
+        value: the new cost (scalar, or an array broadcastable to the block)
+        """
+        block_rows, block_cols = np.atleast_1d(rows), np.atleast_1d(cols)
+        block = np.ix_(block_rows, block_cols)
+        old = self.costs[block]
+        new = np.broadcast_to(np.asarray(value, dtype=float), old.shape)
+        self.costs[block] = new
+
+        freed_rows = []
+        if (new < old).any():
+            if len(block_rows) <= len(block_cols):
+                lowest = (self.costs[block_rows] - self.v).min(axis=1)
+                lowered = lowest < self.u[block_rows]
+                self.u[block_rows[lowered]] = lowest[lowered]
+                freed_rows.append(block_rows[lowered])
+            else:
+                lowest = (self.costs[:, block_cols] - self.u[:, np.newaxis]).min(axis=0)
+                lowered = lowest < self.v[block_cols]
+                self.v[block_cols[lowered]] = lowest[lowered]
+                freed_rows.append(self.col_to_row[block_cols[lowered]])
+
+        # Unassign any assigned pairs whose cost went up
+        col_pos = np.full(len(self.row_to_col), -1)
+        col_pos[block_cols] = np.arange(len(block_cols))
+        pos = col_pos[self.row_to_col[block_rows]]
+        in_block = np.flatnonzero(pos >= 0)
+        increased = new[in_block, pos[in_block]] > old[in_block, pos[in_block]]
+        freed_rows.append(block_rows[in_block[increased]])
+
+        changed_rows = np.unique(np.concatenate(freed_rows))
+        for row in changed_rows:
+            self.col_to_row[self.row_to_col[row]] = -1
+            self.row_to_col[row] = -1
+        for row in changed_rows:
+            augment(self.costs, row, self.row_to_col, self.col_to_row, self.u, self.v)
+
+
+def augment(costs, row, row_to_col, col_to_row, u, v):
+    """Assign a free row by finding the shortest augmenting path in the
+    reduced costs (Dijkstra's algorithm), then update the potentials so they
+    stay feasible. The potentials are only updated once, at the end of the
+    search, following Crouse (2016) IEEE Trans. Aerosp. Electron. Syst.
+    52(4), 1679-1696.
+
+    row_to_col, col_to_row, u and v are updated in place. They are left
+    unchanged if there is no feasible assignment for the row.
+
+    Parameters
+    costs: (n x n) array of costs, which may include inf for forbidden pairs
+    row: the row to assign
+    row_to_col, col_to_row: the current assignment, with -1 for unassigned
+        rows and columns
+    u, v: feasible row and column potentials, tight for the assigned pairs
+    """
+    n = len(row_to_col)
+
+    # Path lengths to the columns still to be scanned (inf once scanned)
+    candidate = np.full(n, np.inf)
+    # Final path lengths to the scanned columns
+    path_length = np.zeros(n)
+    scanned = np.zeros(n, dtype=bool)
+    prev_row = np.full(n, -1)
+    tree_rows = []
+    min_length = 0.0
+    current_row = row
+    while True:
+        tree_rows.append(current_row)
+        lengths = costs[current_row] - v
+        lengths += min_length - u[current_row]
+        better = lengths < candidate
+        better[scanned] = False
+        candidate[better] = lengths[better]
+        prev_row[better] = current_row
+
+        col = int(np.argmin(candidate))
+        min_length = candidate[col]
+        if not np.isfinite(min_length):
+            raise ValueError("No feasible assignment for row %d" % row)
+        path_length[col] = min_length
+        candidate[col] = np.inf
+        scanned[col] = True
+        if col_to_row[col] == -1:
+            break
+        current_row = col_to_row[col]
+
+    # Update the potentials for the rows and columns in the search tree
+    u[row] += min_length
+    tree_rows = np.array(tree_rows[1:], dtype=int)
+    u[tree_rows] += min_length - path_length[row_to_col[tree_rows]]
+    v[scanned] -= min_length - path_length[scanned]
+
+    # Flip the assignments along the path
+    while True:
+        assigned_row = prev_row[col]
+        col_to_row[col] = assigned_row
+        row_to_col[assigned_row], col = col, row_to_col[assigned_row]
+        if assigned_row == row:
+            break
+
+
+def matching_with_dummies(row_to_col, dummy_rows, dummy_cols):
+    """Label a square assignment the way find_best_assignment() does, with
+    any real rows or columns that ended up with a dummy paired with the
+    dummies in order
+
+    Dummies are interchangeable, so which dummy a real row or column is paired
+    with in a square assignment is arbitrary. This puts the pairs in a
+    canonical order: real/real pairs by row, then unassigned real rows with
+    the first dummy columns, then the first dummy rows with unassigned real
+    columns, then any remaining dummy/dummy pairs.
+
+    Returns
+    A tuple (rows, cols) of index arrays
+
+    Parameters
+    row_to_col: length n array giving the column assigned to each row
+    dummy_rows, dummy_cols: length n boolean arrays marking the dummies
+    """
+    row_to_col = np.asarray(row_to_col)
+    dummy_rows = np.asarray(dummy_rows, dtype=bool)
+    dummy_cols = np.asarray(dummy_cols, dtype=bool)
+
+    real_pair = ~dummy_rows & ~dummy_cols[row_to_col]
+    unassigned_rows = np.flatnonzero(~dummy_rows & dummy_cols[row_to_col])
+    col_assigned = np.zeros(len(row_to_col), dtype=bool)
+    col_assigned[row_to_col[real_pair]] = True
+    unassigned_cols = np.flatnonzero(~dummy_cols & ~col_assigned)
+    spare_rows = np.flatnonzero(dummy_rows)
+    spare_cols = np.flatnonzero(dummy_cols)
+
+    rows = np.concatenate([np.flatnonzero(real_pair), unassigned_rows,
+                           spare_rows[:len(unassigned_cols)],
+                           spare_rows[len(unassigned_cols):]])
+    cols = np.concatenate([row_to_col[real_pair], spare_cols[:len(unassigned_rows)],
+                           unassigned_cols, spare_cols[len(unassigned_rows):]])
+    return rows.astype(int), cols.astype(int)
+
+
+class ConstraintOverlay:
+    """Fixed and forbidden pairs, and additive penalties, layered over a base
+    score matrix which is never copied or modified
+
+    Constraining a problem by copying the whole score matrix (and dropping the
+    fixed rows and columns) is slow for large proteins. Instead, the overlay
+    keeps the column each row is fixed to, and only allocates the forbidden
+    mask and penalty array once they're first used. A solver reads the scores
+    of just the free rows and columns it needs through scores().
+    """
+
+    def __init__(self, base):
+        """
+        base: (N x M) array of scores. This is referenced, not copied, so it
+            shouldn't be changed while the overlay is in use.
+        """
+        self.base = np.asarray(base, dtype=float)
+        N, M = self.base.shape
+        self.row_fixed = np.full(N, -1)
+        self.col_fixed = np.full(M, -1)
+        self.forbidden = None
+        self.penalty = None
+
+    @property
+    def shape(self):
+        return self.base.shape
+
+    def copy(self):
+        """Make an independent copy of the constraints, sharing the base"""
+        new = ConstraintOverlay.__new__(ConstraintOverlay)
+        new.base = self.base
+        new.row_fixed = self.row_fixed.copy()
+        new.col_fixed = self.col_fixed.copy()
+        new.forbidden = None if self.forbidden is None else self.forbidden.copy()
+        new.penalty = None if self.penalty is None else self.penalty.copy()
+        return new
+
+    def fix(self, rows, cols):
+        """Require each (row, col) pair to be part of the assignment"""
+        self.row_fixed[rows] = cols
+        self.col_fixed[cols] = rows
+
+    def forbid(self, rows, cols):
+        """Prevent each (row, col) pair from being part of the assignment"""
+        if self.forbidden is None:
+            self.forbidden = np.zeros(self.shape, dtype=bool)
+        self.forbidden[rows, cols] = True
+
+    def add_penalty(self, rows, cols, value):
+        """Add value to the score of each (row, col) pair. rows and cols are
+        broadcast together, as for numpy indexing."""
+        if self.penalty is None:
+            self.penalty = np.zeros(self.shape)
+        np.add.at(self.penalty, (rows, cols), value)
+
+    def free_rows(self):
+        return np.flatnonzero(self.row_fixed < 0)
+
+    def free_cols(self):
+        return np.flatnonzero(self.col_fixed < 0)
+
+    def fixed_pairs(self):
+        """The fixed pairs, as a tuple (rows, cols) of index arrays"""
+        rows = np.flatnonzero(self.row_fixed >= 0)
+        return rows, self.row_fixed[rows]
+
+    def scores(self, rows, cols):
+        """The penalised scores of a block of rows and columns, as a new array"""
+        block = np.ix_(rows, cols)
+        scores = self.base[block]
+        if self.penalty is not None:
+            scores += self.penalty[block]
+        return scores
+
+    def forbidden_block(self, rows, cols):
+        """The forbidden mask for a block of rows and columns, or None if
+        nothing is forbidden"""
+        if self.forbidden is None:
+            return None
+        return self.forbidden[np.ix_(rows, cols)]
+
+    def max_abs_score(self):
+        """An upper bound on the magnitude of any penalised score"""
+        bound = np.abs(self.base).max(initial=0)
+        if self.penalty is not None:
+            bound += np.abs(self.penalty).max(initial=0)
+        return bound
+
+
+class ConstraintSession:
+    """An optimal assignment that is kept up to date as pairs are fixed,
+    forbidden and released
+
+    Dummy rows and columns score 0 with everything, as in
+    SNAPS_assigner.find_best_assignment(), and are interchangeable: fixing a
+    row to a dummy column means the row must be paired with some dummy, and
+    forbidding it means the row can't be paired with any dummy (and likewise
+    for columns). Dummy/dummy pairs can't be constrained.
+
+    Constraints are applied by giving the pairs which break them a penalty
+    cost, larger than any difference the unconstrained costs can make, so
+    the assignment breaks as few constraints as possible. Each edit only
+    changes the costs in a few rows and columns, and the assignment is
+    repaired from the previous one by a DualAssignment, rather than solved
+    from scratch.
+    """
+
+    def __init__(self, costs, dummy_rows=None, dummy_cols=None):
+        """
+        costs: (n x n) array of costs. The costs of pairs with a dummy are
+            ignored.
+        dummy_rows, dummy_cols: length n boolean arrays marking the dummies
+        """
+        costs = np.array(costs, dtype=float)
+        n = costs.shape[0]
+        self.dummy_rows = (np.zeros(n, dtype=bool) if dummy_rows is None
+                           else np.asarray(dummy_rows, dtype=bool))
+        self.dummy_cols = (np.zeros(n, dtype=bool) if dummy_cols is None
+                           else np.asarray(dummy_cols, dtype=bool))
+        costs[self.dummy_rows, :] = 0
+        costs[:, self.dummy_cols] = 0
+        self.base = costs
+        self.penalty = 2 * n * np.abs(costs).max(initial=0) + 1
+        # The column (row) each row (column) is fixed to, or -1
+        self.row_fixed = np.full(n, -1)
+        self.col_fixed = np.full(n, -1)
+        # Forbidden real pairs (allocated when first needed), and the rows
+        # (columns) which can't be paired with a dummy
+        self.forbidden = None
+        self.no_dummy_row = np.zeros(n, dtype=bool)
+        self.no_dummy_col = np.zeros(n, dtype=bool)
+        self.solution = DualAssignment(costs)
+
+    @property
+    def n(self):
+        return len(self.base)
+
+    def _same(self, a, b, dummy):
+        """True where a and b are the same, counting all dummies as one"""
+        return (a == b) | (dummy[a] & dummy[b])
+
+    def constrained_costs(self, rows, cols):
+        """The costs of a block of pairs, including the constraint penalties"""
+        rows, cols = np.atleast_1d(rows), np.atleast_1d(cols)
+        costs = self.base[np.ix_(rows, cols)]
+        r, c = rows[:, np.newaxis], cols[np.newaxis, :]
+        row_fixed, col_fixed = self.row_fixed[r], self.col_fixed[c]
+        broken = (row_fixed >= 0) & ~self._same(row_fixed, c, self.dummy_cols)
+        broken |= (col_fixed >= 0) & ~self._same(col_fixed, r, self.dummy_rows)
+        broken |= self.no_dummy_row[r] & self.dummy_cols[c]
+        broken |= self.no_dummy_col[c] & self.dummy_rows[r]
+        if self.forbidden is not None:
+            broken |= self.forbidden[r, c]
+        costs[broken] = self.penalty
+        return costs
+
+    def _update(self, rows=(), cols=()):
+        """Recalculate the costs of whole rows and columns, and repair the
+        assignment"""
+        every = np.arange(self.n)
+        rows = np.unique(np.asarray(rows, dtype=int))
+        cols = np.unique(np.asarray(cols, dtype=int))
+        rows, cols = rows[rows >= 0], cols[cols >= 0]
+        if len(rows):
+            self.solution.set_costs(rows, every, self.constrained_costs(rows, every))
+        if len(cols):
+            self.solution.set_costs(every, cols, self.constrained_costs(every, cols))
+
+    def _unfix_row(self, row):
+        """Remove any fixed pair for a real row, and return its column"""
+        col = self.row_fixed[row]
+        if col >= 0 and self.col_fixed[col] == row:
+            self.col_fixed[col] = -1
+        self.row_fixed[row] = -1
+        return col
+
+    def _unfix_col(self, col):
+        """Remove any fixed pair for a real column, and return its row"""
+        row = self.col_fixed[col]
+        if row >= 0 and self.row_fixed[row] == col:
+            self.row_fixed[row] = -1
+        self.col_fixed[col] = -1
+        return row
+
+    def fix(self, row, col):
+        """Require (row, col) to be part of the assignment, replacing any
+        other fixed pair for the row or column"""
+        dummy_row, dummy_col = self.dummy_rows[row], self.dummy_cols[col]
+        rows, cols = [], []
+        if not dummy_row:
+            cols.append(self._unfix_row(row))
+            rows.append(row)
+        if not dummy_col:
+            rows.append(self._unfix_col(col))
+            cols.append(col)
+        if dummy_row and dummy_col:
+            return
+        elif dummy_col:
+            self.row_fixed[row] = col
+            self.no_dummy_row[row] = False
+        elif dummy_row:
+            self.col_fixed[col] = row
+            self.no_dummy_col[col] = False
+        else:
+            self.row_fixed[row] = col
+            self.col_fixed[col] = row
+            if self.forbidden is not None:
+                self.forbidden[row, col] = False
+        self._update(rows, cols)
+
+    def forbid(self, row, col):
+        """Prevent (row, col) from being part of the assignment, releasing it
+        if it was fixed"""
+        dummy_row, dummy_col = self.dummy_rows[row], self.dummy_cols[col]
+        if dummy_row and dummy_col:
+            return
+        self.release(row, col, update=False)
+        if dummy_col:
+            self.no_dummy_row[row] = True
+        elif dummy_row:
+            self.no_dummy_col[col] = True
+        else:
+            if self.forbidden is None:
+                self.forbidden = np.zeros((self.n, self.n), dtype=bool)
+            self.forbidden[row, col] = True
+        self._update([] if dummy_row else [row], [] if dummy_col else [col])
+
+    def release(self, row=None, col=None, update=True):
+        """Remove constraints
+
+        With both row and col, removes any constraint on that pair. With only
+        one of them, removes every constraint on that row or column. With
+        neither, removes all constraints.
+        """
+        if row is None and col is None:
+            self.row_fixed[:] = -1
+            self.col_fixed[:] = -1
+            self.forbidden = None
+            self.no_dummy_row[:] = False
+            self.no_dummy_col[:] = False
+            if update:
+                self.solution = DualAssignment(self.base)
+            return
+
+        rows, cols = [], []
+        if col is None:
+            if self.dummy_rows[row]:
+                cols = np.flatnonzero(self.col_fixed == row)
+                self.col_fixed[cols] = -1
+            else:
+                rows = [row]
+                cols = [self._unfix_row(row)]
+                self.no_dummy_row[row] = False
+                if self.forbidden is not None:
+                    self.forbidden[row] = False
+        elif row is None:
+            if self.dummy_cols[col]:
+                rows = np.flatnonzero(self.row_fixed == col)
+                self.row_fixed[rows] = -1
+            else:
+                cols = [col]
+                rows = [self._unfix_col(col)]
+                self.no_dummy_col[col] = False
+                if self.forbidden is not None:
+                    self.forbidden[:, col] = False
+        else:
+            dummy_row, dummy_col = self.dummy_rows[row], self.dummy_cols[col]
+            if not dummy_row and self._same(self.row_fixed[row], col, self.dummy_cols):
+                cols.append(self._unfix_row(row))
+                rows.append(row)
+            if not dummy_col and self._same(self.col_fixed[col], row, self.dummy_rows):
+                rows.append(self._unfix_col(col))
+                cols.append(col)
+            if dummy_col and not dummy_row:
+                self.no_dummy_row[row] = False
+                rows.append(row)
+            elif dummy_row and not dummy_col:
+                self.no_dummy_col[col] = False
+                cols.append(col)
+            elif not dummy_row and self.forbidden is not None and self.forbidden[row, col]:
+                self.forbidden[row, col] = False
+                rows.append(row)
+        if update:
+            self._update(rows, cols)
+
+    def constraints(self):
+        """The current constraints
+
+        Returns
+        A tuple (fixed, forbidden), each a tuple (rows, cols) of index arrays.
+        Rows and columns fixed to a dummy are given different dummies, in
+        order. Forbidden pairs involving dummies use the first dummy row or
+        column.
+        """
+        first_dummy_row = np.argmax(self.dummy_rows)
+        first_dummy_col = np.argmax(self.dummy_cols)
+        fixed_rows = np.flatnonzero(self.row_fixed >= 0)
+        fixed_cols = self.row_fixed[fixed_rows]
+        dummy_fixed = self.dummy_cols[fixed_cols]
+        fixed_cols[dummy_fixed] = np.resize(np.flatnonzero(self.dummy_cols), dummy_fixed.sum())
+        extra_cols = np.flatnonzero((self.col_fixed >= 0) & ~self.dummy_cols)
+        extra_cols = extra_cols[self.dummy_rows[self.col_fixed[extra_cols]]]
+        fixed = (np.concatenate([fixed_rows,
+                                 np.resize(np.flatnonzero(self.dummy_rows), len(extra_cols))]),
+                 np.concatenate([fixed_cols, extra_cols]))
+
+        if self.forbidden is None:
+            forbidden_rows = forbidden_cols = np.empty(0, dtype=int)
+        else:
+            forbidden_rows, forbidden_cols = np.nonzero(self.forbidden)
+        no_dummy_rows = np.flatnonzero(self.no_dummy_row)
+        no_dummy_cols = np.flatnonzero(self.no_dummy_col)
+        forbidden = (np.concatenate([forbidden_rows, no_dummy_rows,
+                                     np.full(len(no_dummy_cols), first_dummy_row)]),
+                     np.concatenate([forbidden_cols, np.full(len(no_dummy_rows), first_dummy_col),
+                                     no_dummy_cols]))
+        return (fixed[0].astype(int), fixed[1].astype(int)), \
+            (forbidden[0].astype(int), forbidden[1].astype(int))
+
+    def pairs(self):
+        """The current assignment, labelled as by matching_with_dummies()"""
+        return matching_with_dummies(self.solution.row_to_col, self.dummy_rows, self.dummy_cols)
+
+    def broken(self):
+        """The rows whose assigned pair breaks a constraint (which only
+        happens if the constraints can't all be satisfied)"""
+        row_to_col = self.solution.row_to_col
+        return np.flatnonzero(self.solution.costs[np.arange(self.n), row_to_col] >= self.penalty)
@@ -0,0 +1,199 @@
+"""
+Sparse index of the sequential links between spin systems.
+
+Spin system a can precede spin system b if the i shifts of a match the i-1
+shifts of b. SNAPS_assigner.calc_mismatch_matrix() stores the largest
+mismatch for every (a, b) pair in dense matrices, but only pairs within the
+link threshold (normally 0.2 ppm) matter for the assignment confidence, and
+these are a small fraction of the pairs.
+
+The index finds the candidate partners for each carbon type by sorting the
+i-1 shifts and searching a window around each i shift, which takes
+O(N log N + links) rather than O(N^2). Only the consistent pairs are kept,
+in compressed sparse row form. Mismatches for any other pairs (eg. the
+links of an assignment) are calculated directly from the shifts when needed.
+
+The mismatch of a pair is the largest absolute difference over the carbon
+types which both spin systems have, or 0 if they have none in common, as in
+calc_mismatch_matrix().
+"""
+import numpy as np
+from scipy import sparse
+
+
+class LinkIndex:
+    """The consistent sequential links between n spin systems
+
+    A pair (a, b) is consistent if the spin systems have at least one carbon
+    type in common, and its mismatch is at most window. indptr and indices
+    give the consistent partners b of each a, in compressed sparse row form,
+    with mismatch and n_links holding the mismatch and the number of carbon
+    types which agree to within window (strictly) for each pair.
+    """
+
+    def __init__(self, i_shifts, i_m1_shifts, window=0.2):
+        """
+        i_shifts, i_m1_shifts: (n x k) arrays of the i and i-1 shifts of each
+            spin system, for k carbon types, with NaN for missing shifts
+        window: the largest mismatch for a consistent link
+        """
+        self.i_shifts = np.asarray(i_shifts, dtype=float)
+        self.i_m1_shifts = np.asarray(i_m1_shifts, dtype=float)
+        self.window = window
+        n = self.n
+
+        # Find the candidate pairs for each carbon type by a window search
+        # over the sorted i-1 shifts. The window is widened slightly, as the
+        # exact mismatches are checked below.
+        margin = window * (1 + 1e-9) + 1e-12
+        candidates = []
+        for k in range(self.i_shifts.shape[1]):
+            x, y = self.i_shifts[:, k], self.i_m1_shifts[:, k]
+            rows = np.flatnonzero(~np.isnan(x))
+            cols = np.flatnonzero(~np.isnan(y))
+            cols = cols[np.argsort(y[cols], kind="stable")]
+            lo = np.searchsorted(y[cols], x[rows] - margin, side="left")
+            hi = np.searchsorted(y[cols], x[rows] + margin, side="right")
+            counts = hi - lo
+            offsets = np.cumsum(counts) - counts
+            positions = np.repeat(lo - offsets, counts) + np.arange(counts.sum())
+            candidates.append(np.repeat(rows, counts) * n + cols[positions])
+        pairs = np.unique(np.concatenate(candidates + [np.empty(0, dtype=int)]))
+        rows, cols = pairs // n, pairs % n
+
+        mismatch, n_links = self.pair_stats(rows, cols)
+        keep = mismatch <= window
+        rows, cols = rows[keep], cols[keep]
+        self.indices = cols
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n))])
+        self.mismatch = mismatch[keep]
+        self.n_links = n_links[keep]
+
+        # The same pairs in column order, for looking up the partners of b
+        self._col_order = np.lexsort((rows, cols))
+        self._col_indptr = np.concatenate([[0], np.cumsum(np.bincount(cols, minlength=n))])
+        self._col_rows = rows[self._col_order]
+
+    @property
+    def n(self):
+        return len(self.i_shifts)
+
+    @property
+    def nnz(self):
+        return len(self.indices)
+
+    def pair_stats(self, rows, cols, threshold=None):
+        """The mismatch and number of good links for any pairs of spin systems
+
+        Returns
+        A tuple (mismatch, n_links) of arrays
+
+        Parameters
+        rows, cols: arrays of the first and second spin system of each pair
+        threshold: the cutoff for a good link (default window). As the stats
+            are calculated from the shifts, this can be larger than window.
+        """
+        threshold = self.window if threshold is None else threshold
+        diff = self.pair_differences(rows, cols)
+        with np.errstate(invalid="ignore"):
+            n_links = (diff < threshold).sum(axis=1)
+        mismatch = np.fmax.reduce(diff, axis=1, initial=0) if diff.size else np.zeros(len(diff))
+        return mismatch, n_links
+
+    def pair_differences(self, rows, cols):
+        """The absolute differences between the i shifts of rows and the i-1
+        shifts of cols, for each carbon type
+
+        Returns
+        An (m x k) array, with NaN where either shift is missing
+        """
+        return np.abs(self.i_shifts[rows] - self.i_m1_shifts[cols])
+
+    def shared_matrix(self):
+        """Which pairs of spin systems have at least one carbon type in common
+
+        Returns
+        An (n x n) boolean array. Where it's False, the pair has a mismatch
+        of 0 because there's nothing to compare, not because the shifts agree.
+        """
+        has_i = (~np.isnan(self.i_shifts)).astype(float)
+        has_i_m1 = (~np.isnan(self.i_m1_shifts)).astype(float)
+        return (has_i @ has_i_m1.T) > 0
+
+    def csr(self, values=None):
+        """The consistent links as a scipy.sparse.csr_matrix
+
+        Parameters
+        values: data for each stored pair (default the mismatches)
+        """
+        values = self.mismatch if values is None else values
+        return sparse.csr_matrix((values, self.indices, self.indptr), shape=(self.n, self.n))
+
+    def _check_threshold(self, threshold):
+        if threshold > self.window:
+            raise ValueError("threshold %g is larger than the window of the link index (%g)"
+                             % (threshold, self.window))
+
+    def _shares_shifts(self, i_rows, i_m1_rows):
+        """True for pairs with at least one carbon type in common"""
+        return (~np.isnan(self.i_shifts[i_rows]) & ~np.isnan(self.i_m1_shifts[i_m1_rows])).any(
+            axis=-1)
+
+    def allowed_prev(self, b, threshold):
+        """Which spin systems a have a mismatch with b of at most threshold,
+        so could precede b
+
+        Returns
+        A length n boolean array
+        """
+        self._check_threshold(threshold)
+        allowed = ~self._shares_shifts(slice(None), b)
+        start, end = self._col_indptr[b], self._col_indptr[b + 1]
+        pos = self._col_order[start:end]
+        allowed[self._col_rows[start:end][self.mismatch[pos] <= threshold]] = True
+        return allowed
+
+    def allowed_next(self, a, threshold):
+        """Which spin systems b have a mismatch with a of at most threshold,
+        so could follow a
+
+        Returns
+        A length n boolean array
+        """
+        self._check_threshold(threshold)
+        allowed = ~self._shares_shifts(a, slice(None))
+        start, end = self.indptr[a], self.indptr[a + 1]
+        allowed[self.indices[start:end][self.mismatch[start:end] <= threshold]] = True
+        return allowed
+
+
+def threshold_sweep(diff, thresholds):
+    """The number of good links and whether the mismatch is too large, for
+    each link at several thresholds
+
+    Each difference is located among the sorted thresholds once, and the
+    counts at every threshold then follow from a cumulative sum, rather than
+    comparing all the differences again for each threshold.
+
+    Returns
+    A tuple (n_links, mismatched) of (m x T) arrays, giving the number of
+    differences below each threshold, and whether the largest difference is
+    above it
+
+    Parameters
+    diff: (m x k) array of absolute shift differences for m links, with NaN
+        where either shift is missing (as from LinkIndex.pair_differences())
+    thresholds: length T array of thresholds, in increasing order
+    """
+    thresholds = np.asarray(thresholds, dtype=float)
+    m, T = len(diff), len(thresholds)
+    # A difference counts as a good link at every threshold from pos on.
+    # NaN sorts after all the thresholds, so never counts.
+    pos = np.searchsorted(thresholds, diff, side="right")
+    counts = np.zeros((m, T + 1), dtype=int)
+    np.add.at(counts, (np.repeat(np.arange(m), diff.shape[1]), pos.ravel()), 1)
+    n_links = np.cumsum(counts, axis=1)[:, :T]
+
+    mismatch = np.fmax.reduce(diff, axis=1, initial=0) if diff.size else np.zeros(m)
+    mismatched = np.arange(T) < np.searchsorted(thresholds, mismatch, side="left")[:, np.newaxis]
+    return n_links, mismatched
@@ -0,0 +1,281 @@
+"""
+Sampling assignments by Markov chain Monte Carlo, with parallel tempering.
+
+The state is a permutation of a square log probability matrix (spin systems
+by residues, including any dummies), and each move swaps the residues of two
+spin systems. The score of an assignment is the sum of the log probabilities
+of its pairs, plus an optional sequential link term for each pair of
+adjacent residues, so a swap only changes a handful of terms and its score
+difference is calculated in constant time.
+
+Several chains are run at different temperatures, and neighbouring chains
+periodically try to exchange their states (Swendsen & Wang (1986) Phys. Rev.
+Lett. 57(21), 2607-2609). The hot chains cross between well separated
+assignments easily, and pass them down to the cold chain, which is the one
+sampled. The chains run in rounds of a fixed number of steps, and each round
+can run the chains in separate processes.
+"""
+import random
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from math import exp
+from time import monotonic
+
+import numpy as np
+
+TemperingResult = namedtuple("TemperingResult",
+                             ["visit_freq", "score_trace", "ess", "acceptance_rate",
+                              "exchange_rate", "n_rounds", "best_score", "best_row_to_col"])
+TemperingResult.__doc__ = """Results of parallel_tempering()
+
+visit_freq: (n x n) array with the fraction of the cold chain's steps each
+    row spent paired with each column
+score_trace: the cold chain's score, every thin steps
+ess: effective sample size of score_trace
+acceptance_rate: fraction of swap moves accepted, for each temperature
+exchange_rate: fraction of exchanges accepted, for each pair of
+    neighbouring temperatures
+n_rounds: number of rounds run
+best_score, best_row_to_col: the highest scoring assignment seen by any chain
+"""
+
+
+class SwapProblem:
+    """The scores needed to evaluate swap moves, as nested lists (which are
+    quicker than numpy arrays for looking up one element at a time)"""
+
+    def __init__(self, log_prob, prev_col=None, link_log_prob=None):
+        """
+        log_prob: (n x n) array of log probabilities
+        prev_col: length n array giving the column which precedes each
+            column in the sequence, or -1 if there isn't one. Only needed
+            for the link terms.
+        link_log_prob: optional (n x n) array. link_log_prob[a, b] is added
+            to the score if row a is paired with the column preceding row b's
+            column.
+        """
+        log_prob = np.asarray(log_prob, dtype=float)
+        self.n = len(log_prob)
+        self.log_prob = log_prob.tolist()
+        self.prev_col = None
+        self.next_col = None
+        self.link_log_prob = None
+        if link_log_prob is not None:
+            prev_col = np.asarray(prev_col, dtype=int)
+            next_col = np.full(self.n, -1)
+            has_prev = prev_col >= 0
+            next_col[prev_col[has_prev]] = np.flatnonzero(has_prev)
+            self.prev_col = prev_col.tolist()
+            self.next_col = next_col.tolist()
+            self.link_log_prob = np.asarray(link_log_prob, dtype=float).tolist()
+
+    def score(self, row_to_col):
+        """The total score of an assignment"""
+        row_to_col = np.asarray(row_to_col)
+        log_prob = np.array(self.log_prob)
+        total = log_prob[np.arange(self.n), row_to_col].sum()
+        if self.link_log_prob is not None:
+            col_to_row = np.empty(self.n, dtype=int)
+            col_to_row[row_to_col] = np.arange(self.n)
+            cols = np.flatnonzero(np.array(self.prev_col) >= 0)
+            prev_rows = col_to_row[np.array(self.prev_col)[cols]]
+            total += np.array(self.link_log_prob)[prev_rows, col_to_row[cols]].sum()
+        return float(total)
+
+    def _links(self, cols, col_to_row):
+        """Sum the link terms involving any of the columns"""
+        prev_col, next_col, link = self.prev_col, self.next_col, self.link_log_prob
+        pairs = set()
+        for col in cols:
+            if prev_col[col] >= 0:
+                pairs.add((prev_col[col], col))
+            if next_col[col] >= 0:
+                pairs.add((col, next_col[col]))
+        return sum(link[col_to_row[a]][col_to_row[b]] for a, b in pairs)
+
+    def run_chain(self, row_to_col, score, beta, n_steps, seed, thin=100, record=False):
+        """Run n_steps swap moves at inverse temperature beta
+
+        Returns
+        A tuple (row_to_col, score, n_accepted, visits, trace, best_score,
+        best_row_to_col). visits is None unless record is True, in which case
+        it's a dict mapping (row, col) to the number of steps spent in that
+        pair. trace is the score every thin steps.
+        """
+        n = self.n
+        log_prob = self.log_prob
+        has_links = self.link_log_prob is not None
+        rng = random.Random(seed)
+        randrange, uniform = rng.randrange, rng.random
+        row_to_col = list(row_to_col)
+        col_to_row = [0] * n
+        for row, col in enumerate(row_to_col):
+            col_to_row[col] = row
+        since = [0] * n
+        visits = {} if record else None
+        trace = []
+        best_score, best_row_to_col = score, list(row_to_col)
+        n_accepted = 0
+
+        for step in range(n_steps):
+            if step % thin == 0:
+                trace.append(score)
+            r1 = randrange(n)
+            r2 = randrange(n - 1)
+            if r2 >= r1:
+                r2 += 1
+            c1, c2 = row_to_col[r1], row_to_col[r2]
+            delta = log_prob[r1][c2] + log_prob[r2][c1] - log_prob[r1][c1] - log_prob[r2][c2]
+            if has_links:
+                delta -= self._links((c1, c2), col_to_row)
+                col_to_row[c1], col_to_row[c2] = r2, r1
+                delta += self._links((c1, c2), col_to_row)
+                col_to_row[c1], col_to_row[c2] = r1, r2
+            if not (delta >= 0 or uniform() < exp(beta * delta)):
+                continue
+
+            if record:
+                for row, col in ((r1, c1), (r2, c2)):
+                    visits[row, col] = visits.get((row, col), 0) + step - since[row]
+                    since[row] = step
+            row_to_col[r1], row_to_col[r2] = c2, c1
+            col_to_row[c1], col_to_row[c2] = r2, r1
+            score += delta
+            n_accepted += 1
+            if score > best_score:
+                best_score, best_row_to_col = score, list(row_to_col)
+
+        if record:
+            for row, col in enumerate(row_to_col):
+                visits[row, col] = visits.get((row, col), 0) + n_steps - since[row]
+        return row_to_col, score, n_accepted, visits, trace, best_score, best_row_to_col
+
+
+def effective_sample_size(trace):
+    """Estimate the effective sample size of a trace, using Geyer's initial
+    positive sequence estimator of the autocorrelation time
+
+    Returns
+    The effective sample size, or nan if the trace is constant
+    """
+    x = np.asarray(trace, dtype=float)
+    n = len(x)
+    if n < 4 or np.var(x) == 0:
+        return np.nan
+    x = x - x.mean()
+    # Autocorrelation by FFT, zero padded to avoid wrapping around
+    spectrum = np.fft.rfft(x, 2 * n)
+    acf = np.fft.irfft(spectrum * np.conj(spectrum))[:n]
+    acf /= acf[0]
+    # Sum consecutive pairs of autocorrelations while they stay positive
+    pair_sums = acf[:n - n % 2].reshape(-1, 2).sum(axis=1)
+    negative = np.flatnonzero(pair_sums <= 0)
+    n_pairs = negative[0] if len(negative) else len(pair_sums)
+    tau = -1 + 2 * pair_sums[:n_pairs].sum()
+    return n / max(tau, 1e-12)
+
+
+# The problem for the current worker process, set by _init_worker
+_worker_problem = None
+
+
+def _init_worker(problem):
+    global _worker_problem
+    _worker_problem = problem
+
+
+def _run_chain(task):
+    return _worker_problem.run_chain(*task)
+
+
+def parallel_tempering(problem, start, temperatures=(1, 2, 4, 8), steps_per_round=10000,
+                       n_rounds=None, time_budget=None, n_jobs=1, seed=None, thin=100):
+    """Sample assignments with parallel tempering
+
+    The run stops after n_rounds rounds, or when time_budget seconds have
+    passed, whichever comes first. Given the seed and number of rounds, the
+    results don't depend on n_jobs.
+
+    Returns
+    A TemperingResult
+
+    Parameters
+    problem: a SwapProblem
+    start: length n array giving the starting column for each row (eg. the
+        optimal assignment). All chains start here.
+    temperatures: temperature of each chain, in increasing order. Only the
+        first chain (normally at temperature 1) is sampled.
+    steps_per_round: number of swap moves each chain makes between exchanges
+    n_rounds, time_budget: when to stop. At least one must be given.
+    n_jobs: number of worker processes to run the chains in
+    seed: seed for the random number generator
+    thin: interval between the steps recorded in score_trace
+    """
+    if n_rounds is None and time_budget is None:
+        raise ValueError("Either n_rounds or time_budget is needed")
+    start_time = monotonic()
+    n = problem.n
+    betas = [1 / t for t in temperatures]
+    n_chains = len(betas)
+    rng = np.random.default_rng(seed)
+
+    states = [(list(start), problem.score(start)) for _ in betas]
+    visits = np.zeros((n, n))
+    trace = []
+    n_accepted = np.zeros(n_chains)
+    n_exchanges = np.zeros(max(n_chains - 1, 0))
+    n_exchange_attempts = np.zeros(max(n_chains - 1, 0))
+    best_score, best_row_to_col = states[0][1], list(start)
+
+    executor = (ProcessPoolExecutor(n_jobs, initializer=_init_worker, initargs=(problem,))
+                if n_jobs > 1 else None)
+    try:
+        round_number = 0
+        while n_rounds is None or round_number < n_rounds:
+            seeds = rng.integers(2**63, size=n_chains).tolist()
+            tasks = [(row_to_col, score, beta, steps_per_round, chain_seed, thin, i == 0)
+                     for i, ((row_to_col, score), beta, chain_seed)
+                     in enumerate(zip(states, betas, seeds))]
+            if executor is None:
+                results = [problem.run_chain(*task) for task in tasks]
+            else:
+                results = list(executor.map(_run_chain, tasks))
+
+            for i, (row_to_col, score, accepted, chain_visits, chain_trace,
+                    chain_best, chain_best_row_to_col) in enumerate(results):
+                states[i] = (row_to_col, score)
+                n_accepted[i] += accepted
+                if chain_best > best_score:
+                    best_score, best_row_to_col = chain_best, chain_best_row_to_col
+                if i == 0:
+                    rows, cols = zip(*chain_visits.keys())
+                    np.add.at(visits, (list(rows), list(cols)), list(chain_visits.values()))
+                    trace.extend(chain_trace)
+
+            # Try to exchange the states of neighbouring chains, alternating
+            # between the odd and even pairs
+            for i in range(round_number % 2, n_chains - 1, 2):
+                n_exchange_attempts[i] += 1
+                log_ratio = (betas[i] - betas[i + 1]) * (states[i + 1][1] - states[i][1])
+                if log_ratio >= 0 or rng.random() < exp(log_ratio):
+                    states[i], states[i + 1] = states[i + 1], states[i]
+                    n_exchanges[i] += 1
+
+            round_number += 1
+            if time_budget is not None and monotonic() - start_time >= time_budget:
+                break
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    with np.errstate(invalid="ignore"):
+        exchange_rate = n_exchanges / n_exchange_attempts
+    return TemperingResult(visit_freq=visits / (round_number * steps_per_round),
+                           score_trace=np.array(trace),
+                           ess=effective_sample_size(trace),
+                           acceptance_rate=n_accepted / (round_number * steps_per_round),
+                           exchange_rate=exchange_rate,
+                           n_rounds=round_number,
+                           # Recalculated, as the chains' scores are running totals
+                           best_score=problem.score(best_row_to_col),
+                           best_row_to_col=np.array(best_row_to_col))
@@ -0,0 +1,203 @@
+"""
+A process-wide registry of the model files used by SNAPS_assigner.
+
+The config file, the delta correlation mean/covariance files and the
+prediction correction file are each loaded, validated and pre-processed once,
+and then shared between all assigners in the process (eg. batch jobs, or the
+web app). An entry is reloaded if the modification time or size of any of its
+files changes and the file contents are also different.
+"""
+import hashlib
+import io
+import os
+import threading
+from copy import deepcopy
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from lib.scoring_lib import snaps_atom_name, marginal_factor, compile_pred_correction
+
+
+class CorrelationModel:
+    """Mean and covariance of the prediction errors, for the
+    delta_correlation method"""
+
+    def __init__(self, d_mean, d_cov):
+        """
+        d_mean: Series of mean prediction errors, indexed by atom type
+        d_cov: DataFrame containing the covariance matrix, with atom types
+            as the index and columns
+        """
+        d_mean = d_mean.rename(index=snaps_atom_name).astype(float)
+        d_cov = d_cov.rename(index=snaps_atom_name, columns=snaps_atom_name).astype(float)
+
+        if set(d_cov.index) != set(d_cov.columns) or set(d_cov.index) != set(d_mean.index):
+            raise ValueError("delta_correlation mean and covariance files must "
+                             "contain the same atom types")
+        d_cov = d_cov.loc[d_mean.index, d_mean.index]
+        cov = d_cov.to_numpy()
+        if not np.allclose(cov, cov.T):
+            raise ValueError("delta_correlation covariance matrix is not symmetric")
+        try:
+            np.linalg.cholesky(cov)
+        except np.linalg.LinAlgError:
+            raise ValueError("delta_correlation covariance matrix is not positive definite")
+
+        self.d_mean = d_mean
+        self.d_cov = d_cov
+        self._subsets = {}
+        self._lock = threading.Lock()
+
+    def arrays(self, atoms):
+        """Get the model for a list of atom types
+
+        Returns
+        A tuple (d_mean, d_cov, factors), where d_mean and d_cov are arrays
+        with the atoms in the order given, and factors is a dict of
+        marginal_factor() results for use with correlated_log_prob(). The
+        factor for the full set of atoms is precomputed.
+
+        Parameters
+        atoms: list of atom types
+        """
+        key = tuple(atoms)
+        with self._lock:
+            if key not in self._subsets:
+                missing = set(atoms) - set(self.d_mean.index)
+                if missing:
+                    raise ValueError("No delta_correlation parameters for atom types: %s"
+                                     % ", ".join(sorted(missing)))
+                d_mean = self.d_mean.loc[list(atoms)].to_numpy()
+                d_cov = self.d_cov.loc[list(atoms), list(atoms)].to_numpy()
+                factors = {0: marginal_factor(d_cov, 0)}
+                self._subsets[key] = (d_mean, d_cov, factors)
+            return self._subsets[key]
+
+
+class CorrectionModel:
+    """Linear model parameters for correcting the predicted shifts"""
+
+    REQUIRED_COLUMNS = {"Atom_type", "Res_type", "Grad", "Offset"}
+
+    def __init__(self, lm_pars):
+        """
+        lm_pars: DataFrame with Atom_type, Res_type, Grad and Offset columns
+        """
+        missing = self.REQUIRED_COLUMNS - set(lm_pars.columns)
+        if missing:
+            raise ValueError("pred_correction file is missing columns: %s"
+                             % ", ".join(sorted(missing)))
+        if lm_pars[["Grad", "Offset"]].isna().any().any():
+            raise ValueError("pred_correction file has missing Grad/Offset values")
+
+        self.lm_pars = lm_pars
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def tables(self, atoms):
+        """Get the (grad, offset) lookup tables from compile_pred_correction()
+        for a list of atom types"""
+        key = tuple(atoms)
+        with self._lock:
+            if key not in self._tables:
+                self._tables[key] = compile_pred_correction(self.lm_pars, atoms)
+            return self._tables[key]
+
+
+def _parse_config(contents):
+    return yaml.safe_load(contents[0])
+
+
+def _parse_correlation_model(contents):
+    mean_contents, cov_contents = contents
+    d_mean = pd.read_csv(io.BytesIO(mean_contents), header=None, index_col=0)[1]
+    d_cov = pd.read_csv(io.BytesIO(cov_contents), index_col=0)
+    return CorrelationModel(d_mean, d_cov)
+
+
+def _parse_correction_model(contents):
+    return CorrectionModel(pd.read_csv(io.BytesIO(contents[0]), index_col=0))
+
+
+class _Entry:
+    def __init__(self, stats, digests, value):
+        self.stats = stats
+        self.digests = digests
+        self.value = value
+
+
+class ModelRegistry:
+    """Cache of parsed model files, keyed by file path"""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def config(self, filename):
+        """Get the parameters from a YAML config file
+
+        Returns
+        A new copy of the parsed dictionary, which the caller is free to modify
+        """
+        return deepcopy(self._get("config", [filename], _parse_config))
+
+    def correlation_model(self, mean_file, cov_file):
+        """Get the CorrelationModel for a delta_correlation mean/cov file pair"""
+        return self._get("correlation", [mean_file, cov_file], _parse_correlation_model)
+
+    def correction_model(self, filename):
+        """Get the CorrectionModel for a pred_correction file"""
+        return self._get("correction", [filename], _parse_correction_model)
+
+    def correlation_digests(self, mean_file, cov_file):
+        """SHA-1 digests of the files of correlation_model(), which is loaded
+        if it isn't already"""
+        return list(self._entry("correlation", [mean_file, cov_file],
+                                _parse_correlation_model).digests)
+
+    def correction_digests(self, filename):
+        """SHA-1 digest of the file of correction_model(), which is loaded if
+        it isn't already"""
+        return list(self._entry("correction", [filename], _parse_correction_model).digests)
+
+    def clear(self):
+        """Remove all cached models"""
+        with self._lock:
+            self._entries.clear()
+
+    def _get(self, kind, filenames, parse):
+        return self._entry(kind, filenames, parse).value
+
+    def _entry(self, kind, filenames, parse):
+        paths = [str(Path(f).resolve()) for f in filenames]
+        key = (kind,) + tuple(paths)
+        stats = [self._stat(p) for p in paths]
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.stats == stats:
+                return entry
+
+            # Either this is new, or the files have been touched. Only reparse
+            # if the contents have actually changed.
+            contents = [Path(p).read_bytes() for p in paths]
+            digests = [hashlib.sha1(c).hexdigest() for c in contents]
+            if entry is not None and entry.digests == digests:
+                entry.stats = stats
+                return entry
+
+            entry = _Entry(stats, digests, parse(contents))
+            self._entries[key] = entry
+            return entry
+
+    @staticmethod
+    def _stat(path):
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+
+
+# The registry shared by the whole process
+registry = ModelRegistry()
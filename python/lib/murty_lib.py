@@ -0,0 +1,402 @@
+"""
+Ranking assignments in order of increasing cost with Murty's algorithm.
+
+Murty, K. (1968). An Algorithm for Ranking all the Assignments in Order of
+Increasing Cost. Operations Research, 16(3), 682-687
+
+Each node of the search is a set of constraints (pairs which must be
+included in, or excluded from, the assignment) together with the optimal
+assignment subject to those constraints. Expanding a node partitions the
+remaining assignments into children, the t'th of which includes the first t
+free pairs of the node's assignment and excludes pair t. Everything is kept
+as integer index arrays, and the usual optimisations are used (Miller, Stone
+& Cox (1997) IEEE Trans. Aerosp. Electron. Syst. 33(3), 1092-1102):
+
+- Children inherit their parent's assignment and dual potentials. The extra
+  constraints only increase costs, so the potentials stay feasible, and each
+  child is solved with a single augmenting path search (lap_lib.augment).
+- Children are evaluated lazily. Each is first queued with a lower bound on
+  its cost, calculated from the parent's reduced costs, and is only solved if
+  it reaches the front of the queue.
+- The free pairs are partitioned in decreasing order of that lower bound, so
+  the pairs that are most expensive to exclude are included in all later
+  children. Those children have the tightest constraints and smallest
+  subproblems.
+
+Children can also be solved in a pool of worker processes (n_jobs > 1), in
+which case the cost matrix is shared with the workers through
+multiprocessing.shared_memory rather than being sent with each child.
+
+Dummy rows and columns are interchangeable, so assignments that only differ
+in which dummy a row or column is paired with are treated as the same
+assignment. Constraints involving dummies refer to "any dummy", using
+DUMMY in place of the row or column index, and dummy/dummy pairs aren't
+partitioned on.
+"""
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import count
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from lib.lap_lib import assignment_duals, augment
+
+# Stands for "any dummy" in a (row, col) constraint
+DUMMY = -1
+
+# With n_jobs > 1, up to this many children per worker are solved at a time
+CHILDREN_PER_JOB = 4
+
+
+class MurtyProblem:
+    """A square cost matrix, with dummy rows and columns marked"""
+
+    def __init__(self, costs, dummy_rows=None, dummy_cols=None):
+        """
+        costs: (n x n) array of costs. Dummy rows and columns should have the
+            same cost with everything (normally 0).
+        dummy_rows, dummy_cols: length n boolean arrays marking the dummies
+        """
+        self.costs = np.asarray(costs, dtype=float)
+        n, m = self.costs.shape
+        if n != m:
+            raise ValueError("Murty's algorithm needs a square cost matrix")
+        self.n = n
+        self.dummy_rows = (np.zeros(n, dtype=bool) if dummy_rows is None
+                           else np.asarray(dummy_rows, dtype=bool))
+        self.dummy_cols = (np.zeros(n, dtype=bool) if dummy_cols is None
+                           else np.asarray(dummy_cols, dtype=bool))
+
+    def constrained_costs(self, included, excluded):
+        """Make a copy of the costs with inf for every pair not allowed by
+        the constraints
+
+        Parameters
+        included, excluded: (m x 2) integer arrays of (row, col) pairs, with
+            DUMMY meaning any dummy row or column
+        """
+        costs = self.costs.copy()
+        real_rows = np.flatnonzero(~self.dummy_rows)
+        real_cols = np.flatnonzero(~self.dummy_cols)
+        dummy_rows = np.flatnonzero(self.dummy_rows)
+        dummy_cols = np.flatnonzero(self.dummy_cols)
+
+        rows, cols = included[:, 0], included[:, 1]
+        pairs = (rows != DUMMY) & (cols != DUMMY)
+        fixed = costs[rows[pairs], cols[pairs]]
+        costs[rows[pairs], :] = np.inf
+        costs[:, cols[pairs]] = np.inf
+        costs[rows[pairs], cols[pairs]] = fixed
+        # Rows which must be paired with a dummy, and vice versa
+        costs[np.ix_(rows[cols == DUMMY], real_cols)] = np.inf
+        costs[np.ix_(real_rows, cols[rows == DUMMY])] = np.inf
+
+        rows, cols = excluded[:, 0], excluded[:, 1]
+        pairs = (rows != DUMMY) & (cols != DUMMY)
+        costs[rows[pairs], cols[pairs]] = np.inf
+        costs[np.ix_(rows[cols == DUMMY], dummy_cols)] = np.inf
+        costs[np.ix_(dummy_rows, cols[rows == DUMMY])] = np.inf
+        return costs
+
+    def pairs(self, row_to_col):
+        """The (row, col) pairs making up an assignment, with DUMMY in place
+        of dummy indices, and dummy/dummy pairs left out
+
+        Returns
+        An (m x 2) integer array, in row order
+        """
+        rows = np.arange(self.n)
+        pairs = np.column_stack([np.where(self.dummy_rows, DUMMY, rows),
+                                 np.where(self.dummy_cols[row_to_col], DUMMY, row_to_col)])
+        return pairs[(pairs != DUMMY).any(axis=1)]
+
+
+class MurtyNode:
+    """A set of constraints, and the optimal assignment subject to them"""
+
+    __slots__ = ("cost", "row_to_col", "u", "v", "included", "excluded")
+
+    def __init__(self, cost, row_to_col, u, v, included, excluded):
+        self.cost = cost
+        self.row_to_col = row_to_col
+        self.u = u
+        self.v = v
+        self.included = included
+        self.excluded = excluded
+
+
+def _no_pairs():
+    return np.empty((0, 2), dtype=int)
+
+
+def _invert(row_to_col):
+    col_to_row = np.empty(len(row_to_col), dtype=int)
+    col_to_row[row_to_col] = np.arange(len(row_to_col))
+    return col_to_row
+
+
+def subproblem(problem, row_to_col, included, excluded):
+    """The part of an assignment which isn't fixed by the included pairs
+
+    Included pairs can't change, so finding the best assignment subject to
+    the constraints only involves the other rows and the columns they're
+    paired with. Dummies are interchangeable, so a row (or column) which must
+    be paired with any dummy can be fixed to the one it's currently paired
+    with.
+
+    Returns
+    A tuple (rows, costs). rows are the indices of the free rows. costs is
+    the (m x m) matrix of costs between the free rows and their currently
+    assigned columns (in the same order, so the current assignment is the
+    diagonal), with inf for excluded pairs.
+
+    Parameters
+    problem: a MurtyProblem
+    row_to_col: an assignment satisfying the included pairs
+    included, excluded: (m x 2) integer arrays of (row, col) pairs, with
+        DUMMY meaning any dummy
+    """
+    col_to_row = _invert(row_to_col)
+    fixed = np.zeros(problem.n, dtype=bool)
+    fixed[np.where(included[:, 0] == DUMMY,
+                   col_to_row[np.maximum(included[:, 1], 0)], included[:, 0])] = True
+    rows = np.flatnonzero(~fixed)
+    cols = row_to_col[rows]
+    costs = problem.costs[np.ix_(rows, cols)]
+
+    # Positions of each row and column in the subproblem (-1 if fixed)
+    row_pos = np.full(problem.n, -1)
+    row_pos[rows] = np.arange(len(rows))
+    col_pos = np.full(problem.n, -1)
+    col_pos[cols] = np.arange(len(cols))
+
+    exc_rows, exc_cols = excluded[:, 0], excluded[:, 1]
+    pairs = (exc_rows != DUMMY) & (exc_cols != DUMMY)
+    r, c = row_pos[exc_rows[pairs]], col_pos[exc_cols[pairs]]
+    costs[r[(r >= 0) & (c >= 0)], c[(r >= 0) & (c >= 0)]] = np.inf
+    r = row_pos[exc_rows[exc_cols == DUMMY]]
+    costs[np.ix_(r[r >= 0], problem.dummy_cols[cols])] = np.inf
+    c = col_pos[exc_cols[exc_rows == DUMMY]]
+    costs[np.ix_(problem.dummy_rows[rows], c[c >= 0])] = np.inf
+    return rows, costs
+
+
+def solve_root(problem, included=None, excluded=None):
+    """Find the optimal assignment subject to some initial constraints
+
+    Returns
+    A MurtyNode, or None if the constraints can't be satisfied
+    """
+    included = _no_pairs() if included is None else np.asarray(included, dtype=int).reshape(-1, 2)
+    excluded = _no_pairs() if excluded is None else np.asarray(excluded, dtype=int).reshape(-1, 2)
+    costs = problem.constrained_costs(included, excluded)
+    try:
+        _, row_to_col = linear_sum_assignment(costs)
+    except ValueError:
+        return None
+    u, v = assignment_duals(costs, row_to_col)
+    cost = costs[np.arange(problem.n), row_to_col].sum()
+    return MurtyNode(cost, row_to_col, u, v, included, excluded)
+
+
+def partition(problem, node):
+    """Order the free pairs of a node's assignment for partitioning, and find
+    lower bounds on the costs of the resulting children
+
+    Child t includes pairs[:t] and excludes pairs[t] (see child_constraints).
+    Together the children cover every assignment allowed by the node's
+    constraints, apart from the node's own assignment.
+
+    Returns
+    A tuple (pairs, bounds), where pairs is an (m x 2) array of the free
+    pairs in partition order, and bounds is a length m array of lower bounds
+    on the child costs
+    """
+    rows, costs = subproblem(problem, node.row_to_col, node.included, node.excluded)
+    cols = node.row_to_col[rows]
+    # Dummy/dummy pairs aren't partitioned on
+    free = ~(problem.dummy_rows[rows] & problem.dummy_cols[cols])
+    pairs = np.column_stack([np.where(problem.dummy_rows[rows], DUMMY, rows),
+                             np.where(problem.dummy_cols[cols], DUMMY, cols)])[free]
+    if len(pairs) == 0:
+        return pairs, np.empty(0)
+
+    # Excluding a pair means its row (and its column) have to be paired with
+    # something else, which costs at least the smallest reduced cost of the
+    # alternatives. Pairing a row with a different dummy doesn't count.
+    reduced = costs - node.u[rows, np.newaxis] - node.v[np.newaxis, cols]
+    pos = np.flatnonzero(free)
+    m = len(pos)
+    row_alt = reduced[pos]
+    row_alt[np.arange(m), pos] = np.inf
+    row_alt[np.ix_(pairs[:, 1] == DUMMY, problem.dummy_cols[cols])] = np.inf
+    col_alt = reduced[:, pos].T
+    col_alt[np.arange(m), pos] = np.inf
+    col_alt[np.ix_(pairs[:, 0] == DUMMY, problem.dummy_rows[rows])] = np.inf
+    bounds = node.cost + np.maximum(np.maximum(row_alt.min(axis=1), col_alt.min(axis=1)), 0)
+
+    # Partition in decreasing order of the bounds. A stable sort keeps the
+    # order deterministic for equal bounds.
+    order = np.argsort(-bounds, kind="stable")
+    return pairs[order], bounds[order]
+
+
+def child_constraints(parent, pairs, t):
+    """The constraints for child t of a node partitioned on pairs
+
+    Returns
+    A tuple (included, excluded) of (m x 2) arrays
+    """
+    return (np.concatenate([parent.included, pairs[:t]]),
+            np.concatenate([parent.excluded, pairs[t:t + 1]]))
+
+
+def solve_child(problem, parent, pairs, t):
+    """Find the optimal assignment for a child node, starting from its
+    parent's assignment and potentials
+
+    Only the part of the assignment which isn't fixed by the child's
+    included pairs is repaired. Because of the partition order, the children
+    most likely to be solved have the most included pairs, and so the
+    smallest subproblems.
+
+    Returns
+    A MurtyNode, or None if the constraints can't be satisfied
+    """
+    included, excluded = child_constraints(parent, pairs, t)
+    rows, costs = subproblem(problem, parent.row_to_col, included, excluded)
+    cols = parent.row_to_col[rows]
+    m = len(rows)
+    sub_u, sub_v = parent.u[rows], parent.v[cols]
+
+    # Only the newly excluded pair should have become forbidden
+    sub_row_to_col = np.arange(m)
+    sub_col_to_row = np.arange(m)
+    freed_rows = np.flatnonzero(np.isinf(np.diagonal(costs)))
+    sub_row_to_col[freed_rows] = -1
+    sub_col_to_row[freed_rows] = -1
+    try:
+        for row in freed_rows:
+            augment(costs, row, sub_row_to_col, sub_col_to_row, sub_u, sub_v)
+    except ValueError:
+        return None
+
+    row_to_col = parent.row_to_col.copy()
+    row_to_col[rows] = cols[sub_row_to_col]
+    u, v = parent.u.copy(), parent.v.copy()
+    u[rows] = sub_u
+    v[cols] = sub_v
+    cost = problem.costs[np.arange(problem.n), row_to_col].sum()
+    return MurtyNode(cost, row_to_col, u, v, included, excluded)
+
+
+
+# The problem for the current worker process, set by _init_worker
+_worker_problem = None
+_worker_memory = None
+
+
+def _init_worker(memory_name, shape, dummy_rows, dummy_cols):
+    global _worker_problem, _worker_memory
+    # Keep a reference to the shared memory, so the costs stay mapped
+    _worker_memory = shared_memory.SharedMemory(name=memory_name)
+    costs = np.ndarray(shape, dtype=float, buffer=_worker_memory.buf)
+    _worker_problem = MurtyProblem(costs, dummy_rows, dummy_cols)
+
+
+def _solve_child_task(task):
+    return solve_child(_worker_problem, *task)
+
+
+@contextmanager
+def child_solver(problem, n_jobs=1):
+    """Context manager providing a function to solve a list of children
+
+    The function takes a list of (parent, pairs, t) tuples, and returns the
+    solve_child() result for each, in order.
+
+    Parameters
+    problem: a MurtyProblem
+    n_jobs: number of worker processes. If more than 1, the cost matrix is
+        copied into shared memory once, and the workers use it from there.
+    """
+    if n_jobs == 1:
+        yield lambda tasks: [solve_child(problem, *task) for task in tasks]
+        return
+
+    memory = shared_memory.SharedMemory(create=True, size=max(problem.costs.nbytes, 1))
+    costs = np.ndarray(problem.costs.shape, dtype=float, buffer=memory.buf)
+    costs[:] = problem.costs
+    try:
+        with ProcessPoolExecutor(n_jobs, initializer=_init_worker,
+                                 initargs=(memory.name, problem.costs.shape,
+                                           problem.dummy_rows, problem.dummy_cols)) as executor:
+            def solve_children(tasks):
+                chunksize = max(len(tasks) // n_jobs, 1)
+                return list(executor.map(_solve_child_task, tasks, chunksize=chunksize))
+            yield solve_children
+    finally:
+        del costs
+        memory.close()
+        memory.unlink()
+
+
+def kbest_assignments(problem, k, included=None, excluded=None, n_jobs=1, batch_size=None):
+    """Find the k lowest cost assignments
+
+    The ranked assignments don't depend on n_jobs or batch_size: ties in cost
+    are always broken in the order the nodes were created.
+
+    Returns
+    A tuple (ranked, pending). ranked is a list of up to k MurtyNode objects,
+    in order of increasing cost. pending is a list of the other nodes that
+    were solved along the way, also in order of increasing cost. Which nodes
+    are pending depends on batch_size.
+
+    Parameters
+    problem: a MurtyProblem
+    k: the number of assignments to find
+    included, excluded: optional initial constraints, as (m x 2) arrays of
+        (row, col) pairs, with DUMMY meaning any dummy
+    n_jobs: number of worker processes used to solve the children
+    batch_size: maximum number of children solved at a time. Defaults to 1
+        for a single process, or CHILDREN_PER_JOB * n_jobs.
+    """
+    if batch_size is None:
+        batch_size = 1 if n_jobs == 1 else CHILDREN_PER_JOB * n_jobs
+    root = solve_root(problem, included, excluded)
+    if root is None:
+        return [], []
+
+    # The queue holds (key, sequence number, node, parent, pairs, t). Solved
+    # nodes have their cost as the key. Unsolved children have node=None and
+    # a lower bound as the key, and are only solved when they reach the front
+    # of the queue. A node is only ranked once it's at the front, so solving
+    # extra children early (in a batch) doesn't change the ranking. The
+    # sequence number breaks ties, so the ranking is deterministic.
+    sequence = count()
+    queue = [(root.cost, next(sequence), root, None, None, None)]
+    ranked = []
+    with child_solver(problem, n_jobs) as solve_children:
+        while queue and len(ranked) < k:
+            if queue[0][2] is None:
+                batch = []
+                while queue and queue[0][2] is None and len(batch) < batch_size:
+                    batch.append(heapq.heappop(queue))
+                nodes = solve_children([entry[3:] for entry in batch])
+                for entry, node in zip(batch, nodes):
+                    if node is not None:
+                        heapq.heappush(queue, (node.cost, entry[1], node, None, None, None))
+                continue
+
+            node = heapq.heappop(queue)[2]
+            ranked.append(node)
+            pairs, bounds = partition(problem, node)
+            for t in np.flatnonzero(np.isfinite(bounds)):
+                heapq.heappush(queue, (bounds[t], next(sequence), None, node, pairs, t))
+
+    pending = [entry[2] for entry in sorted(queue, key=lambda e: e[:2]) if entry[2] is not None]
+    return ranked, pending
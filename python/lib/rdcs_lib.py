@@ -3,6 +3,7 @@ import sys
 
 
 from lib.nef_lib import loop_to_dataframe #loop_row_namespace_iter, #loop_row_dict_iter,
+from lib.diagnostics_lib import diagnostics, SUMMARY, DETAIL
 
 SIGMA= 1
 from pandas import DataFrame , merge
@@ -64,13 +65,13 @@ def build_magnitude_log_probability_tables(tidy_dataframe_measured:DataFrame, ti
     magnitude_matrix = pred_measured_to_magnitude_matrix(tidy_dataframe_predicted, tidy_dataframe_measured)
     #print('magnitude_matrix \n', magnitude_matrix)
     log_prob = magnitude_matrix_to_log_probability_matrix(magnitude_matrix)
-    print('log_prob \n', log_prob.to_string())
+    diagnostics.record("rdc_log_prob", log_prob, SUMMARY)
     return log_prob
 
 
 def combine_penalty_tables(rdc: DataFrame, snaps: DataFrame ) :
     table = (add_penalty_tables(rdc, snaps))
-    print('new table\n', table)
+    diagnostics.record("combined_penalty_table", table, SUMMARY)
 
 
 def entry_to_rdc_dataframe(entry: Entry, frame_name:str) -> DataFrame:
@@ -134,8 +135,9 @@ def pred_measured_to_magnitude_matrix(predicted_df: DataFrame, measured_df: Data
                         float(row_measured['target_value']) - float(row_predicted['target_value']))
 
 
-    print ('magnitude matrix \n', magnitude_matrix.to_string())
-    return magnitude_matrix.astype(float)
+    magnitude_matrix = magnitude_matrix.astype(float)
+    diagnostics.record("rdc_magnitude_matrix", magnitude_matrix, DETAIL)
+    return magnitude_matrix
 
 def magnitude_matrix_to_log_probability_matrix(magnitude_matrix: DataFrame):
 
@@ -0,0 +1,426 @@
+"""
+Array based kernels for scoring observed spin systems against predicted
+residues.
+
+The functions here work on plain numpy arrays of shifts, with one row per spin
+system (or residue) and one column per atom type. Row and column labels are
+left to the caller, so SNAPS_assigner only builds a DataFrame once the whole
+matrix has been calculated.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from math import log, log10, pi
+
+import numpy as np
+
+_LOG_SQRT_2PI = 0.5 * log(2 * pi)
+
+# One letter amino acid codes. Residue types are represented by their position
+# in this string, with len(AMINO_ACIDS) used for anything else (eg. X or NaN).
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+UNKNOWN_RES_CODE = len(AMINO_ACIDS)
+# Sets of amino acid types are represented as bitmasks, with bit i set if
+# AMINO_ACIDS[i] is in the set.
+ALL_AA_MASK = (1 << len(AMINO_ACIDS)) - 1
+
+
+def shift_array(df, atoms):
+    """Extract the shifts for a list of atom types as a contiguous float array
+
+    Returns
+    A (len(df) x len(atoms)) numpy array, with NaN for missing shifts
+
+    Parameters
+    df: a DataFrame of observed or predicted shifts
+    atoms: the atom type columns to extract, in order
+    """
+    return np.ascontiguousarray(df.loc[:, list(atoms)].to_numpy(dtype=float))
+
+
+def snaps_atom_name(atom):
+    """Convert atom names like 'CAm1' (as used in some config files) to the
+    'CA_m1' form used elsewhere in SNAPS"""
+    if atom.endswith("m1") and not atom.endswith("_m1"):
+        return atom[:-2] + "_m1"
+    return atom
+
+
+def residue_type_codes(res_types):
+    """Convert a sequence of one letter residue types to integer codes
+
+    Returns
+    An integer array of positions in AMINO_ACIDS, with UNKNOWN_RES_CODE for
+    anything that isn't a standard amino acid (including NaN)
+    """
+    lookup = {aa: i for i, aa in enumerate(AMINO_ACIDS)}
+    return np.array([lookup.get(r, UNKNOWN_RES_CODE) for r in res_types], dtype=np.intp)
+
+
+def aa_mask(aas):
+    """Encode a string of one letter amino acid types as a bitmask
+
+    Characters which aren't in AMINO_ACIDS are ignored.
+    """
+    mask = 0
+    for aa in aas:
+        i = AMINO_ACIDS.find(aa)
+        if i >= 0:
+            mask |= 1 << i
+    return mask
+
+
+def aa_string(mask):
+    """Decode a bitmask back into a string of one letter amino acid types"""
+    return "".join(aa for i, aa in enumerate(AMINO_ACIDS) if (mask >> i) & 1)
+
+
+def aa_class_masks(ss_classes):
+    """Encode a sequence of amino acid class strings (eg. the SS_class column
+    of the observed shifts) as bitmasks
+
+    Returns
+    An integer array of bitmasks. Missing values (NaN) allow any amino acid
+    type, so are encoded as ALL_AA_MASK.
+    """
+    masks = {}
+    result = np.empty(len(ss_classes), dtype=np.int64)
+    for i, ss_class in enumerate(ss_classes):
+        if not isinstance(ss_class, str):
+            result[i] = ALL_AA_MASK
+            continue
+        if ss_class not in masks:
+            masks[ss_class] = aa_mask(ss_class)
+        result[i] = masks[ss_class]
+    return result
+
+
+def residue_type_masks(res_types):
+    """Encode a sequence of one letter residue types as single bit masks
+
+    Returns
+    An integer array of bitmasks, with 0 for anything that isn't a standard
+    amino acid (eg. X or NaN)
+    """
+    codes = residue_type_codes(res_types)
+    known = codes != UNKNOWN_RES_CODE
+    return np.where(known, np.left_shift(1, np.where(known, codes, 0)), 0).astype(np.int64)
+
+
+def aa_type_mismatch(ss_class_masks, res_type_masks):
+    """Find spin system/residue pairs where the residue type isn't one of
+    those allowed for the spin system
+
+    Returns
+    An (N x M) boolean array. Residues of unknown type never mismatch.
+
+    Parameters
+    ss_class_masks: length N array from aa_class_masks()
+    res_type_masks: length M array from residue_type_masks()
+    """
+    ss_class_masks = np.asarray(ss_class_masks)
+    res_type_masks = np.asarray(res_type_masks)
+    allowed = ss_class_masks[:, np.newaxis] & res_type_masks[np.newaxis, :]
+    return (allowed == 0) & (res_type_masks != 0)[np.newaxis, :]
+
+
+def compile_pred_correction(lm_pars, atoms):
+    """Compile the linear prediction correction model into lookup tables
+
+    Returns
+    A tuple (grad, offset) of (len(atoms) x len(AMINO_ACIDS)+1) arrays, indexed
+    by atom and residue type code. Atom/residue type combinations that aren't
+    in lm_pars (and unknown residue types) get zero correction.
+
+    Parameters
+    lm_pars: DataFrame with Atom_type, Res_type, Grad and Offset columns, as
+        in the pred_correction_file
+    atoms: the atom types to compile, in order
+    """
+    grad = np.zeros((len(atoms), UNKNOWN_RES_CODE + 1))
+    offset = np.zeros((len(atoms), UNKNOWN_RES_CODE + 1))
+    atom_index = {atom: a for a, atom in enumerate(atoms)}
+
+    atom_types = [snaps_atom_name(x) for x in lm_pars["Atom_type"]]
+    res_codes = residue_type_codes(lm_pars["Res_type"])
+    for atom, res, g, o in zip(atom_types, res_codes, lm_pars["Grad"], lm_pars["Offset"]):
+        if atom in atom_index and res != UNKNOWN_RES_CODE:
+            grad[atom_index[atom], res] = g
+            offset[atom_index[atom], res] = o
+
+    return grad, offset
+
+
+def pred_correction_arrays(preds, atoms, grad_table, offset_table):
+    """Look up the correction parameters for every predicted residue
+
+    The i atoms are corrected according to Res_type, and the i-1 atoms
+    according to Res_type_m1.
+
+    Returns
+    A tuple (grad, offset) of (M x len(atoms)) arrays
+
+    Parameters
+    preds: DataFrame of predicted shifts, with Res_type and Res_type_m1 columns
+    atoms: the atom types, in the same order used for the tables
+    grad_table, offset_table: output from compile_pred_correction()
+    """
+    codes = residue_type_codes(preds["Res_type"])
+    codes_m1 = residue_type_codes(preds["Res_type_m1"])
+
+    grad = np.empty((len(preds), len(atoms)))
+    offset = np.empty((len(preds), len(atoms)))
+    for a, atom in enumerate(atoms):
+        res_codes = codes_m1 if atom.endswith("_m1") else codes
+        grad[:, a] = grad_table[a, res_codes]
+        offset[:, a] = offset_table[a, res_codes]
+
+    return grad, offset
+
+
+def _corrected_preds(pred_shifts, pred_grad, pred_offset):
+    """Rearrange the correction so delta = pred_adj - pred_scale * obs"""
+    if pred_grad is None:
+        return pred_shifts, None
+    return pred_shifts - pred_offset, 1 + pred_grad
+
+
+def row_blocks(n_rows, n_blocks):
+    """Split range(n_rows) into at most n_blocks contiguous, similarly sized
+    blocks
+
+    Returns
+    A list of (start, stop) tuples
+    """
+    n_blocks = max(1, min(n_blocks, n_rows))
+    bounds = np.linspace(0, n_rows, n_blocks + 1).round().astype(int)
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+# Number of row blocks per thread. Using a few blocks per thread evens out the
+# load if some threads are slower to start or get less CPU time.
+BLOCKS_PER_THREAD = 4
+
+
+def _run_in_threads(func, tasks, n_threads):
+    """Call func on each task in a thread pool. The tasks write their results
+    directly into a shared output array, and numpy releases the GIL for the
+    array operations, so they run in parallel."""
+    with ThreadPoolExecutor(n_threads) as executor:
+        # Iterating over the results re-raises any exception from a task
+        for _ in executor.map(func, tasks):
+            pass
+
+
+def independent_log_prob(obs_shifts, pred_shifts, atom_sd, default_prob=0.01, out=None,
+                         pred_grad=None, pred_offset=None, n_threads=1):
+    """Calculate the log probability matrix assuming independent Gaussian
+    prediction errors for each atom type.
+
+    Equivalent to summing norm.logpdf(pred - obs, scale=sd) over atom types,
+    with log10(default_prob) used wherever either shift is missing. Each atom
+    is broadcast straight into a single scratch buffer, so the only
+    allocations are the output and one (N x M) work array.
+
+    If pred_grad and pred_offset are given, each predicted shift is corrected
+    to pred - grad*obs - offset before comparing it with the observed shift.
+
+    Returns
+    An (N x M) array of log probabilities (out, if it was provided)
+
+    Parameters
+    obs_shifts: (N x A) array of observed shifts
+    pred_shifts: (M x A) array of predicted shifts
+    atom_sd: length A sequence of prediction standard deviations
+    default_prob: penalty for missing data
+    out: optional preallocated (N x M) float array for the result
+    pred_grad, pred_offset: optional (M x A) arrays of linear correction
+        parameters, from pred_correction_arrays()
+    n_threads: if more than 1, blocks of rows are calculated in parallel on
+        this many threads
+    """
+    obs_shifts = np.asarray(obs_shifts, dtype=float)
+    pred_shifts = np.asarray(pred_shifts, dtype=float)
+    N, A = obs_shifts.shape
+    M = pred_shifts.shape[0]
+
+    if out is None:
+        out = np.empty((N, M))
+    if n_threads > 1 and N > 1:
+        # Each block of rows is scored into a view of its rows of out
+        def score_block(block):
+            start, stop = block
+            independent_log_prob(obs_shifts[start:stop], pred_shifts, atom_sd, default_prob,
+                                 out=out[start:stop], pred_grad=pred_grad,
+                                 pred_offset=pred_offset)
+
+        _run_in_threads(score_block, row_blocks(N, n_threads * BLOCKS_PER_THREAD), n_threads)
+        return out
+
+    pred_adj, pred_scale = _corrected_preds(pred_shifts, pred_grad, pred_offset)
+    out.fill(0)
+    buffer = np.empty_like(out)
+    missing = log10(default_prob)
+
+    for a in range(A):
+        sd = float(atom_sd[a])
+        obs_atom = obs_shifts[:, a]
+        pred_atom = pred_adj[:, a]
+
+        if pred_scale is None:
+            np.subtract(pred_atom[np.newaxis, :], obs_atom[:, np.newaxis], out=buffer)
+        else:
+            np.multiply(obs_atom[:, np.newaxis], pred_scale[np.newaxis, :, a], out=buffer)
+            np.subtract(pred_atom[np.newaxis, :], buffer, out=buffer)
+        np.square(buffer, out=buffer)
+        buffer *= -0.5 / sd ** 2
+        buffer -= log(sd) + _LOG_SQRT_2PI
+
+        # Missing shifts are always a whole row or column, so there is no need
+        # to search the full matrix for NaNs
+        buffer[np.isnan(obs_atom), :] = missing
+        buffer[:, np.isnan(pred_atom)] = missing
+
+        out += buffer
+
+    return out
+
+
+# Upper limit on the number of elements in each block of the (rows x cols x
+# atoms) delta array used by correlated_log_prob(). 2**20 float64 values is 8 MB.
+DEFAULT_BLOCK_ELEMENTS = 2 ** 20
+
+
+def missing_patterns(shifts):
+    """Encode the missing atoms in each row of a shift array as a bitmask
+
+    Returns
+    An integer array with bit a set if atom a is missing from that row
+
+    Parameters
+    shifts: (N x A) array of shifts, with NaN for missing values
+    """
+    bits = np.left_shift(1, np.arange(shifts.shape[1], dtype=np.int64))
+    return (np.isnan(shifts) * bits).sum(axis=1)
+
+
+def marginal_factor(d_cov, pattern):
+    """Precompute what is needed to evaluate the marginal multivariate normal
+    over the atoms which are not missing in a given pattern.
+
+    Returns a tuple (present, W, log_norm), where present is the list of atom
+    indices kept, W is the inverse of the Cholesky factor of the marginal
+    covariance (so |W x|^2 is the Mahalanobis distance), and log_norm is the
+    log of the normalising constant.
+
+    Parameters
+    d_cov: (A x A) covariance matrix
+    pattern: bitmask of missing atoms, as from missing_patterns()
+    """
+    present = [a for a in range(d_cov.shape[0]) if not (pattern >> a) & 1]
+    k = len(present)
+    if k == 0:
+        return present, np.zeros((0, 0)), 0.0
+    chol = np.linalg.cholesky(d_cov[np.ix_(present, present)])
+    whiten = np.linalg.inv(chol)
+    log_norm = -k * _LOG_SQRT_2PI - np.log(np.diag(chol)).sum()
+    return present, whiten, log_norm
+
+
+def correlated_log_prob(obs_shifts, pred_shifts, d_mean, d_cov, default_prob=0.01,
+                        out=None, block_size=None, pred_grad=None, pred_offset=None,
+                        factors=None, n_threads=1):
+    """Calculate the log probability matrix using a multivariate normal model
+    of the prediction errors, which accounts for correlations between atom
+    types.
+
+    For each (spin system, residue) pair, the multivariate normal is
+    marginalised over the atoms that are missing from either of them, and a
+    penalty of log10(default_prob) is added for each missing atom.
+
+    Spin systems and residues are grouped by which atoms they are missing, so
+    only one Cholesky factorisation is needed per combined pattern. Rows are
+    then streamed through in blocks, so the largest temporary array is
+    (block_size x M x A) rather than (N x M x A).
+
+    Returns
+    An (N x M) array of log probabilities (out, if it was provided)
+
+    Parameters
+    obs_shifts: (N x A) array of observed shifts
+    pred_shifts: (M x A) array of predicted shifts
+    d_mean: length A array of mean prediction errors (pred - obs)
+    d_cov: (A x A) covariance matrix of the prediction errors
+    default_prob: penalty for missing data
+    out: optional preallocated (N x M) float array for the result
+    block_size: the number of rows to process at once. By default this is
+        chosen so each block has at most DEFAULT_BLOCK_ELEMENTS elements.
+    pred_grad, pred_offset: optional (M x A) arrays of linear correction
+        parameters, from pred_correction_arrays()
+    factors: optional dict of marginal_factor() results keyed by pattern.
+        Any missing factors are added, so the same dict can be reused for
+        later calls with the same d_cov.
+    n_threads: if more than 1, blocks of rows are calculated in parallel on
+        this many threads
+    """
+    obs_shifts = np.asarray(obs_shifts, dtype=float)
+    pred_shifts = np.asarray(pred_shifts, dtype=float)
+    d_mean = np.asarray(d_mean, dtype=float)
+    d_cov = np.asarray(d_cov, dtype=float)
+    N, A = obs_shifts.shape
+    M = pred_shifts.shape[0]
+    pred_adj, pred_scale = _corrected_preds(pred_shifts, pred_grad, pred_offset)
+
+    if out is None:
+        out = np.empty((N, M))
+    if block_size is None:
+        block_size = max(1, DEFAULT_BLOCK_ELEMENTS // max(1, M * A))
+    missing = log10(default_prob)
+
+    obs_patterns = missing_patterns(obs_shifts)
+    pred_patterns = missing_patterns(pred_shifts)
+    if factors is None:
+        factors = {}
+
+    # Factorise every combined pattern up front, so threads only read the dict
+    obs_groups = [np.flatnonzero(obs_patterns == p) for p in np.unique(obs_patterns)]
+    pred_groups = [(int(p), np.flatnonzero(pred_patterns == p)) for p in np.unique(pred_patterns)]
+    for rows in obs_groups:
+        for pred_pattern, _ in pred_groups:
+            pattern = int(obs_patterns[rows[0]] | pred_pattern)
+            if pattern not in factors:
+                factors[pattern] = marginal_factor(d_cov, pattern)
+
+    def score_rows(rows):
+        """Score a set of rows which all have the same missing atoms"""
+        obs_pattern = obs_patterns[rows[0]]
+        for pred_pattern, cols in pred_groups:
+            present, whiten, log_norm = factors[int(obs_pattern | pred_pattern)]
+            log_prob_const = log_norm + missing * (A - len(present))
+
+            pred_part = pred_adj[np.ix_(cols, present)] - d_mean[present]
+            if pred_scale is not None:
+                scale_part = pred_scale[np.ix_(cols, present)]
+            for start in range(0, len(rows), block_size):
+                block_rows = rows[start:start + block_size]
+                obs_part = obs_shifts[np.ix_(block_rows, present)]
+
+                # delta has shape (rows, cols, atoms)
+                if pred_scale is None:
+                    delta = pred_part[np.newaxis, :, :] - obs_part[:, np.newaxis, :]
+                else:
+                    delta = pred_part[np.newaxis, :, :] - scale_part * obs_part[:, np.newaxis, :]
+                z = delta @ whiten.T
+                np.square(z, out=z)
+                out[np.ix_(block_rows, cols)] = -0.5 * z.sum(axis=-1) + log_prob_const
+
+    if n_threads > 1 and N > 1:
+        # Split the larger groups of rows into blocks, so the work can be
+        # spread evenly between the threads
+        max_rows = -(-N // (n_threads * BLOCKS_PER_THREAD))
+        tasks = [rows[start:start + max_rows]
+                 for rows in obs_groups for start in range(0, len(rows), max_rows)]
+        _run_in_threads(score_rows, tasks, n_threads)
+    else:
+        for rows in obs_groups:
+            score_rows(rows)
+
+    return out
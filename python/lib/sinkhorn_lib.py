@@ -0,0 +1,160 @@
+"""
+Approximate marginal assignment probabilities by entropic-regularised optimal
+transport (Sinkhorn iterations).
+
+Given a square matrix of log probabilities L, the Sinkhorn iterations find
+row and column potentials f and g such that P = exp(L / temperature + f + g)
+has every row and column summing to 1. P[i, j] then estimates the posterior
+probability that row i is assigned to column j, averaged over all
+assignments rather than just the best one. Each iteration is a couple of
+matrix-vector products, so this is much cheaper than ranking alternative
+assignments.
+
+The potentials are kept in log space, so very small probabilities don't
+underflow. Between updates of the potentials, the iterations work on the
+kernel exp(L / temperature + f + g) with scaling vectors a and b. When a or b
+get too far from 1 they are absorbed into f and g, and the kernel is
+recalculated (the log-domain stabilisation of Schmitzer (2019) SIAM J. Sci.
+Comput. 41(3), A1443-A1481). The passes over the matrix are split into row
+blocks which can be run on a thread pool.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from lib.scoring_lib import row_blocks, BLOCKS_PER_THREAD
+
+logger = logging.getLogger("SNAPS.sinkhorn")
+
+# Absorb the scaling vectors into the potentials once any element is further
+# than this from 1, in log space
+ABSORB_THRESHOLD = 50
+# Kernel entries smaller than this are set to 0. They can't affect the result,
+# and subnormal numbers make the matrix-vector products very slow.
+KERNEL_CUTOFF = 1e-200
+
+
+class _RowBlocks:
+    """Runs a function over the row blocks of a matrix, using a thread pool
+    which is kept for the whole calculation"""
+
+    def __init__(self, n_rows, n_threads):
+        self.n_rows = n_rows
+        self.blocks = row_blocks(n_rows, n_threads * BLOCKS_PER_THREAD)
+        self.executor = ThreadPoolExecutor(n_threads) if n_threads > 1 else None
+
+    def run(self, func):
+        """Call func(start, stop) for each row block"""
+        if self.executor is None:
+            func(0, self.n_rows)
+        else:
+            # Iterating over the results re-raises any exception from a task
+            for _ in self.executor.map(lambda block: func(*block), self.blocks):
+                pass
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def _kernel(scaled, f, g, out, blocks):
+    """out = exp(scaled + f[:, None] + g[None, :])"""
+    def calc(start, stop):
+        block = out[start:stop]
+        np.add(scaled[start:stop], f[start:stop, np.newaxis], out=block)
+        block += g[np.newaxis, :]
+        np.exp(block, out=block)
+        block[block < KERNEL_CUTOFF] = 0
+    blocks.run(calc)
+
+
+def _scale(kernel, scaling, out, blocks):
+    """out = 1 / (kernel @ scaling), with 0 for rows with no allowed entries"""
+    def calc(start, stop):
+        sums = kernel[start:stop] @ scaling
+        out[start:stop] = np.divide(1, sums, out=np.zeros_like(sums), where=sums > 0)
+    blocks.run(calc)
+
+
+def sinkhorn_marginals(log_prob, temperature=1, tol=1e-3, max_iter=20000, n_threads=1):
+    """Find the matrix of marginal assignment probabilities
+
+    Returns
+    A tuple (marginals, converged). marginals is an (n x n) array whose rows
+    and columns sum to 1 (to within tol, if converged). Forbidden pairs
+    (-inf log probability) have probability 0.
+
+    Parameters
+    log_prob: (n x n) array of log probabilities, which may include -inf
+    temperature: scale for the log probabilities. 1 treats them as log
+        likelihoods; higher values give flatter marginals.
+    tol: stop when the log of every row sum is within tol of 0. Strongly
+        peaked log probabilities converge slowly, so this is a compromise:
+        the marginals are then typically accurate to a few times tol.
+    max_iter: maximum number of iterations
+    n_threads: number of threads used for each pass over the matrix
+    """
+    scaled = np.asarray(log_prob, dtype=float) / temperature
+    n, m = scaled.shape
+    if n != m:
+        raise ValueError("Sinkhorn marginals need a square log probability matrix")
+    blocks = _RowBlocks(n, n_threads)
+    try:
+        return _iterate(scaled, tol, max_iter, blocks)
+    finally:
+        blocks.close()
+
+
+def _iterate(scaled, tol, max_iter, blocks):
+    """Run the Sinkhorn iterations for sinkhorn_marginals()"""
+    n = len(scaled)
+
+    # Start from potentials which make the largest entry of each row and
+    # column 1, so the kernel doesn't underflow
+    with np.errstate(invalid="ignore"):
+        f = -scaled.max(axis=1)
+        f[~np.isfinite(f)] = 0
+        g = -(scaled + f[:, np.newaxis]).max(axis=0)
+        g[~np.isfinite(g)] = 0
+    kernel = np.empty_like(scaled)
+    _kernel(scaled, f, g, kernel, blocks)
+    kernel_t = np.ascontiguousarray(kernel.T)
+
+    a = np.ones(n)
+    b = np.ones(n)
+    new_a = np.empty(n)
+    error = np.inf
+    converged = False
+    for iteration in range(max_iter):
+        _scale(kernel, b, new_a, blocks)
+        # With the previous a, the row sums were a / new_a
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = np.log(a / new_a)
+        error = np.abs(ratio[np.isfinite(ratio)]).max(initial=0)
+        a, new_a = new_a, a
+        _scale(kernel_t, a, b, blocks)
+        if error < tol:
+            converged = True
+            break
+
+        with np.errstate(divide="ignore"):
+            log_a, log_b = np.log(a), np.log(b)
+        if max(np.abs(log_a[a > 0]).max(initial=0),
+               np.abs(log_b[b > 0]).max(initial=0)) > ABSORB_THRESHOLD:
+            f += np.where(a > 0, log_a, 0)
+            g += np.where(b > 0, log_b, 0)
+            a.fill(1)
+            b.fill(1)
+            _kernel(scaled, f, g, kernel, blocks)
+            kernel_t[:] = kernel.T
+
+    if not converged:
+        logger.warning("Sinkhorn iterations did not converge after %d iterations "
+                       "(maximum log row sum error %g)", max_iter, error)
+    else:
+        logger.debug("Sinkhorn iterations converged after %d iterations", iteration + 1)
+
+    marginals = kernel * a[:, np.newaxis]
+    marginals *= b[np.newaxis, :]
+    return marginals, converged
@@ -0,0 +1,212 @@
+"""
+Fast re-scoring and assignment over a grid of scoring parameters.
+
+The differences between observed and predicted shifts don't depend on
+atom_sd, sf or default_prob, so for parameter calibration they are
+calculated once per protein (DeltaSet), and each grid point only needs a
+weighted sum over atom types followed by the assignment.
+"""
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from math import log, log10, pi
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from lib.scoring_lib import shift_array, pred_correction_arrays
+from lib.lap_lib import solve_with_dummies
+from lib.model_registry_lib import registry
+
+_LOG_SQRT_2PI = 0.5 * log(2 * pi)
+
+
+class DeltaSet:
+    """Squared prediction errors for one protein, for every spin system/residue
+    pair and atom type"""
+
+    def __init__(self, name, atoms, sq_delta, present, fixed_penalty, ss_names, res_names):
+        """
+        name: identifier for the protein
+        atoms: list of atom types
+        sq_delta: (A x N x M) array of squared prediction errors, with 0
+            where either shift is missing
+        present: (A x N x M) boolean array, False where either shift is missing
+        fixed_penalty: (N x M) array of any other (parameter independent)
+            log probability terms, eg. SS_class penalties
+        ss_names, res_names: labels of the real spin systems and residues
+        """
+        self.name = name
+        self.atoms = list(atoms)
+        self.sq_delta = sq_delta
+        self.present = present
+        self.fixed_penalty = fixed_penalty
+        self.ss_names = np.asarray(ss_names)
+        self.res_names = np.asarray(res_names)
+
+    @classmethod
+    def from_assigner(cls, assigner, name=None):
+        """Calculate the deltas for an assigner that has already had
+        prepare_obs_preds() run. Dummy spin systems and residues are left out.
+
+        pred_correction and use_ss_class_info are taken from assigner.pars.
+        delta_correlation is not supported, as it doesn't use atom_sd.
+        """
+        if assigner.pars.get("delta_correlation", False):
+            raise ValueError("Parameter sweeps are not supported with delta_correlation")
+        obs = assigner.obs[~assigner.obs["Dummy_SS"].astype(bool)]
+        preds = assigner.preds[~assigner.preds["Dummy_res"].astype(bool)]
+        atoms = sorted(assigner.pars["atom_set"].intersection(obs.columns))
+
+        obs_shifts = shift_array(obs, atoms)
+        pred_shifts = shift_array(preds, atoms)
+        # (A x N x M) array of pred - obs
+        delta = pred_shifts.T[:, np.newaxis, :] - obs_shifts.T[:, :, np.newaxis]
+
+        if assigner.pars.get("pred_correction", False):
+            correction_model = registry.correction_model(assigner.pars["pred_correction_file"])
+            grad, offset = pred_correction_arrays(preds, atoms, *correction_model.tables(atoms))
+            delta -= (grad.T[:, np.newaxis, :] * obs_shifts.T[:, :, np.newaxis]
+                      + offset.T[:, np.newaxis, :])
+
+        present = ~np.isnan(delta)
+        sq_delta = np.where(present, delta, 0) ** 2
+
+        fixed_penalty = np.zeros(delta.shape[1:])
+        if assigner.pars.get("use_ss_class_info", False):
+            zeros = pd.DataFrame(fixed_penalty, index=obs.index, columns=preds.index)
+            fixed_penalty = assigner._apply_ss_class_penalties(zeros, obs, preds).to_numpy()
+
+        return cls(name, atoms, sq_delta, present, fixed_penalty,
+                   obs["SS_name"].astype(str).str.strip(), preds["Res_name"].astype(str).str.strip())
+
+    def log_prob(self, atom_sd, sf=1, default_prob=0.01):
+        """Calculate the (N x M) log probability matrix for one set of
+        parameters. This matches SNAPS_assigner.calc_log_prob_matrix() for the
+        real spin systems and residues."""
+        sd = np.array([atom_sd[atom] * sf for atom in self.atoms])
+        weights = -0.5 / sd ** 2
+        log_norm = -(np.log(sd) + _LOG_SQRT_2PI)
+        missing = log10(default_prob)
+
+        result = np.tensordot(weights, self.sq_delta, axes=1)
+        result += np.tensordot(log_norm - missing, self.present, axes=1)
+        result += missing * len(self.atoms)
+        result += self.fixed_penalty
+        return result
+
+    def assign(self, log_prob):
+        """Find the best assignment for a log probability matrix
+
+        Returns
+        The number of spin systems assigned to the residue with the same name,
+        and the number of spin systems which have a matching residue.
+        """
+        N, M = log_prob.shape
+        row_ind, col_ind = solve_with_dummies(-log_prob, max(M - N, 0), max(N - M, 0))
+        correct = (self.ss_names[row_ind] == self.res_names[col_ind]).sum()
+        assignable = np.isin(self.ss_names, self.res_names).sum()
+        return int(correct), int(assignable)
+
+
+def parameter_grid(atom_sd, sf_values=(1,), default_prob_values=(0.01,), atom_sd_values=None):
+    """Make a list of parameter settings for run_sweep()
+
+    Returns
+    A list of dicts with atom_sd, sf and default_prob keys, covering every
+    combination of the values given
+
+    Parameters
+    atom_sd: dict of default atom_sd values
+    sf_values, default_prob_values: sequences of values to try
+    atom_sd_values: optional dict of {atom: sequence of sd values}, overriding
+        the default for those atoms
+    """
+    atom_sd_values = atom_sd_values or {}
+    sd_atoms = list(atom_sd_values)
+    grid = []
+    for sds in itertools.product(*[atom_sd_values[a] for a in sd_atoms]):
+        sd = dict(atom_sd)
+        sd.update(zip(sd_atoms, sds))
+        for sf, default_prob in itertools.product(sf_values, default_prob_values):
+            grid.append({"atom_sd": sd, "sf": sf, "default_prob": default_prob})
+    return grid
+
+
+# Delta sets for the current worker process, set by _init_worker
+_worker_delta_sets = None
+
+
+def _init_worker(delta_sets):
+    global _worker_delta_sets
+    _worker_delta_sets = delta_sets
+
+
+def _evaluate(pars):
+    """Score and assign every protein for one parameter setting"""
+    rows = []
+    for delta_set in _worker_delta_sets:
+        start = perf_counter()
+        log_prob = delta_set.log_prob(pars["atom_sd"], pars["sf"], pars["default_prob"])
+        scored = perf_counter()
+        correct, assignable = delta_set.assign(log_prob)
+        assigned = perf_counter()
+        rows.append({"ID": delta_set.name,
+                     "Correct": correct,
+                     "Assignable": assignable,
+                     "Score_time": scored - start,
+                     "Assign_time": assigned - scored})
+    return rows
+
+
+def run_sweep(delta_sets, grid, n_jobs=1):
+    """Evaluate the assignment accuracy for each parameter setting in a grid
+
+    Returns
+    A DataFrame with one row per parameter setting and protein, giving the
+    parameters, the number of correct assignments and timings
+
+    Parameters
+    delta_sets: list of DeltaSet objects
+    grid: list of parameter dicts, from parameter_grid()
+    n_jobs: number of worker processes. Each worker receives the delta sets
+        once, when it starts.
+    """
+    if n_jobs == 1:
+        _init_worker(delta_sets)
+        results = [_evaluate(pars) for pars in grid]
+    else:
+        with ProcessPoolExecutor(n_jobs, initializer=_init_worker,
+                                 initargs=(delta_sets,)) as executor:
+            results = list(executor.map(_evaluate, grid))
+
+    rows = []
+    for i, (pars, protein_rows) in enumerate(zip(grid, results)):
+        for row in protein_rows:
+            setting = {"Setting": i, "sf": pars["sf"], "default_prob": pars["default_prob"]}
+            setting.update({"sd_" + atom: sd for atom, sd in sorted(pars["atom_sd"].items())})
+            setting.update(row)
+            rows.append(setting)
+    return pd.DataFrame(rows)
+
+
+def summarise_sweep(results):
+    """Summarise run_sweep() results per parameter setting
+
+    Returns
+    A DataFrame with one row per setting, giving the overall accuracy
+    (correct/assignable over all proteins), the mean per-protein accuracy
+    and the total scoring and assignment times
+    """
+    par_cols = [c for c in results.columns
+                if c in ("sf", "default_prob") or c.startswith("sd_")]
+    results = results.assign(Accuracy=results["Correct"] / results["Assignable"])
+    summary = results.groupby("Setting").agg(
+        **{c: (c, "first") for c in par_cols},
+        Correct=("Correct", "sum"),
+        Assignable=("Assignable", "sum"),
+        Mean_accuracy=("Accuracy", "mean"),
+        Score_time=("Score_time", "sum"),
+        Assign_time=("Assign_time", "sum"))
+    summary.insert(len(par_cols), "Accuracy", summary["Correct"] / summary["Assignable"])
+    return summary.sort_values("Accuracy", ascending=False)
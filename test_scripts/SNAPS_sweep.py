@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sweep the scoring parameters (atom_sd, sf and default_prob) over the testset,
+and report the assignment accuracy and timing for each setting.
+
+The shift deltas are calculated once per protein, so each extra grid point
+only costs a re-weighting and an assignment.
+
+eg. "python SNAPS_sweep.py .. --sf 0.8 1 1.2 --default_prob 0.01 0.001
+        --atom_sd CA=0.35,0.44,0.55 -j 4 -o sweep.txt"
+"""
+
+import sys
+import argparse
+import logging
+from pathlib import Path
+
+import pandas as pd
+
+from SNAPS_analyse import import_testset_metadata
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "python"))
+from SNAPS_importer import SNAPS_importer
+from SNAPS_assigner import SNAPS_assigner
+from lib.sweep_lib import DeltaSet, parameter_grid, run_sweep, summarise_sweep
+
+
+def prepare_delta_set(path, testset_df, ID, config_file, SS_class=None, SS_class_m1=None):
+    """Import the shifts for one testset protein and calculate its deltas"""
+    a = SNAPS_assigner()
+    a.read_config_file(config_file)
+    # atom_sd isn't used by the delta_correlation model
+    a.pars["delta_correlation"] = False
+    if SS_class is not None:
+        a.pars["use_ss_class_info"] = True
+
+    importer = SNAPS_importer()
+    importer.import_testset_shifts(testset_df.loc[ID, "obs_file"],
+                                   SS_class=SS_class, SS_class_m1=SS_class_m1)
+    a.obs = importer.obs
+    a.import_pred_shifts(testset_df.loc[ID, "preds_file"], "shiftx2", None)
+    a.prepare_obs_preds()
+
+    return DeltaSet.from_assigner(a, ID)
+
+
+def parse_atom_sd(values):
+    """Parse a list of strings like "CA=0.35,0.44" into a dict"""
+    atom_sd_values = {}
+    for value in values:
+        atom, sds = value.split("=")
+        atom_sd_values[atom] = [float(x) for x in sds.split(",")]
+    return atom_sd_values
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Parameter sweep for SNAPS scoring")
+    parser.add_argument("SNAPS_path", help="Path to the top-level SNAPS directory.")
+    parser.add_argument("-c", "--config_file", default=None,
+                        help="Config file (default config/config_yaml.txt)")
+    parser.add_argument("--ids", nargs="+", default=None,
+                        help="Testset IDs to use (default all)")
+    parser.add_argument("-N", type=int, default=None, help="Limit to first N datasets.")
+    parser.add_argument("--sf", type=float, nargs="+", default=[1])
+    parser.add_argument("--default_prob", type=float, nargs="+", default=[0.01])
+    parser.add_argument("--atom_sd", nargs="+", default=[],
+                        help="""Values to try for individual atom types, eg.
+                        CA=0.35,0.44,0.55. Other atoms use the config values.""")
+    parser.add_argument("--test_aa_classes", default=None,
+                        help="As for SNAPS.py, eg. \"ACDEFGHIKLMNPQRSTVWY;G,S,T,AVI,DN,FHYWC,REKPQML\"")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of grid points to evaluate in parallel")
+    parser.add_argument("-o", "--output_file", default=None,
+                        help="Write the per-setting summary table here (tab separated)")
+    parser.add_argument("--details_file", default=None,
+                        help="Write the per-protein results here (tab separated)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    path = Path(args.SNAPS_path)
+    config_file = args.config_file or path / "config/config_yaml.txt"
+    testset_df = import_testset_metadata(path)
+    ids = args.ids or testset_df["ID"].tolist()
+    if args.N is not None:
+        ids = ids[:args.N]
+
+    SS_class, SS_class_m1 = None, None
+    if args.test_aa_classes is not None:
+        aa_class, aa_class_m1 = args.test_aa_classes.split(";")
+        SS_class, SS_class_m1 = aa_class.split(","), aa_class_m1.split(",")
+
+    delta_sets = []
+    for ID in ids:
+        try:
+            delta_sets.append(prepare_delta_set(path, testset_df, ID, config_file,
+                                                SS_class, SS_class_m1))
+        except Exception as e:
+            print("Skipping %s: %s" % (ID, e), file=sys.stderr)
+
+    atom_sd = SNAPS_assigner().read_config_file(config_file)["atom_sd"]
+    grid = parameter_grid(atom_sd, args.sf, args.default_prob, parse_atom_sd(args.atom_sd))
+    print("Evaluating %d settings on %d proteins" % (len(grid), len(delta_sets)),
+          file=sys.stderr)
+
+    results = run_sweep(delta_sets, grid, n_jobs=args.jobs)
+    summary = summarise_sweep(results)
+
+    if args.details_file is not None:
+        results.to_csv(args.details_file, sep="\t", index=False)
+    if args.output_file is not None:
+        summary.to_csv(args.output_file, sep="\t")
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(summary)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Measure how long it takes to find the k best assignments with different
+numbers of worker processes, and check that the ranking doesn't change.
+
+eg. "python benchmark_kbest.py -N 500 -k 100 -j 1 2 4 8"
+"""
+
+import sys
+import argparse
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "python"))
+from lib.murty_lib import MurtyProblem, kbest_assignments
+
+
+def simulate_problem(n, n_dummy, seed=None):
+    """A random (n x n) cost matrix with n_dummy dummy columns"""
+    rng = np.random.default_rng(seed)
+    costs = rng.chisquare(3, size=(n, n))
+    dummy_cols = np.arange(n) >= n - n_dummy
+    costs[:, dummy_cols] = 0
+    return MurtyProblem(costs, None, dummy_cols)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark parallel k-best assignment")
+    parser.add_argument("-N", type=int, default=500, help="Size of the cost matrix")
+    parser.add_argument("-d", "--dummies", type=int, default=20, help="Number of dummy columns")
+    parser.add_argument("-k", type=int, default=100, help="Number of assignments to find")
+    parser.add_argument("-j", "--jobs", type=int, nargs="+", default=[1, 2, 4],
+                        help="Numbers of worker processes to try")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    problem = simulate_problem(args.N, args.dummies, args.seed)
+    expected = None
+    rows = []
+    for n_jobs in sorted(set(args.jobs) | {1}):
+        start = perf_counter()
+        ranked, pending = kbest_assignments(problem, args.k, n_jobs=n_jobs)
+        t = perf_counter() - start
+        assignments = np.array([node.row_to_col for node in ranked])
+        if expected is None:
+            expected = assignments
+        elif not np.array_equal(assignments, expected):
+            raise RuntimeError("Ranking differs with %d workers" % n_jobs)
+        rows.append({"Jobs": n_jobs, "Time": t, "Solved": len(ranked) + len(pending)})
+
+    results = pd.DataFrame(rows)
+    results["Speedup"] = results["Time"].iloc[0] / results["Time"]
+    print("%d best assignments of a %dx%d matrix" % (args.k, args.N, args.N))
+    print(results.to_string(index=False, float_format="%.4g"))
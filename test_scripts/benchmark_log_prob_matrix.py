@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark the array based log probability kernel against the original
+DataFrame based calculation in SNAPS_assigner.calc_log_prob_matrix
+
+eg. "python benchmark_log_prob_matrix.py -N 1000 -M 1000"
+"""
+
+import sys
+import argparse
+from math import log10
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "python"))
+from lib.scoring_lib import independent_log_prob
+
+ATOM_SD = {'H': 0.454, 'N': 2.429, 'HA': 0.227, 'C': 1.030, 'CA': 0.932,
+           'CB': 1.025, 'C_m1': 1.030, 'CA_m1': 0.932, 'CB_m1': 1.025}
+ATOM_MEAN = {'H': 8.2, 'N': 120.0, 'HA': 4.3, 'C': 176.0, 'CA': 56.0,
+             'CB': 38.0, 'C_m1': 176.0, 'CA_m1': 56.0, 'CB_m1': 38.0}
+
+
+def simulate_shifts(n, atoms, missing=0.05, seed=0):
+    """Make a DataFrame of random shifts, with a fraction of them missing"""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({a: rng.normal(ATOM_MEAN[a], 5 * ATOM_SD[a], size=n) for a in atoms},
+                      index=["%dX" % i for i in range(n)])
+    df = df.mask(rng.random(df.shape) < missing)
+    return df
+
+
+def dataframe_log_prob(obs, preds, atoms, default_prob=0.01):
+    """The original per-atom DataFrame calculation"""
+    log_prob_matrix = pd.DataFrame(0, index=obs.index, columns=preds.index)
+    for atom in atoms:
+        obs_atom = pd.DataFrame(obs[atom].repeat(len(obs.index)).values.
+                                reshape([len(obs.index), -1]),
+                                index=obs.index, columns=preds.index)
+        preds_atom = pd.DataFrame(preds[atom].repeat(len(preds.index)).values.
+                                  reshape([len(preds.index), -1]).transpose(),
+                                  index=obs.index, columns=preds.index)
+        delta_atom = preds_atom - obs_atom
+        na_mask = np.isnan(delta_atom)
+        delta_atom[na_mask] = 0
+        prob_atom = pd.DataFrame(norm.logpdf(delta_atom, scale=ATOM_SD[atom]),
+                                 index=obs.index, columns=preds.index)
+        prob_atom[na_mask] = log10(default_prob)
+        log_prob_matrix = log_prob_matrix + prob_atom
+    return log_prob_matrix
+
+
+def array_log_prob(obs, preds, atoms, default_prob=0.01):
+    """The array kernel, including conversion to and from DataFrames"""
+    values = independent_log_prob(obs[atoms].to_numpy(dtype=float),
+                                  preds[atoms].to_numpy(dtype=float),
+                                  [ATOM_SD[a] for a in atoms], default_prob)
+    return pd.DataFrame(values, index=obs.index, columns=preds.index)
+
+
+def time_function(f, repeats, *args):
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        result = f(*args)
+        times.append(perf_counter() - start)
+    return min(times), result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark log probability matrix calculation")
+    parser.add_argument("-N", type=int, default=1000, help="Number of spin systems")
+    parser.add_argument("-M", type=int, default=1000, help="Number of predicted residues")
+    parser.add_argument("-r", "--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    atoms = list(ATOM_SD.keys())
+    obs = simulate_shifts(args.N, atoms, seed=1)
+    preds = simulate_shifts(args.M, atoms, seed=2)
+
+    t_df, df_result = time_function(dataframe_log_prob, args.repeats, obs, preds, atoms)
+    t_arr, arr_result = time_function(array_log_prob, args.repeats, obs, preds, atoms)
+
+    pd.testing.assert_frame_equal(df_result, arr_result, check_exact=False, rtol=1e-9)
+    print("Log probability matrix %dx%d, %d atom types" % (args.N, args.M, len(atoms)))
+    print("DataFrame calculation: %8.3f s" % t_df)
+    print("Array kernel:          %8.3f s" % t_arr)
+    print("Speedup:               %8.1fx" % (t_df / t_arr))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Measure how the log probability kernels scale with the number of threads,
+for both the independent Gaussian and the delta_correlation models.
+
+Reports the throughput (spin system/residue pairs scored per second) and the
+speedup relative to a single thread.
+
+eg. "python benchmark_threads.py -N 2000 -M 2000 -t 1 2 4 8 16 32"
+"""
+
+import sys
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from benchmark_log_prob_matrix import ATOM_SD, simulate_shifts, time_function
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "python"))
+from lib.scoring_lib import independent_log_prob, correlated_log_prob
+from lib.model_registry_lib import registry
+
+CONFIG_DIR = Path(__file__).resolve().parent.parent / "config"
+
+
+def make_kernels(obs, preds, atoms):
+    """Functions running each kernel on the simulated shifts, with a given
+    number of threads"""
+    obs_shifts = obs[atoms].to_numpy(dtype=float)
+    pred_shifts = preds[atoms].to_numpy(dtype=float)
+    sd = [ATOM_SD[a] for a in atoms]
+    d_mean, d_cov, factors = registry.correlation_model(CONFIG_DIR / "d_mean.csv",
+                                                        CONFIG_DIR / "d_cov.csv").arrays(atoms)
+    out = np.empty((len(obs_shifts), len(pred_shifts)))
+
+    def independent(n_threads):
+        return independent_log_prob(obs_shifts, pred_shifts, sd, out=out, n_threads=n_threads)
+
+    def correlated(n_threads):
+        return correlated_log_prob(obs_shifts, pred_shifts, d_mean, d_cov, out=out,
+                                   factors=factors, n_threads=n_threads)
+
+    return {"independent": independent, "delta_correlation": correlated}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark threaded log probability scoring")
+    parser.add_argument("-N", type=int, default=1000, help="Number of spin systems")
+    parser.add_argument("-M", type=int, default=1000, help="Number of predicted residues")
+    parser.add_argument("-t", "--threads", type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="Thread counts to try")
+    parser.add_argument("-r", "--repeats", type=int, default=3)
+    parser.add_argument("-o", "--output_file", default=None,
+                        help="Write the results here (tab separated)")
+    args = parser.parse_args()
+
+    atoms = list(ATOM_SD.keys())
+    obs = simulate_shifts(args.N, atoms, seed=1)
+    preds = simulate_shifts(args.M, atoms, seed=2)
+    kernels = make_kernels(obs, preds, atoms)
+    # The single thread time is needed as the baseline for the speedup
+    thread_counts = sorted(set(args.threads) | {1})
+
+    rows = []
+    for model, kernel in kernels.items():
+        expected = kernel(1).copy()
+        for n_threads in thread_counts:
+            t, result = time_function(kernel, args.repeats, n_threads)
+            if not np.allclose(result, expected, rtol=1e-12, atol=0):
+                raise RuntimeError("%s result differs with %d threads" % (model, n_threads))
+            rows.append({"Model": model, "Threads": n_threads, "Time": t,
+                         "Pairs_per_s": args.N * args.M / t})
+
+    results = pd.DataFrame(rows)
+    single = results[results["Threads"] == 1].set_index("Model")["Time"]
+    results["Speedup"] = results["Model"].map(single) / results["Time"]
+
+    if args.output_file is not None:
+        results.to_csv(args.output_file, sep="\t", index=False)
+    print("Log probability matrix %dx%d, %d atom types" % (args.N, args.M, len(atoms)))
+    print(results.to_string(index=False, float_format="%.4g"))
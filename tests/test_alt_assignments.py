@@ -0,0 +1,373 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+from SNAPS_importer import SNAPS_importer
+from SNAPS_assigner import SNAPS_assigner, CONFIDENCE_TABLE, NEUTRAL_LINK_LOG_PROB
+from lib.lap_lib import ConstraintOverlay
+from lib.joint_lib import optimise_joint
+from lib.cache_lib import MatrixCache
+from lib.diagnostics_lib import Diagnostics
+
+ROOT = Path(__file__).parent.parent
+
+
+def _assigner(n_obs=None):
+    a = SNAPS_assigner()
+    a.read_config_file(ROOT / 'config' / 'config_yaml.txt')
+    a.pars["delta_correlation"] = False
+    a.pars["use_ss_class_info"] = False
+    importer = SNAPS_importer()
+    importer.import_testset_shifts(ROOT / 'data/testset/simplified_BMRB/6338.txt')
+    a.obs = importer.obs.iloc[:n_obs]
+    a.import_pred_shifts(ROOT / 'data/testset/shiftx2_results/A002_1XMTA.cs', "shiftx2", None)
+    a.prepare_obs_preds()
+    a.calc_log_prob_matrix()
+    a.assign_from_preds(set_assign_df=True)
+    return a
+
+
+def _resolved_alt_assignments(a, N, by_ss):
+    """Find alt assignments by re-solving the whole problem for every
+    exclusion"""
+    best_matching = a.assign_df.loc[:, ["SS_name", "Res_name"]]
+    best_matching.index = best_matching["SS_name"]
+    best_matching.index.name = None
+    best_sum_prob = a.calc_overall_matching_prob(best_matching)
+
+    alt_matches = [best_matching.assign(Rank=1, Rel_prob=0)]
+    for i in best_matching.index:
+        ss, res = best_matching.loc[i, "SS_name"], best_matching.loc[i, "Res_name"]
+        excluded = best_matching.loc[[i], :]
+        for j in range(N):
+            alt_matching = a.find_best_assignment(a.log_prob_matrix, exc=excluded)
+            alt_matching["Rank"] = j + 2
+            alt_matching["Rel_prob"] = a.calc_overall_matching_prob(alt_matching) - best_sum_prob
+            if by_ss:
+                alt_matching = alt_matching.loc[alt_matching["SS_name"] == ss, :]
+                res = alt_matching["Res_name"].iloc[0]
+            else:
+                alt_matching = alt_matching.loc[alt_matching["Res_name"] == res, :]
+                ss = alt_matching["SS_name"].iloc[0]
+            alt_matches.append(alt_matching)
+            excluded = pd.concat([excluded, pd.DataFrame({"SS_name": [ss], "Res_name": [res]})],
+                                 ignore_index=True)
+
+    alt_assign_df = a.make_assign_df(pd.concat(alt_matches, ignore_index=True))
+    return alt_assign_df.sort_values(by=["SS_name" if by_ss else "Res_name", "Rank"])
+
+
+def test_find_alt_assignments():
+    # With dummy residues, and with dummy spin systems
+    for n_obs in [None, 60]:
+        a = _assigner(n_obs)
+        for by_ss in [True, False]:
+            expected = _resolved_alt_assignments(a, 2, by_ss)
+            result = a.find_alt_assignments(N=2, by_ss=by_ss)
+            assert_frame_equal(result.reset_index(drop=True), expected.reset_index(drop=True))
+
+
+def test_find_kbest_assignments():
+    for n_obs in [None, 60]:
+        a = _assigner(n_obs)
+        ranked, unranked = a.find_kbest_assignments(5)
+        best_sum_prob = a.calc_overall_matching_prob(a.assign_df)
+
+        assert len(ranked) == 5
+        assert ranked[-1].sum_log_prob == best_sum_prob
+        assert len({frozenset(zip(n.matching["SS_name"], n.matching["Res_name"]))
+                    for n in ranked}) == 5
+        assert all(n.sum_log_prob <= ranked[0].sum_log_prob for n in unranked)
+        for node in ranked:
+            # Each node's matching is the best one allowed by its constraints
+            assert node.sum_log_prob == a.calc_overall_matching_prob(node.matching)
+            matching = a.find_best_assignment(a.log_prob_matrix, inc=node.inc, exc=node.exc)
+            assert np.isclose(a.calc_overall_matching_prob(matching), node.sum_log_prob)
+
+
+def test_marginal_probs():
+    a = _assigner(60)
+    marginal_prob_matrix = a.calc_marginal_prob_matrix()
+    assert (marginal_prob_matrix.index == a.log_prob_matrix.index).all()
+    assert np.allclose(marginal_prob_matrix.sum(axis=0), 1)
+    assert np.allclose(marginal_prob_matrix.sum(axis=1), 1, atol=1e-2)
+
+    assign_df = a.assign_from_preds()
+    assert assign_df["Marginal_prob"].between(0, 1).all()
+    # Most of the best assignment should be fairly likely
+    assert assign_df["Marginal_prob"].median() > 0.5
+
+
+def test_swap_problem_link_terms():
+    a = _assigner(60)
+    m1_atoms = [atom for atom in ["C_m1", "CA_m1", "CB_m1"] if atom in a.obs.columns]
+    blank = ["  11N", "  12E", "  13G"]
+    a.obs.loc[blank, m1_atoms] = np.nan
+    a.calc_mismatch_matrix()
+    problem, start = a._swap_problem()
+    link = np.array(problem.link_log_prob)
+    ss_ids = a._label_registry().ss_ids
+
+    def chain_score(chain):
+        ids = ss_ids(chain)
+        return link[ids[:-1], ids[1:]].sum()
+
+    # A correct linked chain scores better than a chain through spin systems
+    # with no i-1 shifts, which have nothing to compare
+    correct = chain_score(["   7K", "   8I", "   9V", "  10W"])
+    assert correct > chain_score(["   7K"] + blank)
+    assert chain_score(["   7K"] + blank) == 3 * NEUTRAL_LINK_LOG_PROB
+
+
+def test_cached_log_prob_matrix(tmp_path, monkeypatch):
+    a = _assigner(60)
+    a.cache = MatrixCache(tmp_path / "cache")
+    a.diagnostics = Diagnostics(tmp_path / "diagnostics", "summary")
+    expected = a.calc_log_prob_matrix()
+    a.calc_marginal_prob_matrix()
+
+    # A cache hit resets the same state, and records the same diagnostics
+    assert_frame_equal(a.calc_log_prob_matrix(), expected)
+    assert a.marginal_prob_matrix is None
+    names = [e["name"] for e in a.diagnostics.index()]
+    assert names.count("log_prob_matrix") == 2
+
+    # The model files are only read when they're first loaded by the registry
+    a.pars["delta_correlation"] = True
+    atoms = list(a.pars["atom_set"].intersection(a.obs.columns))
+    key = a._log_prob_cache_key(atoms, a.pars["atom_sd"], 1, 0.01)
+
+    def read_bytes(path):
+        raise AssertionError("%s was read again" % path)
+    monkeypatch.setattr(Path, "read_bytes", read_bytes)
+    assert a._log_prob_cache_key(atoms, a.pars["atom_sd"], 1, 0.01) == key
+
+
+def test_find_joint_assignment():
+    a = _assigner(60)
+    a.calc_mismatch_matrix()
+    problem, start = a._swap_problem()
+    assign_df = a.find_consistent_assignments(method="joint")
+    assert set(assign_df["SS_name"]) == set(a.assign_df["SS_name"])
+    assert assign_df["Res_name"].is_unique
+
+    # The joint objective is at least as good as for the best assignment by
+    # predictions alone, or the iterative method
+    row_pos = pd.Series(np.arange(len(a.log_prob_matrix)), index=a.log_prob_matrix.index)
+    col_pos = pd.Series(np.arange(len(a.log_prob_matrix)), index=a.log_prob_matrix.columns)
+
+    def objective(df):
+        row_to_col = np.empty(problem.n, dtype=int)
+        row_to_col[row_pos[df["SS_name"]].to_numpy()] = col_pos[df["Res_name"]].to_numpy()
+        return problem.score(row_to_col)
+
+    iterative_df = a.find_consistent_assignments(method="iterative")
+    assert objective(assign_df) >= objective(a.assign_df)
+    assert objective(assign_df) >= objective(iterative_df) - 1e-6
+
+
+def test_joint_assignment_solves():
+    # The linearisation converges in a bounded number of solves, without
+    # needing the annealing
+    a = _assigner()
+    a.calc_mismatch_matrix()
+    problem, start = a._swap_problem()
+    result = optimise_joint(problem, start, seed=0)
+    assert 0 < result.n_solves <= 20
+    assert all(i.method != "anneal" for i in result.history)
+    assert result.objective >= problem.score(start)
+
+    # The cap includes rejected steps
+    capped = optimise_joint(problem, start, steps=(1, 0.5, 0.25), max_solves=5, betas=())
+    assert capped.n_solves == 5
+
+
+def test_find_joint_assignment_fresh_assigner():
+    # The link terms are included even if calc_mismatch_matrix() hasn't been run
+    a = _assigner(60)
+    assert a.mismatch_matrix is None
+    assign_df = a.find_consistent_assignments(method="joint")
+    assert a.mismatch_matrix is not None
+
+    b = _assigner(60)
+    b.calc_mismatch_matrix()
+    expected = b.find_consistent_assignments(method="joint")
+    assert_frame_equal(assign_df, expected)
+
+
+def test_find_best_assignment_overlay():
+    a = _assigner(60)
+    log_prob_matrix = a.log_prob_matrix
+    rng = np.random.default_rng(0)
+    overlay = ConstraintOverlay(log_prob_matrix.to_numpy(dtype=float))
+    rows = rng.integers(len(log_prob_matrix.index), size=100)
+    cols = rng.integers(len(log_prob_matrix.columns), size=100)
+    overlay.add_penalty(rows, cols, -1000)
+    overlay.fix([3], [5])
+
+    penalised = log_prob_matrix + overlay.penalty
+    inc = pd.DataFrame({"SS_name": log_prob_matrix.index[[3]],
+                        "Res_name": log_prob_matrix.columns[[5]]})
+    exc = a.assign_df.loc[a.assign_df.index[:5], ["SS_name", "Res_name"]]
+    expected = a.find_best_assignment(penalised, inc=inc, exc=exc)
+    matching = a.find_best_assignment(log_prob_matrix, exc=exc, overlay=overlay)
+    assert_frame_equal(matching.reset_index(drop=True).sort_values("SS_name"),
+                       expected.reset_index(drop=True).sort_values("SS_name"))
+    # The overlay isn't changed by the extra constraints
+    assert overlay.forbidden is None
+
+
+def test_assign_by_fragments():
+    a = _assigner()
+    a.calc_mismatch_matrix()
+    fragment_df = a.find_fragments()
+    assert fragment_df["SS_name"].is_unique
+    assert (fragment_df.groupby("Fragment").size() >= 3).all()
+
+    assign_df = a.assign_by_fragments()
+    assert assign_df["SS_name"].is_unique and assign_df["Res_name"].is_unique
+    assert len(assign_df) == len(a.log_prob_matrix.index)
+    # Each placed fragment is on consecutive residues, in order
+    placed = assign_df.dropna(subset=["Fragment"]).merge(fragment_df, on=["SS_name", "Fragment"])
+    assert len(placed) > 0
+    for _, df in placed.groupby("Fragment"):
+        df = df.sort_values("Position")
+        assert (np.diff(df["Res_N"]) == 1).all()
+
+
+def test_label_registry():
+    a = _assigner(n_obs=30)
+    labels = a._label_registry()
+    assert labels.matches(a.log_prob_matrix)
+    assert labels.dummy_ss.sum() == a.obs["Dummy_SS"].sum()
+    assert labels.dummy_res.sum() == a.preds["Dummy_res"].sum()
+    # The neighbour ids agree with the residue numbers
+    has_prev = np.flatnonzero(labels.prev_res >= 0)
+    assert (labels.res_n[labels.prev_res[has_prev]] == labels.res_n[has_prev] - 1).all()
+
+    # The registry is remade if the matrices no longer match it
+    a.labels = None
+    assert a._label_registry().matches(a.log_prob_matrix)
+    a.log_prob_matrix = a.log_prob_matrix.iloc[:, ::-1]
+    with pytest.raises(ValueError):
+        a._label_registry()
+
+
+def test_assignment_session():
+    a = _assigner(n_obs=40)
+    session = a.start_session()
+    assert a.session is session
+    assert_frame_equal(session.solution()[["SS_name", "Res_name"]].reset_index(drop=True),
+                       a.assign_df[["SS_name", "Res_name"]].reset_index(drop=True))
+
+    best = a.assign_df.set_index("SS_name")["Res_name"]
+    ss = list(best.index[:3])
+    session.forbid(ss[0], best[ss[0]])
+    session.fix(ss[1], best[ss[2]])
+    # A residue with no spin system must be given one
+    unassigned = a.assign_df.loc[a.assign_df["Dummy_SS"].eq(True), "Res_name"].iloc[0]
+    session.forbid(a.obs.index[a.obs["Dummy_SS"].eq(True)][0], unassigned)
+
+    inc, exc = session.constraints()
+    assert list(inc["SS_name"]) == [ss[1]] and len(exc) == 2
+    assign_df = session.solution().set_index("SS_name")
+    assert assign_df.loc[ss[0], "Res_name"] != best[ss[0]]
+    assert assign_df.loc[ss[1], "Res_name"] == best[ss[2]]
+    assert not assign_df.loc[assign_df["Res_name"] == unassigned, "Dummy_SS"].any()
+    expected = a.find_best_assignment(a.log_prob_matrix, inc=inc, exc=exc)
+    assert np.isclose(a.calc_overall_matching_prob(assign_df.reset_index()),
+                      a.calc_overall_matching_prob(expected))
+
+    # Starting a session with the same constraints gives the same assignment
+    restarted = a.start_session(inc, exc).solution()
+    assert_frame_equal(restarted.reset_index(drop=True), assign_df.reset_index()[restarted.columns])
+
+    session.release(ss[1])
+    session.release()
+    assert len(session.constraints()[0]) == 0
+    assert np.isclose(a.calc_overall_matching_prob(session.solution()),
+                      a.calc_overall_matching_prob(a.assign_df))
+
+
+def test_link_index_matches_mismatch_matrix():
+    a = _assigner()
+    a.calc_mismatch_matrix()
+    index = a.calc_link_index()
+    assert a.link_index is index and index.n == len(a.obs.index)
+    mismatch = a.mismatch_matrix.loc[a.obs.index, a.obs.index].to_numpy(dtype=float)
+    n_links = a.consistent_links_matrix.loc[a.obs.index, a.obs.index].to_numpy()
+    rows = np.repeat(np.arange(index.n), np.diff(index.indptr))
+    assert (index.mismatch == mismatch[rows, index.indices]).all()
+    assert (index.n_links == n_links[rows, index.indices]).all()
+    # Every pair with a good link and a small mismatch is in the index
+    assert 0 < ((mismatch <= 0.2) & (n_links > 0)).sum() <= index.nnz
+
+
+def test_confidence_table():
+    # The table agrees with the original classification of the link
+    # confidence letters
+    letters = "NWSX"
+    conf2 = pd.Series([m1 + p1 for m1 in letters for p1 in letters])
+    conf2 = conf2.replace(["WS", "NS", "XS", "NW", "XW", "XN"],
+                          ["SW", "SN", "SX", "WN", "WX", "NX"])
+    confidence = conf2.replace(["SS", "SW", "SN", "WW"], "High")
+    confidence = confidence.replace(["SX", "WN"], "Medium")
+    confidence = confidence.replace("WX", "Low")
+    confidence = confidence.replace(["NX", "XX"], "Unreliable")
+    confidence = confidence.replace("NN", "Undefined")
+    assert list(CONFIDENCE_TABLE.ravel()) == list(confidence)
+
+
+def test_check_matching_consistency():
+    a = _assigner()
+    matching = a.assign_df[["SS_name", "Res_name"]].copy()
+    result = a.check_matching_consistency(matching.copy())
+    assert list(result.columns) == ["SS_name", "Res_name", "Max_mismatch_m1", "Max_mismatch_p1",
+                                    "Max_mismatch", "Num_good_links_m1", "Num_good_links_p1",
+                                    "Num_good_links", "Confidence"]
+    assert list(result.index) == list(matching["Res_name"])
+    assert (result["Num_good_links"] == result["Num_good_links_m1"]
+            + result["Num_good_links_p1"]).all()
+    # Residues without an i-1 neighbour have no i-1 mismatch
+    no_m1 = a.preds.loc[result.index, "Res_name_m1"].isna()
+    assert result.loc[no_m1, "Max_mismatch_m1"].isna().all()
+    assert (result.loc[no_m1, "Num_good_links_m1"] == 0).all()
+
+    # Residues missing from a partial matching have no links
+    partial = a.check_matching_consistency(matching.iloc[:-5].copy())
+    assert len(partial) == len(result)
+    assert partial["SS_name"].isna().sum() == 5
+    assert (partial.loc[partial["SS_name"].isna(), "Confidence"] == "Undefined").all()
+
+
+def test_check_matching_consistency_threshold():
+    # The result only depends on the threshold, not on a link index left
+    # from a larger threshold
+    a = _assigner()
+    matching = a.assign_df[["SS_name", "Res_name"]].copy()
+    expected = a.check_matching_consistency(matching.copy(), 0.2)
+    a.check_matching_consistency(matching.copy(), 1.0)
+    assert a.link_index.window == 1.0
+    assert_frame_equal(a.check_matching_consistency(matching.copy(), 0.2), expected)
+
+    # The link index is recalculated after obs is prepared again
+    a.prepare_obs_preds()
+    assert a.link_index is None
+
+
+def test_sweep_link_thresholds():
+    a = _assigner()
+    thresholds = [0.3, 0.1, 0.2]
+    summary = a.sweep_link_thresholds(thresholds)
+    assert list(summary.index) == sorted(thresholds)
+    for threshold in thresholds:
+        a.calc_link_index(threshold)
+        result = a.check_matching_consistency(a.assign_df[["SS_name", "Res_name"]].copy(),
+                                              threshold)
+        counts = result["Confidence"].value_counts()
+        for level in ["High", "Medium", "Low", "Unreliable", "Undefined"]:
+            assert summary.loc[threshold, level] == counts.get(level, 0)
+        assert summary.loc[threshold, "Good_links"] == result["Num_good_links_p1"].sum()
@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from lib.cache_lib import MatrixCache, hash_inputs
+
+
+def _matrix(n, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(rng.normal(size=(n, n)),
+                      index=["%dA" % i for i in range(n)],
+                      columns=["%dR" % i for i in range(n)])
+    df.index.name = "Res_name"
+    df.columns.name = "SS_name"
+    return df
+
+
+def test_hash_inputs():
+    df = _matrix(3)
+    assert hash_inputs(df, {"a": {1, 2}}) == hash_inputs(df.copy(), {"a": {2, 1}})
+    assert hash_inputs(df, 0.2) != hash_inputs(df, 0.3)
+
+    changed = df.copy()
+    changed.iloc[1, 1] += 1e-9
+    assert hash_inputs(df) != hash_inputs(changed)
+
+
+def test_save_and_load(tmp_path):
+    cache = MatrixCache(tmp_path)
+    df = _matrix(4)
+    assert cache.load("log_prob", "abc") is None
+
+    cache.save("log_prob", "abc", {"log_prob_matrix": df})
+    loaded = cache.load("log_prob", "abc")["log_prob_matrix"]
+    assert_frame_equal(loaded, df)
+
+    # Modifying the loaded matrix doesn't affect the cache
+    loaded.iloc[0, 0] = 100
+    assert_frame_equal(cache.load("log_prob", "abc")["log_prob_matrix"], df)
+
+
+def test_eviction(tmp_path):
+    cache = MatrixCache(tmp_path)
+    for i in range(3):
+        cache.save("log_prob", str(i), {"log_prob_matrix": _matrix(50, i)})
+        os.utime(tmp_path / ("log_prob-%d" % i), (1000 + i, 1000 + i))
+    entry_size = sum(f.stat().st_size for f in (tmp_path / "log_prob-0").iterdir())
+
+    # Loading entry 0 makes entry 1 the least recently used
+    cache.load("log_prob", "0")
+    cache.max_bytes = 2 * entry_size
+    cache.evict()
+
+    assert cache.load("log_prob", "1") is None
+    assert cache.load("log_prob", "0") is not None
+    assert cache.load("log_prob", "2") is not None
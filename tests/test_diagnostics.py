@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+from lib.diagnostics_lib import Diagnostics, OFF, SUMMARY, DETAIL
+
+
+def _matrix():
+    df = pd.DataFrame(np.arange(6, dtype=float).reshape(2, 3),
+                      index=["1A", "2A"], columns=["1R", "2R", "3R"])
+    df.index.name = "Res_name"
+    df.columns.name = "SS_name"
+    return df
+
+
+def test_off_by_default(tmp_path):
+    diagnostics = Diagnostics()
+    assert not diagnostics.enabled(SUMMARY)
+
+    def fail():
+        raise AssertionError("value should not be evaluated")
+
+    assert diagnostics.record("log_prob_matrix", fail, SUMMARY) is None
+    with pytest.raises(ValueError):
+        Diagnostics(level="detail")
+
+
+def test_levels(tmp_path):
+    diagnostics = Diagnostics(tmp_path, "summary")
+    assert diagnostics.record("obs", _matrix, DETAIL) is None
+    assert diagnostics.record("log_prob_matrix", _matrix, SUMMARY) is not None
+    assert [e["name"] for e in diagnostics.index()] == ["log_prob_matrix"]
+    assert not list(tmp_path.glob("*.txt"))
+
+
+def test_record_and_load(tmp_path):
+    diagnostics = Diagnostics(tmp_path, DETAIL)
+    mixed = pd.DataFrame({"SS_name": ["1A", "2A"], "H": [8.1, np.nan]}, index=["1A", "2A"])
+    diagnostics.record("log_prob_matrix", _matrix())
+    diagnostics.record("obs", mixed)
+    diagnostics.record("array", np.eye(3))
+    diagnostics.record("pars", {"atom_set": {"H", "N"}, "sf": 1})
+
+    assert_frame_equal(diagnostics.load("log_prob_matrix"), _matrix())
+    assert diagnostics.load("obs")["H"].iloc[0] == 8.1
+    assert (diagnostics.load("array") == np.eye(3)).all()
+    assert diagnostics.load("pars") == {"atom_set": ["H", "N"], "sf": 1}
+    assert "2R" in diagnostics.format_text("log_prob_matrix")
+
+    # Later artefacts with the same name don't overwrite earlier ones
+    diagnostics.record("log_prob_matrix", _matrix() + 1)
+    assert len(diagnostics.index()) == 5
+    assert diagnostics.load("log_prob_matrix").iloc[0, 0] == 1
+
+
+def test_text_output(tmp_path):
+    diagnostics = Diagnostics(tmp_path, SUMMARY, text=True)
+    diagnostics.record("log_prob_matrix", _matrix(), SUMMARY)
+    text_file, = tmp_path.glob("*.txt")
+    assert text_file.read_text() == _matrix().to_string()
+
+    diagnostics.configure(level=OFF)
+    assert not diagnostics.enabled(SUMMARY)
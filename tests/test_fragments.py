@@ -0,0 +1,44 @@
+import numpy as np
+
+from lib.fragment_lib import link_graph, linear_fragments, placement_scores, place_fragments
+
+
+def test_linear_fragments():
+    n = 10
+    consistent_links = np.zeros((n, n))
+    # A chain 0 -> 1 -> 2 -> 3, a branch 4 -> 5 or 6 (so 4's links are
+    # ambiguous, but 6 -> 7 isn't), and a closed loop 8 -> 9 -> 8
+    for a, b in [(0, 1), (1, 2), (2, 3), (4, 5), (4, 6), (6, 7), (8, 9), (9, 8)]:
+        consistent_links[a, b] = 3
+    mismatch = np.where(consistent_links > 0, 0.1, 1.0)
+    mismatch[2, 3] = 0.5  # Too large a mismatch to link
+
+    graph = link_graph(mismatch, consistent_links, threshold=0.2, min_links=2)
+    assert graph.nnz == 7
+    fragments = linear_fragments(graph, min_length=2)
+    assert [list(f) for f in fragments] == [[0, 1, 2], [6, 7]]
+    assert [list(f) for f in linear_fragments(graph, min_length=3)] == [[0, 1, 2]]
+    assert link_graph(mismatch, consistent_links, min_links=4).nnz == 0
+
+
+def test_place_fragments():
+    rng = np.random.default_rng(0)
+    log_prob = rng.normal(size=(8, 10)) - 5
+    res_n = np.array([1, 2, 3, 4, 5, 7, 8, 9, 10, 11])
+    # Fragment 0 clearly belongs at positions 1-3, and fragment 1 at 5-6.
+    # Fragment 2 would overlap fragment 0 with lower log odds.
+    fragments = [np.array([0, 1, 2]), np.array([3, 4]), np.array([5, 6])]
+    log_prob[[0, 1, 2], [1, 2, 3]] = 20
+    log_prob[[3, 4], [5, 6]] = 20
+    log_prob[[5, 6], [2, 3]] = 12
+
+    scores = placement_scores(log_prob, fragments[0], res_n)
+    assert len(scores) == 8
+    # Residues 5 and 7 aren't consecutive
+    assert np.isneginf(scores[[3, 4]]).all()
+    assert np.isclose(scores[1], 60)
+
+    placed = place_fragments(log_prob, fragments, res_n, min_log_odds=10)
+    assert [(p.fragment, p.start) for p in placed] == [(0, 1), (1, 5)]
+    assert all(p.log_odds >= 10 for p in placed)
+    assert place_fragments(log_prob, fragments, res_n, min_log_odds=1000) == []
@@ -156,4 +156,67 @@ def test_import_aa_type_info_nef():
         entry = Entry.from_file(file_handle)
     result = importer.import_aa_type_info_nef(entry, frame_name='default')
 
-    assert_frame_equal(EXPECTED_IN, result, check_exact=False, rtol=0.01)
\ No newline at end of file
+    assert_frame_equal(EXPECTED_IN, result, check_exact=False, rtol=0.01)
+
+def test_import_3d_peaks_nearest_root():
+    data = Path(__file__).parent.parent / 'data' / 'P3a_L273R'
+    importer = SNAPS_importer()
+    roots = importer.import_hsqc_peaks(data / 'hsqc.txt', 'ccpn')
+    peaks = importer.import_3d_peaks(data / 'hncacb.txt', 'ccpn', 'hncacb',
+                                     assign_nearest_root=True)
+
+    # Compare with the distances to every root
+    for i in peaks.index[::10]:
+        delta = ((roots["H"] - peaks.loc[i, "H"])**2
+                 + (0.2 * (roots["N"] - peaks.loc[i, "N"]))**2)**0.5
+        assert peaks.loc[i, "SS_name"] == roots.loc[delta.idxmin(), "SS_name"]
+
+    # Far away peaks are left unassigned
+    far = pd.DataFrame({"H": [8.0, 20.0, nan], "N": [120.0, 120.0, 120.0]})
+    assert pd.isna(importer.find_nearest_roots(far, max_distance=1)[1:]).all()
+    assert pd.isna(importer.find_nearest_roots(far)[2])
+    assert not pd.isna(importer.find_nearest_roots(far)[1])
+    cutoff = importer.import_3d_peaks(data / 'hncacb.txt', 'ccpn', 'hncacb',
+                                      assign_nearest_root=True, max_distance=0.02)
+    assert 0 < cutoff["SS_name"].isna().sum() < len(cutoff)
+    assigned = cutoff["SS_name"].notna()
+    assert (cutoff.loc[assigned, "SS_name"] == peaks.loc[assigned, "SS_name"]).all()
+
+def test_find_shifts_from_peaks():
+    data = Path(__file__).parent.parent / 'data' / 'P3a_L273R'
+    importer = SNAPS_importer()
+    importer.import_hsqc_peaks(data / 'hsqc.txt', 'ccpn')
+    importer.import_3d_peaks(data / 'hnco.txt', 'ccpn', 'hnco')
+    importer.import_3d_peaks(data / 'cbcaconh.txt', 'ccpn', 'hncocacb')
+    importer.import_3d_peaks(data / 'hncacb.txt', 'ccpn', 'hncacb')
+    result = importer.find_shifts_from_peaks()
+
+    # Shifts found by the original per spin system implementation
+    expected = pd.read_csv(TEST_DATA / 'P3a_L273R_shifts_from_peaks.txt', sep='\t')
+    expected.index = expected['SS_name'].to_numpy()
+    assert_frame_equal(expected, result, check_exact=False, rtol=1e-6)
+
+
+def test_find_shifts_from_peaks_ca_cb_rules():
+    importer = SNAPS_importer()
+    importer.roots = pd.DataFrame({'SS_name': ['a', 'b', 'c', 'd', 'e'],
+                                   'H': 8.0, 'N': 120.0})
+    importer.peaklists['hncacb'] = pd.DataFrame({
+        'SS_name': ['a', 'b', 'c', 'c', 'c', 'd', 'd', 'e', 'e', 'x'],
+        'C': [55.0, 39.0, 52.0, 40.0, 60.0, 45.0, 38.0, 45.0, 38.0, 50.0],
+        'Height': [1.0, -1.0, 4.0, -3.0, 1.0, 5.0, -2.0, 3.0, -2.0, 1.0]})
+    importer.peaklists['hnco'] = pd.DataFrame({
+        'SS_name': ['b', 'b', 'a'], 'C': [175.0, 176.0, 177.0],
+        'Height': [1.0, 2.0, -1.0]})
+    obs = importer.find_shifts_from_peaks()
+
+    assert list(obs.columns) == ['SS_name', 'H', 'N', 'CA', 'CB', 'C_m1']
+    # Single peaks are CA above 41 ppm, otherwise CB
+    assert obs.loc['a', 'CA'] == 55.0 and pd.isna(obs.loc['a', 'CB'])
+    assert obs.loc['b', 'CB'] == 39.0 and pd.isna(obs.loc['b', 'CA'])
+    # Only the two strongest peaks are used
+    assert obs.loc['c', ['CA', 'CB']].tolist() == [52.0, 40.0]
+    # Glycine CA, if much stronger than the next peak
+    assert obs.loc['d', 'CA'] == 45.0 and pd.isna(obs.loc['d', 'CB'])
+    assert obs.loc['e', ['CA', 'CB']].tolist() == [45.0, 38.0]
+    assert obs.loc[['a', 'b'], 'C_m1'].tolist() == [177.0, 176.0]
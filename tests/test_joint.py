@@ -0,0 +1,65 @@
+from itertools import permutations
+
+import numpy as np
+
+from lib.mcmc_lib import SwapProblem
+from lib.joint_lib import optimise_joint, linearised_log_prob
+
+
+def _problem(n=7, seed=1, links=True):
+    rng = np.random.default_rng(seed)
+    prev_col = np.array([-1, 0, 1, 2, -1, 4, 5])[:n]
+    if not links:
+        return SwapProblem(rng.normal(size=(n, n)))
+    return SwapProblem(rng.normal(size=(n, n)), prev_col, rng.normal(size=(n, n)) * 2)
+
+
+def test_linearised_log_prob():
+    problem = _problem()
+    n = problem.n
+    row_to_col = np.random.default_rng(2).permutation(n)
+    scores = linearised_log_prob(np.array(problem.log_prob), np.array(problem.prev_col),
+                                 np.array(problem.next_col), np.array(problem.link_log_prob),
+                                 row_to_col)
+    # Swapping two rows changes the linearised scores by the same amount as
+    # the objective, as long as their columns aren't adjacent
+    for r1 in range(n):
+        for r2 in range(n):
+            c1, c2 = row_to_col[r1], row_to_col[r2]
+            if r1 == r2 or c2 in (problem.prev_col[c1], problem.next_col[c1]):
+                continue
+            swapped = row_to_col.copy()
+            swapped[[r1, r2]] = c2, c1
+            expected = problem.score(swapped) - problem.score(row_to_col)
+            delta = scores[r1, c2] + scores[r2, c1] - scores[r1, c1] - scores[r2, c2]
+            assert np.isclose(delta, expected)
+
+
+def test_optimise_joint_finds_optimum():
+    for seed in range(5):
+        problem = _problem(seed=seed)
+        start = list(range(problem.n))
+        best = max(problem.score(p) for p in permutations(range(problem.n)))
+        # Annealing is needed to be sure of the global optimum
+        result = optimise_joint(problem, start, steps_per_stage=2000, anneal_if_converged=True,
+                                seed=0)
+        assert np.isclose(result.objective, best)
+        assert np.isclose(problem.score(result.row_to_col), result.objective)
+
+        # The result is the best assignment in the history
+        objectives = [i.objective for i in result.history]
+        assert np.isclose(objectives[0], problem.score(start))
+        assert np.isclose(max(objectives), result.objective)
+        assert result.n_solves > 0
+
+        # Linearisation alone can't do worse than the start
+        linearised = optimise_joint(problem, start, betas=())
+        assert linearised.objective >= problem.score(start)
+        assert all(i.method != "anneal" for i in linearised.history)
+
+
+def test_optimise_joint_without_links():
+    problem = _problem(links=False)
+    result = optimise_joint(problem, [2, 0, 1, 3, 4, 5, 6])
+    assert list(result.row_to_col) == [2, 0, 1, 3, 4, 5, 6]
+    assert result.n_solves == 0
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from lib.label_lib import LabelRegistry
+
+
+def _obs_preds():
+    obs = pd.DataFrame({"Dummy_SS": [False, False, True]}, index=["a", "b", "DSS_1"])
+    preds = pd.DataFrame({"Res_N": [1, 2, 4, np.nan],
+                          "Res_name_m1": [np.nan, "1A", np.nan, np.nan],
+                          "Res_name_p1": ["2G", np.nan, np.nan, np.nan],
+                          "Dummy_res": [False, False, False, True]},
+                         index=["1A", "2G", "4K", "DR_1"])
+    return obs, preds
+
+
+def test_from_obs_preds():
+    labels = LabelRegistry.from_obs_preds(*_obs_preds())
+    assert (labels.n_ss, labels.n_res) == (3, 4)
+    assert list(labels.dummy_ss) == [False, False, True]
+    assert list(labels.dummy_res) == [False, False, False, True]
+    assert list(labels.prev_res) == [-1, 0, -1, -1]
+    assert list(labels.next_res) == [1, -1, -1, -1]
+    assert list(labels.res_n[:3]) == [1, 2, 4]
+
+    # Without the optional columns, there are no dummies or neighbours
+    labels = LabelRegistry.from_obs_preds(pd.DataFrame(index=["a"]), pd.DataFrame(index=["1A"]))
+    assert not labels.dummy_ss.any() and not labels.dummy_res.any()
+    assert list(labels.prev_res) == [-1]
+
+
+def test_matching_round_trip():
+    labels = LabelRegistry.from_obs_preds(*_obs_preds())
+    matching = labels.matching([2, 0], [3, 1], Rank=[1, 2])
+    assert list(matching.columns) == ["SS_name", "Res_name", "Rank"]
+    assert list(matching["SS_name"]) == ["DSS_1", "a"]
+    assert list(matching["Res_name"]) == ["DR_1", "2G"]
+    ss_ids, res_ids = labels.matching_ids(matching)
+    assert list(ss_ids) == [2, 0] and list(res_ids) == [3, 1]
+
+    assert labels.matching([], []).empty
+    with pytest.raises(KeyError):
+        labels.res_ids(["1A", "3X"])
+
+
+def test_matches():
+    labels = LabelRegistry.from_obs_preds(*_obs_preds())
+    matrix = pd.DataFrame(np.zeros((3, 4)), index=labels.ss_names, columns=labels.res_names)
+    assert labels.matches(matrix)
+    assert not labels.matches(matrix.iloc[::-1])
@@ -0,0 +1,181 @@
+from itertools import permutations
+
+import numpy as np
+import pytest
+from scipy.optimize import linear_sum_assignment
+
+from lib.lap_lib import (solve_with_dummies, DualAssignment, matching_with_dummies,
+                         ConstraintOverlay, ConstraintSession)
+
+
+def _padded_optimum(costs, n_dummy_rows, n_dummy_cols, row_dummy_cost, col_dummy_cost):
+    N, M = costs.shape
+    size = N + n_dummy_rows
+    padded = np.zeros((size, size))
+    padded[:N, :M] = costs
+    padded[:N, M:] = row_dummy_cost[:, np.newaxis]
+    padded[N:, :M] = col_dummy_cost[np.newaxis, :]
+    row_ind, col_ind = linear_sum_assignment(padded)
+    return padded[row_ind, col_ind].sum()
+
+
+def _total_cost(costs, row_ind, col_ind, row_dummy_cost, col_dummy_cost):
+    unassigned_rows = np.setdiff1d(np.arange(costs.shape[0]), row_ind)
+    unassigned_cols = np.setdiff1d(np.arange(costs.shape[1]), col_ind)
+    return (costs[row_ind, col_ind].sum() + row_dummy_cost[unassigned_rows].sum()
+            + col_dummy_cost[unassigned_cols].sum())
+
+
+@pytest.mark.parametrize("N, M, n_dummy_rows, n_dummy_cols",
+                         [(6, 6, 0, 0), (4, 7, 3, 0), (7, 4, 0, 3), (5, 6, 3, 2)])
+def test_solve_with_dummies_matches_padding(N, M, n_dummy_rows, n_dummy_cols):
+    rng = np.random.default_rng(N * 10 + M)
+    costs = rng.normal(size=(N, M))
+    row_dummy_cost = np.where(rng.random(N) < 0.3, 10.0, 0.0)
+    col_dummy_cost = np.where(rng.random(M) < 0.3, 10.0, 0.0)
+
+    row_ind, col_ind = solve_with_dummies(costs, n_dummy_rows, n_dummy_cols,
+                                          row_dummy_cost, col_dummy_cost)
+
+    assert len(set(row_ind)) == len(row_ind) and len(set(col_ind)) == len(col_ind)
+    assert np.isclose(_total_cost(costs, row_ind, col_ind, row_dummy_cost, col_dummy_cost),
+                      _padded_optimum(costs, n_dummy_rows, n_dummy_cols,
+                                      row_dummy_cost, col_dummy_cost))
+
+
+def test_solve_with_dummies_unbalanced():
+    with pytest.raises(ValueError):
+        solve_with_dummies(np.zeros((3, 5)), n_dummy_rows=1)
+
+
+def test_dual_assignment_repair():
+    rng = np.random.default_rng(1)
+    for _ in range(50):
+        n = rng.integers(2, 25)
+        solution = DualAssignment(rng.normal(size=(n, n)))
+        for _ in range(4):
+            # Penalise either an assigned pair or a whole row of pairs
+            row = rng.integers(n)
+            cols = [solution.row_to_col[row]] if rng.random() < 0.7 else np.arange(n // 2)
+            solution.set_costs([row], cols, 5.0)
+
+            row_ind, col_ind = linear_sum_assignment(solution.costs)
+            assert np.isclose(solution.total_cost(), solution.costs[row_ind, col_ind].sum())
+            assert sorted(solution.row_to_col) == list(range(n))
+            reduced = solution.costs - solution.u[:, np.newaxis] - solution.v[np.newaxis, :]
+            assert reduced.min() > -1e-9
+
+
+def test_dual_assignment_decrease():
+    rng = np.random.default_rng(2)
+    for _ in range(50):
+        n = rng.integers(2, 25)
+        solution = DualAssignment(rng.normal(size=(n, n)))
+        for _ in range(4):
+            # Change the costs of a row or a column, up and down
+            line = rng.integers(n)
+            if rng.random() < 0.5:
+                solution.set_costs([line], np.arange(n), rng.normal(size=n) - 1)
+            else:
+                solution.set_costs(np.arange(n), [line], rng.normal(size=(n, 1)) - 1)
+
+            row_ind, col_ind = linear_sum_assignment(solution.costs)
+            assert np.isclose(solution.total_cost(), solution.costs[row_ind, col_ind].sum())
+            assert sorted(solution.row_to_col) == list(range(n))
+            reduced = solution.costs - solution.u[:, np.newaxis] - solution.v[np.newaxis, :]
+            assert reduced.min() > -1e-9
+
+
+def _constrained_optimum(costs, dummy_rows, dummy_cols, fixed, forbidden):
+    """Brute force the best assignment with fixed and forbidden pairs, where
+    all dummies count as the same"""
+    costs = costs.copy()
+    costs[dummy_rows, :] = 0
+    costs[:, dummy_cols] = 0
+    best = np.inf
+    for perm in permutations(range(len(costs))):
+        pairs = [(r, c) for r, c in enumerate(perm)]
+        ok = all(any(r == fr and (c == fc or dummy_cols[c] & dummy_cols[fc])
+                     for r, c in pairs) for fr, fc in fixed if not dummy_rows[fr])
+        ok &= not any((r, c) in forbidden or
+                      (dummy_cols[c] and any(fr == r and dummy_cols[fc] for fr, fc in forbidden))
+                      for r, c in pairs if not dummy_rows[r])
+        if ok:
+            best = min(best, sum(costs[r, c] for r, c in pairs))
+    return best
+
+
+def test_constraint_session():
+    rng = np.random.default_rng(3)
+    n = 6
+    dummy_rows = np.zeros(n, dtype=bool)
+    dummy_cols = np.array([False, False, False, False, True, True])
+    costs = rng.normal(size=(n, n))
+    session = ConstraintSession(costs, dummy_rows, dummy_cols)
+    fixed, forbidden = set(), set()
+    for _ in range(30):
+        row, col = rng.integers(n), rng.integers(n)
+        action = rng.choice(["fix", "forbid", "release"])
+        if action == "fix":
+            session.fix(row, col)
+        elif action == "forbid":
+            session.forbid(row, col)
+        else:
+            session.release(row)
+        (fixed_rows, fixed_cols), (forbidden_rows, forbidden_cols) = session.constraints()
+        fixed = set(zip(fixed_rows.tolist(), fixed_cols.tolist()))
+        forbidden = set(zip(forbidden_rows.tolist(), forbidden_cols.tolist()))
+        assert len(fixed_rows) == len(set(fixed_rows)) == len(set(fixed_cols))
+        if action == "fix":
+            assert (row, col) in fixed or dummy_cols[col] and row in fixed_rows
+        elif action == "forbid":
+            assert (row, col) in forbidden or dummy_cols[col] and row in forbidden_rows
+        else:
+            assert row not in fixed_rows and row not in forbidden_rows
+
+        expected = _constrained_optimum(costs, dummy_rows, dummy_cols, fixed, forbidden)
+        if np.isfinite(expected):
+            assert len(session.broken()) == 0
+            assert np.isclose(session.solution.total_cost(), expected)
+
+    session.release()
+    assert session.constraints()[0][0].size == 0
+    rows, cols = session.pairs()
+    row_ind, col_ind = linear_sum_assignment(session.base)
+    assert np.isclose(session.base[rows, cols].sum(), session.base[row_ind, col_ind].sum())
+
+
+def test_matching_with_dummies():
+    dummy_rows = np.array([False, False, False, True, True])
+    dummy_cols = np.array([False, False, False, False, True])
+    # Row 1 is unassigned, and dummy row 4 has real column 3
+    rows, cols = matching_with_dummies([2, 4, 0, 1, 3], dummy_rows, dummy_cols)
+    assert list(rows) == [0, 2, 1, 3, 4]
+    assert list(cols) == [2, 0, 4, 1, 3]
+
+
+def test_constraint_overlay():
+    base = np.arange(20, dtype=float).reshape(4, 5)
+    overlay = ConstraintOverlay(base)
+    assert overlay.base is base
+    assert overlay.forbidden_block([0, 1], [0, 1]) is None
+
+    overlay.fix([1], [3])
+    overlay.forbid([0, 2], [1, 4])
+    overlay.add_penalty([0, 0, 2], 2, -100)
+    assert list(overlay.free_rows()) == [0, 2, 3]
+    assert list(overlay.free_cols()) == [0, 1, 2, 4]
+    assert [list(x) for x in overlay.fixed_pairs()] == [[1], [3]]
+
+    scores = overlay.scores([0, 2], [1, 2])
+    assert (scores == [[1, -198], [11, -88]]).all()
+    assert (overlay.forbidden_block([0, 2], [1, 4]) == [[True, False], [False, True]]).all()
+    assert overlay.max_abs_score() == 19 + 200
+    # The base is never modified
+    assert (base == np.arange(20).reshape(4, 5)).all()
+
+    copied = overlay.copy()
+    copied.fix([0], [0])
+    copied.add_penalty(3, 3, 1)
+    assert copied.base is base
+    assert overlay.row_fixed[0] == -1 and overlay.penalty[3, 3] == 0
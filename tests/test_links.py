@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from lib.link_lib import LinkIndex, threshold_sweep
+
+
+def _dense(i_shifts, i_m1_shifts, window):
+    """The mismatch and consistent links matrixes, calculated as
+    SNAPS_assigner.calc_mismatch_matrix() does"""
+    diff = np.abs(i_shifts[:, np.newaxis, :] - i_m1_shifts[np.newaxis, :, :])
+    mismatch = np.nan_to_num(diff, nan=0).max(axis=2)
+    n_links = (np.nan_to_num(diff, nan=np.inf) < window).sum(axis=2)
+    shared = (~np.isnan(diff)).any(axis=2)
+    return mismatch, n_links, shared
+
+
+def test_link_index():
+    rng = np.random.default_rng(0)
+    n, k, window = 60, 3, 0.2
+    i_shifts = rng.uniform(50, 55, size=(n, k))
+    i_m1_shifts = rng.uniform(50, 55, size=(n, k))
+    i_shifts[rng.random(size=(n, k)) < 0.2] = np.nan
+    i_m1_shifts[rng.random(size=(n, k)) < 0.2] = np.nan
+    i_m1_shifts[:5] = np.nan
+    # Some pairs on the edge of the window
+    i_m1_shifts[10, 0] = i_shifts[20, 0] + window
+
+    index = LinkIndex(i_shifts, i_m1_shifts, window)
+    mismatch, n_links, shared = _dense(i_shifts, i_m1_shifts, window)
+    consistent = shared & (mismatch <= window)
+    assert (index.shared_matrix() == shared).all()
+    assert index.nnz == consistent.sum()
+    assert (index.csr().toarray() == np.where(consistent, mismatch, 0)).all()
+    assert (index.csr(index.n_links).toarray() == np.where(consistent, n_links, 0)).all()
+
+    rows, cols = rng.integers(n, size=200), rng.integers(n, size=200)
+    pair_mismatch, pair_links = index.pair_stats(rows, cols)
+    assert (pair_mismatch == mismatch[rows, cols]).all()
+    assert (pair_links == n_links[rows, cols]).all()
+    # Good links can be counted at other thresholds
+    n_links_01 = _dense(i_shifts, i_m1_shifts, 0.1)[1]
+    assert (index.pair_stats(rows, cols, 0.1)[1] == n_links_01[rows, cols]).all()
+
+    for threshold in [0.1, window]:
+        for ss in range(n):
+            assert (index.allowed_prev(ss, threshold) == (mismatch[:, ss] <= threshold)).all()
+            assert (index.allowed_next(ss, threshold) == (mismatch[ss, :] <= threshold)).all()
+    with pytest.raises(ValueError):
+        index.allowed_prev(0, 0.3)
+
+
+def test_link_index_empty():
+    index = LinkIndex(np.full((4, 2), np.nan), np.full((4, 2), np.nan))
+    assert index.nnz == 0
+    assert index.allowed_next(1, 0.2).all()
+    assert index.pair_stats(np.array([0]), np.array([1]))[0][0] == 0
+
+
+def test_threshold_sweep():
+    rng = np.random.default_rng(1)
+    diff = rng.uniform(0, 0.5, size=(40, 3))
+    diff[rng.random(size=diff.shape) < 0.3] = np.nan
+    diff[0] = [0.1, 0.2, np.nan]  # On the thresholds
+    thresholds = [0.05, 0.1, 0.2, 0.4]
+    n_links, mismatched = threshold_sweep(diff, thresholds)
+    for t, threshold in enumerate(thresholds):
+        with np.errstate(invalid="ignore"):
+            assert (n_links[:, t] == (diff < threshold).sum(axis=1)).all()
+        assert (mismatched[:, t] == (np.nan_to_num(diff, nan=0).max(axis=1) > threshold)).all()
+    assert threshold_sweep(np.empty((0, 3)), thresholds)[0].shape == (0, 4)
@@ -0,0 +1,55 @@
+from itertools import permutations
+
+import numpy as np
+
+from lib.mcmc_lib import SwapProblem, parallel_tempering, effective_sample_size
+
+
+def _problem(n=5, seed=1):
+    rng = np.random.default_rng(seed)
+    prev_col = np.array([-1, 0, 1, -1, 3])[:n]
+    return SwapProblem(rng.normal(size=(n, n)), prev_col, rng.normal(size=(n, n)) * 0.5)
+
+
+def test_run_chain_score():
+    problem = _problem()
+    start = list(range(problem.n))
+    row_to_col, score, *_ = problem.run_chain(start, problem.score(start), 1, 1000, seed=3)
+    assert np.isclose(score, problem.score(row_to_col))
+
+
+def test_parallel_tempering_matches_posterior():
+    problem = _problem()
+    n = problem.n
+    expected = np.zeros((n, n))
+    for perm in permutations(range(n)):
+        expected[np.arange(n), perm] += np.exp(problem.score(perm))
+    expected /= expected.sum(axis=1, keepdims=True)
+
+    result = parallel_tempering(problem, list(range(n)), temperatures=(1, 2),
+                                steps_per_round=20000, n_rounds=10, seed=0)
+    assert np.allclose(result.visit_freq.sum(axis=1), 1)
+    assert np.abs(result.visit_freq - expected).max() < 0.02
+    assert result.n_rounds == 10
+    assert np.isclose(result.best_score, max(problem.score(p) for p in permutations(range(n))))
+
+
+def test_parallel_tempering_independent_of_jobs():
+    problem = _problem()
+    kwargs = dict(temperatures=(1, 2, 4), steps_per_round=1000, n_rounds=4, seed=5)
+    serial = parallel_tempering(problem, list(range(problem.n)), n_jobs=1, **kwargs)
+    parallel = parallel_tempering(problem, list(range(problem.n)), n_jobs=2, **kwargs)
+    assert np.array_equal(serial.visit_freq, parallel.visit_freq)
+    assert np.array_equal(serial.score_trace, parallel.score_trace)
+
+
+def test_effective_sample_size():
+    rng = np.random.default_rng(0)
+    white_noise = rng.normal(size=10000)
+    assert 8000 < effective_sample_size(white_noise) < 12000
+    # A strongly autocorrelated AR(1) series has far fewer effective samples
+    ar = np.zeros(10000)
+    for i in range(1, len(ar)):
+        ar[i] = 0.95 * ar[i - 1] + white_noise[i]
+    assert effective_sample_size(ar) < 1000
+    assert np.isnan(effective_sample_size(np.ones(100)))
@@ -0,0 +1,94 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from lib.model_registry_lib import ModelRegistry
+
+CONFIG_DIR = Path(__file__).parent.parent / 'config'
+
+MEAN = "C,0.1\nCAm1,-0.2\nH,0.0\n"
+COV = "Atom_type,C,CAm1,H\nC,1.0,0.1,0.0\nCAm1,0.1,0.9,0.0\nH,0.0,0.0,0.2\n"
+
+
+def _write_model(tmp_path, mean=MEAN, cov=COV):
+    mean_file = tmp_path / "d_mean.csv"
+    cov_file = tmp_path / "d_cov.csv"
+    mean_file.write_text(mean)
+    cov_file.write_text(cov)
+    return mean_file, cov_file
+
+
+def test_correlation_model_is_cached(tmp_path):
+    registry = ModelRegistry()
+    mean_file, cov_file = _write_model(tmp_path)
+
+    model = registry.correlation_model(mean_file, cov_file)
+    assert registry.correlation_model(mean_file, cov_file) is model
+
+    d_mean, d_cov, factors = model.arrays(["H", "CA_m1"])
+    np.testing.assert_array_equal(d_mean, [0.0, -0.2])
+    np.testing.assert_array_equal(d_cov, [[0.2, 0.0], [0.0, 0.9]])
+    assert 0 in factors
+    assert model.arrays(["H", "CA_m1"])[2] is factors
+
+
+def test_touched_file_with_same_contents_is_not_reloaded(tmp_path):
+    registry = ModelRegistry()
+    mean_file, cov_file = _write_model(tmp_path)
+    model = registry.correlation_model(mean_file, cov_file)
+
+    st = os.stat(cov_file)
+    os.utime(cov_file, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert registry.correlation_model(mean_file, cov_file) is model
+
+
+def test_changed_file_is_reloaded(tmp_path):
+    registry = ModelRegistry()
+    mean_file, cov_file = _write_model(tmp_path)
+    model = registry.correlation_model(mean_file, cov_file)
+
+    mean_file.write_text(MEAN.replace("0.1", "0.3"))
+    st = os.stat(mean_file)
+    os.utime(mean_file, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    new_model = registry.correlation_model(mean_file, cov_file)
+    assert new_model is not model
+    assert new_model.d_mean["C"] == 0.3
+
+
+def test_digests_follow_file_contents(tmp_path):
+    registry = ModelRegistry()
+    mean_file, cov_file = _write_model(tmp_path)
+    digests = registry.correlation_digests(mean_file, cov_file)
+    assert len(digests) == 2
+    assert registry.correlation_digests(mean_file, cov_file) == digests
+
+    mean_file.write_text(MEAN.replace("0.1", "0.3"))
+    st = os.stat(mean_file)
+    os.utime(mean_file, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    new_digests = registry.correlation_digests(mean_file, cov_file)
+    assert new_digests[0] != digests[0] and new_digests[1] == digests[1]
+
+
+def test_bad_covariance_is_rejected(tmp_path):
+    registry = ModelRegistry()
+    mean_file, cov_file = _write_model(tmp_path, cov=COV.replace("0.9", "-0.9"))
+    with pytest.raises(ValueError):
+        registry.correlation_model(mean_file, cov_file)
+
+
+def test_config_returns_a_copy():
+    registry = ModelRegistry()
+    pars = registry.config(CONFIG_DIR / 'config_yaml.txt')
+    pars["atom_sd"]["H"] = -1
+    assert registry.config(CONFIG_DIR / 'config_yaml.txt')["atom_sd"]["H"] != -1
+
+
+def test_correction_model_tables():
+    registry = ModelRegistry()
+    model = registry.correction_model(CONFIG_DIR / 'lin_model_shiftx2.csv')
+    grad, offset = model.tables(["H", "C_m1"])
+    assert model.tables(["H", "C_m1"])[0] is grad
+    assert grad.shape == offset.shape == (2, 21)
+    assert (grad[1] != 0).any()
@@ -0,0 +1,76 @@
+from itertools import permutations
+
+import numpy as np
+import pytest
+
+from lib.murty_lib import MurtyProblem, kbest_assignments, DUMMY
+
+
+def _brute_force(problem, included=(), excluded=()):
+    """Costs of every distinct assignment allowed by the constraints, in
+    increasing order"""
+    costs = {}
+    for perm in permutations(range(problem.n)):
+        perm = np.array(perm)
+        cost = problem.costs[np.arange(problem.n), perm].sum()
+        pairs = set(map(tuple, problem.pairs(perm)))
+        if (not np.isfinite(cost) or not pairs.issuperset(included)
+                or pairs.intersection(excluded)):
+            continue
+        key = frozenset(pairs)
+        costs[key] = min(costs.get(key, np.inf), cost)
+    return sorted(costs.values())
+
+
+def _problem(n, seed, dummy_rows=0, dummy_cols=0, forbidden=0.0, integer=False):
+    rng = np.random.default_rng(seed)
+    costs = rng.random((n, n)) * 10
+    if integer:
+        # Lots of ties
+        costs = np.round(costs)
+    costs[rng.random((n, n)) < forbidden] = np.inf
+    is_dummy_row = np.arange(n) >= n - dummy_rows
+    is_dummy_col = np.arange(n) >= n - dummy_cols
+    costs[is_dummy_row, :] = 0
+    costs[:, is_dummy_col] = 0
+    return MurtyProblem(costs, is_dummy_row, is_dummy_col)
+
+
+@pytest.mark.parametrize("n, dummy_rows, dummy_cols, forbidden, integer",
+                         [(5, 0, 0, 0, False), (6, 0, 0, 0.2, False), (5, 0, 0, 0, True),
+                          (6, 2, 0, 0, False), (6, 0, 3, 0.2, False), (5, 2, 0, 0, True)])
+def test_kbest_matches_brute_force(n, dummy_rows, dummy_cols, forbidden, integer):
+    for seed in range(5):
+        problem = _problem(n, seed, dummy_rows, dummy_cols, forbidden, integer)
+        expected = _brute_force(problem)
+        k = min(len(expected) + 2, 40)
+        ranked, pending = kbest_assignments(problem, k)
+
+        assert len(ranked) == min(k, len(expected))
+        assert np.allclose([node.cost for node in ranked], expected[:len(ranked)])
+        # Assignments differing only in their dummies aren't repeated
+        keys = {frozenset(map(tuple, problem.pairs(node.row_to_col))) for node in ranked}
+        assert len(keys) == len(ranked)
+        assert all(node.cost >= ranked[-1].cost for node in pending)
+
+
+def test_kbest_with_initial_constraints():
+    problem = _problem(6, 1, dummy_cols=2)
+    included = [(0, 1), (2, DUMMY)]
+    excluded = [(1, 2), (3, DUMMY)]
+    expected = _brute_force(problem, included, excluded)
+    ranked, _ = kbest_assignments(problem, 10, included, excluded)
+    assert np.allclose([node.cost for node in ranked], expected[:10])
+
+    # Constraints which can't be satisfied
+    assert kbest_assignments(problem, 10, [(0, 1)], [(0, 1)]) == ([], [])
+
+
+def test_kbest_independent_of_workers():
+    problem = _problem(40, 3, dummy_cols=5, integer=True)
+    expected, _ = kbest_assignments(problem, 30)
+    for n_jobs, batch_size in [(1, 7), (2, None)]:
+        ranked, _ = kbest_assignments(problem, 30, n_jobs=n_jobs, batch_size=batch_size)
+        assert [node.cost for node in ranked] == [node.cost for node in expected]
+        for node, expected_node in zip(ranked, expected):
+            assert (node.row_to_col == expected_node.row_to_col).all()
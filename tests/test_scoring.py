@@ -0,0 +1,155 @@
+from math import log10
+
+import numpy as np
+from numpy import nan
+from numpy.testing import assert_allclose, assert_array_equal
+import pandas as pd
+from scipy.stats import norm, multivariate_normal
+
+from lib.scoring_lib import (independent_log_prob, correlated_log_prob,
+                             compile_pred_correction, pred_correction_arrays,
+                             aa_mask, aa_string, aa_class_masks, residue_type_masks,
+                             aa_type_mismatch, ALL_AA_MASK)
+
+
+OBS = np.array([[8.1, 120.2, 56.3],
+                [7.6, nan, 61.1],
+                [8.9, 118.4, nan]])
+PREDS = np.array([[8.0, 121.0, 55.9],
+                  [7.8, 117.5, 60.2],
+                  [nan, 119.0, 45.1],
+                  [8.4, 122.3, 58.0]])
+SD = [0.454, 2.429, 0.932]
+D_MEAN = np.array([0.01, -0.05, 0.02])
+D_COV = np.array([[0.21, 0.10, 0.02],
+                  [0.10, 5.90, 0.40],
+                  [0.02, 0.40, 0.87]])
+
+
+def _reference_log_prob(obs, preds, sd, default_prob=0.01):
+    result = np.zeros((len(obs), len(preds)))
+    for a in range(obs.shape[1]):
+        delta = preds[np.newaxis, :, a] - obs[:, np.newaxis, a]
+        prob = norm.logpdf(np.nan_to_num(delta), scale=sd[a])
+        prob[np.isnan(delta)] = log10(default_prob)
+        result += prob
+    return result
+
+
+def test_independent_log_prob():
+    result = independent_log_prob(OBS, PREDS, SD)
+    assert_allclose(result, _reference_log_prob(OBS, PREDS, SD), rtol=1e-12)
+
+
+def test_independent_log_prob_preallocated():
+    out = np.full((3, 4), 123.0)
+    result = independent_log_prob(OBS, PREDS, SD, default_prob=0.1, out=out)
+    assert result is out
+    assert_allclose(out, _reference_log_prob(OBS, PREDS, SD, default_prob=0.1), rtol=1e-12)
+
+
+def _reference_correlated_log_prob(obs, preds, d_mean, d_cov, default_prob=0.01):
+    result = np.zeros((len(obs), len(preds)))
+    for i in range(len(obs)):
+        for j in range(len(preds)):
+            delta = preds[j] - obs[i]
+            present = ~np.isnan(delta)
+            mvn = multivariate_normal(d_mean[present], d_cov[np.ix_(present, present)])
+            result[i, j] = mvn.logpdf(delta[present]) + log10(default_prob) * (~present).sum()
+    return result
+
+
+def test_correlated_log_prob():
+    result = correlated_log_prob(OBS, PREDS, D_MEAN, D_COV)
+    assert_allclose(result, _reference_correlated_log_prob(OBS, PREDS, D_MEAN, D_COV), rtol=1e-10)
+
+
+def test_correlated_log_prob_block_size():
+    expected = correlated_log_prob(OBS, PREDS, D_MEAN, D_COV)
+    for block_size in (1, 2):
+        assert_allclose(correlated_log_prob(OBS, PREDS, D_MEAN, D_COV, block_size=block_size),
+                        expected, rtol=1e-12)
+
+
+GRAD = np.array([[0.1, -0.2, 0.0],
+                 [0.0, 0.05, -0.1],
+                 [-0.3, 0.0, 0.2],
+                 [0.02, 0.1, 0.0]])
+OFFSET = np.array([[-0.8, 20.0, 0.0],
+                   [0.0, -6.0, 5.0],
+                   [2.5, 0.0, -9.0],
+                   [-0.2, -11.0, 0.0]])
+
+
+def _corrected_reference(reference, obs, preds, *args):
+    # Correct the predictions separately for each spin system
+    result = np.zeros((len(obs), len(preds)))
+    for i in range(len(obs)):
+        corrected = preds - GRAD * obs[i] - OFFSET
+        result[i, :] = reference(obs[[i]], corrected, *args)[0]
+    return result
+
+
+def test_independent_log_prob_pred_correction():
+    result = independent_log_prob(OBS, PREDS, SD, pred_grad=GRAD, pred_offset=OFFSET)
+    assert_allclose(result, _corrected_reference(_reference_log_prob, OBS, PREDS, SD),
+                    rtol=1e-12)
+
+
+def test_correlated_log_prob_pred_correction():
+    result = correlated_log_prob(OBS, PREDS, D_MEAN, D_COV, pred_grad=GRAD, pred_offset=OFFSET)
+    expected = _corrected_reference(_reference_correlated_log_prob, OBS, PREDS, D_MEAN, D_COV)
+    assert_allclose(result, expected, rtol=1e-10)
+
+
+def test_threaded_log_prob():
+    rng = np.random.default_rng(0)
+    obs = np.vstack([OBS + rng.normal(scale=0.1, size=OBS.shape) for _ in range(5)])
+    for n_threads in (2, 3, 20):
+        assert_array_equal(independent_log_prob(obs, PREDS, SD, pred_grad=GRAD,
+                                                pred_offset=OFFSET, n_threads=n_threads),
+                           independent_log_prob(obs, PREDS, SD, pred_grad=GRAD,
+                                                pred_offset=OFFSET))
+        assert_allclose(correlated_log_prob(obs, PREDS, D_MEAN, D_COV, block_size=2,
+                                            n_threads=n_threads),
+                        correlated_log_prob(obs, PREDS, D_MEAN, D_COV), rtol=1e-12)
+
+    # The blocks write straight into the output array
+    out = np.zeros((len(obs), len(PREDS)))
+    assert independent_log_prob(obs, PREDS, SD, out=out, n_threads=4) is out
+    assert correlated_log_prob(obs, PREDS, D_MEAN, D_COV, out=out, n_threads=4) is out
+
+
+def test_pred_correction_arrays():
+    lm_pars = pd.DataFrame({"Atom_type": ["H", "H", "CAm1", "CA"],
+                            "Res_type": ["A", "G", "G", "A"],
+                            "Grad": [0.1, 0.2, 0.3, 0.4],
+                            "Offset": [-1.0, -2.0, -3.0, -4.0]})
+    atoms = ["H", "CA_m1"]
+    preds = pd.DataFrame({"Res_type": ["A", "G", "K", nan],
+                          "Res_type_m1": ["G", "A", "G", "G"]})
+
+    grad_table, offset_table = compile_pred_correction(lm_pars, atoms)
+    grad, offset = pred_correction_arrays(preds, atoms, grad_table, offset_table)
+
+    # H is corrected by residue i, and CA_m1 by residue i-1. Anything missing
+    # from the model is left uncorrected.
+    assert_array_equal(grad, [[0.1, 0.3], [0.2, 0], [0, 0.3], [0, 0.3]])
+    assert_array_equal(offset, [[-1.0, -3.0], [-2.0, 0], [0, -3.0], [0, -3.0]])
+
+
+def test_aa_mask_round_trip():
+    assert aa_mask("") == 0
+    assert aa_mask("ACDEFGHIKLMNPQRSTVWY") == ALL_AA_MASK
+    assert aa_string(aa_mask("VIA")) == "AIV"
+    assert aa_string(ALL_AA_MASK & ~aa_mask("AVI")) == "CDEFGHKLMNPQRSTWY"
+
+
+def test_aa_type_mismatch():
+    ss_classes = aa_class_masks(["AVI", nan, "G", ""])
+    res_types = residue_type_masks(["A", "G", "X", nan, "T"])
+    expected = np.array([[False, True, False, False, True],
+                         [False, False, False, False, False],
+                         [True, False, False, False, True],
+                         [True, True, False, False, True]])
+    assert_array_equal(aa_type_mismatch(ss_classes, res_types), expected)
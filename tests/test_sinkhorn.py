@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from lib.sinkhorn_lib import sinkhorn_marginals
+
+
+def test_sinkhorn_marginals():
+    rng = np.random.default_rng(0)
+    log_prob = rng.normal(size=(30, 30)) * 5
+    log_prob[rng.random((30, 30)) < 0.2] = -np.inf
+    np.fill_diagonal(log_prob, 0)
+
+    marginals, converged = sinkhorn_marginals(log_prob, tol=1e-8)
+    assert converged
+    assert np.allclose(marginals.sum(axis=0), 1)
+    assert np.allclose(marginals.sum(axis=1), 1, atol=1e-7)
+    assert (marginals[np.isinf(log_prob)] == 0).all()
+
+    # Results don't depend on the number of threads
+    threaded, _ = sinkhorn_marginals(log_prob, tol=1e-8, n_threads=3)
+    assert np.allclose(marginals, threaded, rtol=1e-12, atol=0)
+
+    # A higher temperature gives flatter probabilities
+    flat, _ = sinkhorn_marginals(log_prob, temperature=10, tol=1e-8)
+    assert flat.max() < marginals.max()
+
+
+def test_sinkhorn_marginals_2x2():
+    # For a 2x2 matrix the odds of the two assignments are the square root
+    # of the ratio of their likelihoods
+    log_prob = np.log([[0.9, 0.1], [0.2, 0.8]])
+    marginals, converged = sinkhorn_marginals(log_prob, tol=1e-12)
+    odds = np.sqrt(0.9 * 0.8 / (0.1 * 0.2))
+    assert converged
+    assert np.allclose(marginals, [[odds / (1 + odds), 1 / (1 + odds)],
+                                   [1 / (1 + odds), odds / (1 + odds)]])
+
+
+def test_sinkhorn_marginals_not_square():
+    with pytest.raises(ValueError):
+        sinkhorn_marginals(np.zeros((2, 3)))
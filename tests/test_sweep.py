@@ -0,0 +1,57 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_allclose
+
+from SNAPS_importer import SNAPS_importer
+from SNAPS_assigner import SNAPS_assigner
+from lib.sweep_lib import DeltaSet, parameter_grid, run_sweep, summarise_sweep
+
+ROOT = Path(__file__).parent.parent
+HADAMAC = ["VIA", "G", "S", "T", "DN", "FHYWC", "REKPQML"]
+
+
+def _assigner(pred_correction=False, use_ss_class_info=False):
+    a = SNAPS_assigner()
+    a.read_config_file(ROOT / 'config' / 'config_yaml.txt')
+    a.pars["delta_correlation"] = False
+    a.pars["pred_correction"] = pred_correction
+    a.pars["use_ss_class_info"] = use_ss_class_info
+    importer = SNAPS_importer()
+    ss_class = HADAMAC if use_ss_class_info else None
+    importer.import_testset_shifts(ROOT / 'data/testset/simplified_BMRB/6338.txt',
+                                   SS_class=ss_class, SS_class_m1=ss_class)
+    a.obs = importer.obs
+    a.import_pred_shifts(ROOT / 'data/testset/shiftx2_results/A002_1XMTA.cs', "shiftx2", None)
+    a.prepare_obs_preds()
+    return a
+
+
+def test_delta_set_matches_log_prob_matrix():
+    for pred_correction, use_ss_class_info in [(False, False), (True, True)]:
+        a = _assigner(pred_correction, use_ss_class_info)
+        delta_set = DeltaSet.from_assigner(a, "A002")
+
+        atom_sd = dict(a.pars["atom_sd"], CA=0.6)
+        expected = a.calc_log_prob_matrix(atom_sd=atom_sd, sf=1.3, default_prob=0.001)
+        expected = expected.loc[~a.obs["Dummy_SS"], ~a.preds["Dummy_res"]]
+        assert_allclose(delta_set.log_prob(atom_sd, sf=1.3, default_prob=0.001),
+                        expected.to_numpy(), rtol=1e-10)
+
+
+def test_run_sweep():
+    delta_set = DeltaSet.from_assigner(_assigner(), "A002")
+    grid = parameter_grid({"H": 0.45, "N": 2.4, "HA": 0.23, "C": 1.0, "CA": 0.93,
+                           "CB": 1.0, "C_m1": 1.0, "CA_m1": 0.93, "CB_m1": 1.0},
+                          sf_values=[1, 2], atom_sd_values={"CA": [0.5, 0.9]})
+    assert len(grid) == 4
+
+    results = run_sweep([delta_set], grid)
+    assert len(results) == 4
+    assert (results["Correct"] <= results["Assignable"]).all()
+    assert (results["Correct"] > 0.8 * results["Assignable"]).all()
+
+    summary = summarise_sweep(results)
+    assert len(summary) == 4
+    assert len(summary[["sf", "sd_CA"]].drop_duplicates()) == 4
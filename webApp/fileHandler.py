@@ -44,7 +44,7 @@ atom_sd: # Atom standard deviations. Don't change indentation.
     C_m1: 1.030 
     CA_m1: 0.932 
     CB_m1: 1.025
-iterate_until_consistent:       False   # If True, iteratively enforce consistent links for High and Medium confidence assignments
+iterate_until_consistent:       False   # If True, iteratively enforce consistent links for High and Medium confidence assignments. If joint, directly optimise predictions and links together
 delta_correlation:       True   # Account for correlations in prediction errors
 delta_correlation_mean_file:     ../config/d_mean.csv       # File containing mean prediction errors
 delta_correlation_cov_file:      ../config/d_cov.csv        # File containing covariances between the prediction errors